@@ -0,0 +1,90 @@
+"""
+Start-up time of the command line.
+
+The Identifier and the scheduled task start nx_tools over and over, so
+commands like `find_entry` have to start fast. Every command is run
+`--repeat` times in a fresh interpreter, and its median time on top of a
+bare interpreter start is checked against the budget:
+
+    python bench/bench_startup.py --budget 100
+
+Exits with 1 if a command is over budget.
+"""
+from __future__ import print_function
+
+import click
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# (group, arguments) of the commands measured by default.
+COMMANDS = [
+    ('nx_tools_utils', ['find_entry', '0']),
+    ('nx_tools', ['--version']),
+]
+_CODE = ("import sys\n"
+         "from nx_tools.__main__ import %s as group\n"
+         "group(sys.argv[1:])\n")
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def time_process(args, env, repeat):
+    """Median wall time of `args`, in milliseconds."""
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(repeat):
+            start = time.time()
+            subprocess.call(args, env=env, stdout=devnull, stderr=devnull)
+            times.append((time.time() - start) * 1000)
+    return median(times)
+
+
+@click.command()
+@click.option('--repeat', default=10, help="Runs of every command.")
+@click.option('--budget', default=100.0,
+              help="Milliseconds allowed on top of the interpreter start.")
+@click.option('-c', '--command', 'commands', multiple=True,
+              help="Command to measure instead of the defaults, e.g. "
+                   "\"nx_tools_utils find_entry 0\".")
+def cli(repeat, budget, commands):
+    """Measure the start-up time of nx_tools commands."""
+    if commands:
+        commands = [(c.split()[0], c.split()[1:]) for c in commands]
+    else:
+        commands = COMMANDS
+    root = tempfile.mkdtemp(prefix='nx_bench_')
+    env = dict(os.environ, NX_TOOLS_ROOT=root,
+               PYTHONPATH=os.pathsep.join(
+                       filter(None, [PACKAGE_DIR,
+                                     os.environ.get('PYTHONPATH')])))
+    try:
+        baseline = time_process([sys.executable, '-c', 'pass'], env, repeat)
+        print("%-40s %8.1f ms" % ('python', baseline))
+        over = False
+        for group, args in commands:
+            total = time_process(
+                    [sys.executable, '-c', _CODE % group] + args, env, repeat)
+            cost = total - baseline
+            status = 'OK' if cost <= budget else 'OVER BUDGET'
+            over = over or cost > budget
+            print("%-40s %8.1f ms  +%.1f ms  %s"
+                  % (' '.join([group] + args), total, cost, status))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    print("Budget: +%.0f ms" % budget)
+    sys.exit(1 if over else 0)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,312 @@
+"""
+End-to-end benchmark of the updater.
+
+A local FTP server (pyftpdlib) and a temporary directory, standing in for
+the FTP server and the build share, are filled with synthetic archives.
+Patches and builds are then checked and updated like `nx_tools update`
+would, and the listing latency, transfer throughput and extraction time are
+recorded. Latency, bandwidth limits and dropped data connections can be
+injected on the FTP side.
+
+Results are written as JSON, and two result files can be compared, e.g.
+before and after a change:
+
+    python bench/bench_update.py run --size 64 --count 3 -o before.json
+    python bench/bench_update.py run --size 64 --count 3 -o after.json
+    python bench/bench_update.py compare before.json after.json
+
+Archives are 7z if a 7z executable is found (or given with --7z), tar
+otherwise. Requires pyftpdlib, which nx_tools itself does not depend on:
+
+    pip install -r bench/requirements.txt
+"""
+from __future__ import print_function
+
+import click
+import contextlib
+from distutils.spawn import find_executable
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+
+# Keep the benchmark away from the user's files. Must be set before
+# nx_tools is imported.
+WORK_ROOT = tempfile.mkdtemp(prefix='nx_bench_')
+os.environ['NX_TOOLS_ROOT'] = os.path.join(WORK_ROOT, 'user')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+        __file__))))
+
+from nx_tools.__main__ import __version__  # noqa: E402
+from nx_tools.commands import update  # noqa: E402
+from nx_tools import utils  # noqa: E402
+
+VERSION = 'bench'
+MB = 1024 * 1024
+# Files per archive.
+FILES = 4
+
+
+def make_archive(path, size, exe):
+    """Create an archive of `size` bytes of random data at `path`."""
+    content = tempfile.mkdtemp(dir=WORK_ROOT)
+    kits = os.path.join(content, 'kits')
+    os.makedirs(kits)
+    for i in range(FILES):
+        with open(os.path.join(kits, 'file%i.dll' % i), 'wb') as fh:
+            remaining = size // FILES
+            while remaining > 0:
+                block = os.urandom(min(MB, remaining))
+                fh.write(block)
+                remaining -= len(block)
+    if exe:
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call([exe, 'a', '-mx=0', path, kits],
+                                  stdout=devnull)
+    else:
+        # TarFile is no context manager on Python 2.6.
+        with contextlib.closing(tarfile.open(path, 'w')) as tar:
+            tar.add(kits, arcname='kits')
+    shutil.rmtree(content)
+
+
+def ftp_server(root, latency, rate, drop):
+    """Start an anonymous FTP server on `root` in a background thread.
+
+    Args:
+        latency (float): Seconds added to every FTP command.
+        rate (int): Bytes per second of every data connection, 0 for no
+            limit.
+        drop (float): If set, the connection is dropped once for every
+            file, after this fraction of the file was sent.
+
+    Returns:
+        pyftpdlib.servers.ThreadedFTPServer
+    """
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler, ThrottledDTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+    dropped = set()
+
+    class DTPHandler(ThrottledDTPHandler):
+        read_limit = rate
+        write_limit = rate
+
+        def send(self, data):
+            name = getattr(self.file_obj, 'name', None)
+            if drop and name and name not in dropped:
+                if self.tot_bytes_sent > drop * os.path.getsize(name):
+                    dropped.add(name)
+                    # Like a network failure: both connections go down.
+                    self.cmd_channel.close()
+                    return 0
+            return ThrottledDTPHandler.send(self, data)
+
+    class Handler(FTPHandler):
+        dtp_handler = DTPHandler
+        # sendfile would bypass the throttling and the drops.
+        use_sendfile = False
+
+        def process_command(self, cmd, *args, **kwargs):
+            if latency:
+                time.sleep(latency)
+            return FTPHandler.process_command(self, cmd, *args, **kwargs)
+
+    authorizer = DummyAuthorizer()
+    authorizer.add_anonymous(root)
+    Handler.authorizer = authorizer
+    logging.getLogger('pyftpdlib').setLevel(logging.WARNING)
+    server = ThreadedFTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def make_config(share, ftp_address, local, exe, overrides):
+    config = utils.read_default_config()
+    config['remote'] = dict(build={VERSION: share}, patch={VERSION: '/'})
+    config['local'] = dict(build={VERSION: os.path.join(local, 'builds')},
+                           patch={VERSION: os.path.join(local, 'patches')})
+    config['ftp_host'] = ftp_address
+    config['7z_exe'] = exe or 'unused'
+    config['delete_zip'] = True
+    config['cache_server'] = None
+    # Always list the server, and do not wait for the archives to settle.
+    config['listing_ttl'] = 0
+    config['upload_settle'] = 0
+    config.update(overrides)
+    return config
+
+
+def measure(updater_cls, config, kind, archive_bytes):
+    """Check and update one kind of item, timing each step.
+
+    Returns:
+        dict
+    """
+    result = {}
+    updater = updater_cls(VERSION, config, progress=False)
+    if kind == 'patch':
+        start = time.time()
+        updater.ftp
+        result['connect_s'] = time.time() - start
+    start = time.time()
+    updater.check()
+    result['check_s'] = time.time() - start
+    result['items'] = len(updater.new_items)
+    start = time.time()
+    updater.update()
+    result['update_s'] = time.time() - start
+    totals = updater.timer.totals
+    transfer = totals.get('transfer', 0.0) + totals.get('stream', 0.0)
+    result['transfer_s'] = transfer
+    result['extract_s'] = totals.get('extract', 0.0)
+    result['throughput_MBps'] = (archive_bytes / transfer / MB if transfer
+                                 else None)
+    if kind == 'patch':
+        updater.close()
+    return result
+
+
+def median(values):
+    values = sorted(v for v in values if v is not None)
+    if not values:
+        return None
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def git_describe():
+    # subprocess.check_output is missing from Python 2.6.
+    try:
+        process = subprocess.Popen(
+                ['git', 'describe', '--always', '--dirty'],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                cwd=os.path.dirname(os.path.abspath(__file__)))
+    except OSError:
+        return None
+    out, _ = process.communicate()
+    if process.returncode != 0:
+        return None
+    return out.strip()
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command('run')
+@click.option('--size', default=16, help="Size of each archive, in MB.")
+@click.option('--count', default=2, help="Archives of each kind.")
+@click.option('--repeat', default=3, help="Number of runs.")
+@click.option('--latency', default=0.0,
+              help="Seconds added to every FTP command.")
+@click.option('--rate', default=0.0,
+              help="Bandwidth of every FTP data connection, in MB/s.")
+@click.option('--drop', default=0.0,
+              help="Drop every FTP transfer once, after this fraction.")
+@click.option('--7z', 'exe', default=None,
+              help="7z executable, found on the PATH by default.")
+@click.option('--set', 'settings', multiple=True,
+              help="Configuration override, KEY=JSON, e.g. ftp_segments=4.")
+@click.option('-o', '--output', default='bench_results.json',
+              help="Result file.")
+@click.option('--keep', is_flag=True,
+              help="Keep the working directory, %s." % WORK_ROOT)
+def run(size, count, repeat, latency, rate, drop, exe, settings, output,
+        keep):
+    """Benchmark patch and build updates."""
+    exe = exe or find_executable('7z') or find_executable('7za')
+    ext = '.7z' if exe else '.tar'
+    overrides = {}
+    for setting in settings:
+        key, _, value = setting.partition('=')
+        overrides[key] = json.loads(value)
+    ftp_root = os.path.join(WORK_ROOT, 'ftp')
+    share = os.path.join(WORK_ROOT, 'share')
+    utils.ensure_dir_exists(ftp_root)
+    utils.ensure_dir_exists(share)
+    print("Creating %i x 2 archives of %i MB (%s)..." % (count, size, ext))
+    for i in range(count):
+        make_archive(os.path.join(ftp_root, 'nx_bench_%02i_wntx64%s'
+                                  % (i, ext)), size * MB, exe)
+        make_archive(os.path.join(share, 'NX_BENCH_%02i%s' % (i, ext)),
+                     size * MB, exe)
+    archive_bytes = dict(
+            patch=sum(os.path.getsize(os.path.join(ftp_root, f))
+                      for f in os.listdir(ftp_root)),
+            build=sum(os.path.getsize(os.path.join(share, f))
+                      for f in os.listdir(share)))
+
+    server = ftp_server(ftp_root, latency, int(rate * MB), drop)
+    address = '127.0.0.1:%i' % server.address[1]
+    runs = []
+    try:
+        for i in range(repeat):
+            local = os.path.join(WORK_ROOT, 'local%i' % i)
+            config = make_config(share, address, local, exe, overrides)
+            results = {}
+            for kind, updater_cls in (('patch', update._TMGUpdater),
+                                      ('build', update._BuildUpdater)):
+                print("Run %i/%i: %s" % (i + 1, repeat, kind))
+                results[kind] = measure(updater_cls, config, kind,
+                                        archive_bytes[kind])
+            runs.append(results)
+            shutil.rmtree(local, ignore_errors=True)
+    finally:
+        server.close_all()
+        if not keep:
+            shutil.rmtree(WORK_ROOT, ignore_errors=True)
+
+    medians = {}
+    for kind in ('patch', 'build'):
+        for metric in runs[0][kind]:
+            medians['%s.%s' % (kind, metric)] = median(
+                    [r[kind][metric] for r in runs])
+    report = dict(nx_tools=__version__, git=git_describe(),
+                  time=time.time(), python=sys.version.split()[0],
+                  platform=sys.platform,
+                  params=dict(size_MB=size, count=count, repeat=repeat,
+                              latency_s=latency, rate_MBps=rate, drop=drop,
+                              format=ext, config=overrides),
+                  runs=runs, median=medians)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=4, sort_keys=True)
+    for metric, value in sorted(medians.items()):
+        print("%-28s %s" % (metric, '-' if value is None
+                            else '%.3f' % value))
+    print("Results written to %s" % output)
+
+
+@cli.command('compare')
+@click.argument('before', type=click.File('r'))
+@click.argument('after', type=click.File('r'))
+def compare(before, after):
+    """Compare the medians of two result files."""
+    os.rmdir(WORK_ROOT)
+    before = json.load(before)
+    after = json.load(after)
+    if before['params'] != after['params']:
+        print("WARNING: the parameters differ.")
+    print("%-28s %10s %10s %8s" % ('', before['git'] or before['nx_tools'],
+                                   after['git'] or after['nx_tools'], ''))
+    for metric in sorted(set(before['median']) & set(after['median'])):
+        old, new = before['median'][metric], after['median'][metric]
+        if old is None or new is None:
+            continue
+        change = '%+.1f%%' % (100.0 * (new - old) / old) if old else ''
+        print("%-28s %10.3f %10.3f %8s" % (metric, old, new, change))
+
+
+if __name__ == '__main__':
+    cli()
@@ -6,29 +6,44 @@
     Additionally, to access the configuration, the @pass_object decorator is
     necessary.
 """
+from __future__ import print_function
 
 import click
-from pkg_resources import parse_version
 import logging
 import os
+import re
 import subprocess
 import sys
+import threading
 
 from ._click import NamedGroup
+from . import spans
+from .cache import JSONCache
+from .exceptions import ConfigError
 from .utils import read_config
-from .commands import add_task
-from .commands import config
-from .commands import find_entry
-from .commands import launch
-from .commands import _list
-from .commands import update
-from .commands import identifier
 
 __version__ = '1.1.11'
 
+UPGRADE_SOURCE = os.path.join('T:\\', 'selimb', 'nx_tools')
+
 CONTEXT_SETTINGS = dict(token_normalize_func=lambda x: x.lower())
 
 
+def load_config(ctx):
+    """Merged configuration, cached between invocations.
+
+    An invalid configuration aborts every command but `config`, which is
+    how it gets fixed.
+    """
+    try:
+        return read_config(version=__version__)
+    except ConfigError as e:
+        if ctx.invoked_subcommand != 'config':
+            raise click.ClickException(str(e))
+        print("WARNING: %s" % e, file=sys.stderr)
+        return e.config
+
+
 def make_logger(verbose):
     logger = logging.getLogger(__name__)
     if verbose:
@@ -38,17 +53,100 @@ def make_logger(verbose):
         logging.basicConfig()
 
 
-def check_for_update():
+def start_profile(ctx, dump):
+    """Record timing spans until the command exits, then print them.
+
+    Args:
+        dump (str): If set, the main thread is also run under cProfile, and
+            its statistics are written to this file (see `pstats`).
+    """
+    spans.enable()
+    profiler = None
+    if dump:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    def report():
+        # On stderr, not to mix with e.g. `check --json`.
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(dump)
+            print("Profile written to %s" % dump, file=sys.stderr)
+        print(spans.pformat(), file=sys.stderr)
+    ctx.call_on_close(report)
+
+
+def profile_options(func):
+    """Add the --profile and --profile-dump options to a command group."""
+    func = click.option('--profile-dump', type=click.Path(dir_okay=False),
+                        help="Also write cProfile statistics to this file.")(
+            func)
+    return click.option('--profile', is_flag=True,
+                        help="Print the time spent in each phase.")(func)
+
+
+def parse_version(version):
+    """Comparable form of a version string, e.g. (1, 1, 11) for '1.1.11'.
+
+    Returns:
+        tuple
+    """
+    return tuple(int(part) for part in re.findall(r'\d+', version))
+
+
+def read_available_version():
+    """Version available on the share, None if it cannot be read."""
     logger = logging.getLogger(__name__)
-    source = os.path.join('T:\\', 'selimb', 'nx_tools')
-    vtxt = os.path.join(source, 'version.txt')
+    vtxt = os.path.join(UPGRADE_SOURCE, 'version.txt')
     try:
-        new_version = open(vtxt).read().strip()
+        with open(vtxt) as f:
+            new_version = f.read().strip()
     except IOError:
-        logger.debug("Could not open %s" % vtxt)
-        return
-    logger.debug("Version at %s : %s" % (vtxt, new_version))
-    if parse_version(new_version) <= parse_version(__version__):
+        logger.debug("Could not open %s", vtxt)
+        return None
+    logger.debug("Version at %s : %s", vtxt, new_version)
+    return new_version
+
+
+def available_version(ttl, timeout):
+    """Version available on the share, as cached in USER_ROOT.
+
+    When the cache is older than `ttl` seconds, it is refreshed in a
+    background thread, waited for at most `timeout` seconds, so that a slow
+    or unreachable share does not hold up the command. Until the refresh
+    completes, the previous value is used.
+
+    Returns:
+        str : None if unknown.
+    """
+    logger = logging.getLogger(__name__)
+    cache = JSONCache('upgrade')
+    version, age = cache.get('available_version')
+    if age is not None and age <= ttl:
+        return version
+    # Reset the age first, so that other commands do not also wait on a
+    # share that does not answer.
+    cache.set('available_version', version)
+
+    def refresh():
+        cache.set('available_version', read_available_version())
+    thread = threading.Thread(target=refresh)
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        logger.debug("Share did not answer within %s s", timeout)
+        return version
+    return cache.get('available_version')[0]
+
+
+@spans.span('self-update check')
+def check_for_update(config):
+    new_version = available_version(config['upgrade_check_ttl'],
+                                    config['upgrade_check_timeout'])
+    if (new_version is None
+            or parse_version(new_version) <= parse_version(__version__)):
         return
     print("Update is available: %s " % new_version)
     question = " Do you want to upgrade [Y/n]? "
@@ -57,9 +155,9 @@ def check_for_update():
     if answer.lower() == 'n':
         return
     print("Changelog available at %s"
-          % os.path.join(source, 'CHANGELOG.url'))
+          % os.path.join(UPGRADE_SOURCE, 'CHANGELOG.url'))
     print("The current command will have to be re-run after installation.")
-    sys.exit(subprocess.call(os.path.join(source, 'install.bat')))
+    sys.exit(subprocess.call(os.path.join(UPGRADE_SOURCE, 'install.bat')))
 
 
 @click.command('nx_tools', cls=NamedGroup,
@@ -68,34 +166,51 @@ def check_for_update():
               help='Enables verbose mode.')
 @click.option('--no-upgrade', is_flag=True,
               help="Don't prompt for version upgrade.")
+@profile_options
 @click.version_option(__version__, prog_name='NX Tools')
 @click.pass_context
-def nx_tools(ctx, verbose, no_upgrade):
+def nx_tools(ctx, verbose, no_upgrade, profile, profile_dump):
     make_logger(verbose)
+    if profile or profile_dump:
+        start_profile(ctx, profile_dump)
+    with spans.span('config'):
+        ctx.obj = load_config(ctx)
     if no_upgrade is False:
-        check_for_update()
-    ctx.obj = read_config()
+        check_for_update(ctx.obj)
 
 
 @click.command('nx_tools_utils', cls=NamedGroup,
                context_settings=CONTEXT_SETTINGS)
 @click.option('-v', '--verbose', is_flag=True,
               help='Enables verbose mode.')
+@profile_options
 @click.pass_context
-def nx_tools_utils(ctx, verbose):
+def nx_tools_utils(ctx, verbose, profile, profile_dump):
     make_logger(verbose)
-    ctx.obj = read_config()
-
-
-nx_tools.add_command(add_task.cli)
-nx_tools.add_command(config.cli)
-nx_tools.add_command(launch.cli)
-nx_tools.add_command(update.update_cli)
-nx_tools.add_command(_list.cli)
-nx_tools.add_command(identifier.cli)
-
-nx_tools_utils.add_command(update.check_cli)
-nx_tools_utils.add_command(find_entry.cli)
+    if profile or profile_dump:
+        start_profile(ctx, profile_dump)
+    with spans.span('config'):
+        ctx.obj = load_config(ctx)
+
+
+# Commands are only imported when invoked.
+for name, import_path in [
+        ('add_task', 'nx_tools.commands.add_task:cli'),
+        ('config', 'nx_tools.commands.config:cli'),
+        ('launch', 'nx_tools.commands.launch:cli'),
+        ('update', 'nx_tools.commands.update:update_cli'),
+        ('list', 'nx_tools.commands._list:cli'),
+        ('identifier', 'nx_tools.commands.identifier:cli'),
+        ('dedupe', 'nx_tools.commands.dedupe:cli'),
+        ('prune', 'nx_tools.commands.prune:cli'),
+        ('serve', 'nx_tools.commands.serve:cli'),
+        ('verify', 'nx_tools.commands.verify:cli'),
+        ('watch', 'nx_tools.commands.watch:cli')]:
+    nx_tools.add_lazy_command(name, import_path)
+
+nx_tools_utils.add_lazy_command('check', 'nx_tools.commands.update:check_cli')
+nx_tools_utils.add_lazy_command('find_entry',
+                                'nx_tools.commands.find_entry:cli')
 
 nx_tools_all = click.CommandCollection(sources=[nx_tools, nx_tools_utils])
 
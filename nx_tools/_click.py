@@ -2,6 +2,32 @@ import click
 
 
 class NamedGroup(click.Group):
+    """Group whose commands can be registered by import path.
+
+    Such commands are only imported when invoked, or listed by --help, so
+    that starting a command does not import all the others.
+    """
+
+    def __init__(self, *args, **kwargs):
+        click.Group.__init__(self, *args, **kwargs)
+        self.lazy_commands = {}
+
+    def add_lazy_command(self, name, import_path):
+        """Register the command `name` found at 'package.module:attribute'."""
+        self.lazy_commands[name] = import_path
+
+    def list_commands(self, ctx):
+        return sorted(set(self.commands) | set(self.lazy_commands))
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name not in self.commands and cmd_name in self.lazy_commands:
+            module, attribute = self.lazy_commands[cmd_name].split(':')
+            # importlib is missing from Python 2.6.
+            command = getattr(__import__(module, fromlist=[attribute]),
+                              attribute)
+            self.add_command(command, cmd_name)
+        return click.Group.get_command(self, ctx, cmd_name)
+
     def format_usage(self, ctx, formatter):
         pieces = self.collect_usage_pieces(ctx)
         formatter.write_usage(self.name, ' '.join(pieces))
@@ -0,0 +1,101 @@
+"""
+    nx_tools.cache
+    ~~~~~~~~~~~~~~
+
+    Small persistent caches stored under USER_ROOT.
+"""
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+from .constants import CACHE_DIR
+from .utils import ensure_dir_exists, file_lock
+
+# Shared by all caches, so that instances of the same cache in several
+# threads do not overwrite each other's entries.
+_lock = threading.RLock()
+# {path: how many times the thread holding `_lock` holds its file lock}
+_depths = {}
+
+
+class JSONCache(object):
+    """A dictionary of timestamped values persisted as a JSON file.
+
+    The file is re-read before every update, under a lock shared by all
+    threads and processes, so that concurrent writers do not overwrite each
+    other's entries. Hold `locked` around a read-modify-write spanning
+    several calls.
+
+    Args:
+        name (str): Name of the cache file inside CACHE_DIR.
+    """
+
+    def __init__(self, name, cache_dir=CACHE_DIR):
+        self.path = os.path.join(cache_dir, name + '.json')
+
+    @contextlib.contextmanager
+    def locked(self):
+        """Hold the lock of the cache. Reentrant."""
+        with _lock:
+            depth = _depths.get(self.path, 0)
+            _depths[self.path] = depth + 1
+            try:
+                if depth:
+                    yield
+                else:
+                    ensure_dir_exists(os.path.dirname(self.path))
+                    with file_lock(self.path + '.lock'):
+                        yield
+            finally:
+                _depths[self.path] = depth
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _dump(self, data):
+        ensure_dir_exists(os.path.dirname(self.path))
+        tmp = '%s.%i.tmp' % (self.path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(tmp, self.path)
+
+    def get(self, key):
+        """Value stored for `key` along with its age in seconds.
+
+        Returns:
+            tuple : (value, age), or (None, None) if there is no such key.
+        """
+        with self.locked():
+            record = self._load().get(key)
+        if record is None:
+            return None, None
+        return record['value'], time.time() - record['time']
+
+    def set(self, key, value):
+        self.update({key: value})
+
+    def update(self, values):
+        """Set several keys at once, with a single write.
+
+        Args:
+            values (dict): {key: value}
+        """
+        logger = logging.getLogger(__name__)
+        now = time.time()
+        with self.locked():
+            data = self._load()
+            for key, value in values.items():
+                data[key] = dict(time=now, value=value)
+            try:
+                self._dump(data)
+            except EnvironmentError as e:
+                logger.debug("Could not write cache %s: %s", self.path, e)
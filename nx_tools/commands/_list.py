@@ -8,50 +8,81 @@ import logging
 import os
 import time
 
+from .. import inventory
+from .. import spans
 from .. import utils
 
 FMT = "{0}. {1} -- created: {2}"
 
 
+@spans.span('directory listing')
 def list_directories(root_dir):
     """List absolute paths to directories inside `root_dir`.
 
-    Directories are listed in reverse alphabetical order.
+    Directories are listed in reverse alphabetical order, without the ones
+    still being extracted. They are read from the inventory, which only
+    rescans `root_dir` if it changed.
 
     Returns:
         list
     """
     logger = logging.getLogger(__name__)
-    logger.debug('Listing directories in %s' % root_dir)
-    directories = []
-    for d in os.listdir(root_dir):
-        path = os.path.join(root_dir, d)
-        if os.path.isdir(path):
-            directories.append(path)
-    return directories[::-1]
-
-
-def fmt_ctime(x):
-    kits_path = os.path.join(x, 'kits')
-    if os.path.exists(kits_path):
-        x = kits_path
-    t = time.gmtime(os.path.getmtime(x))
+    logger.debug('Listing directories in %s', root_dir)
+    names = inventory.Inventory().installed(root_dir)
+    return [os.path.join(root_dir, d) for d in sorted(names, reverse=True)]
+
+
+def directory_entries(paths):
+    """Inventory entries of `paths`, reading the index of each root once.
+
+    Returns:
+        list : Entry of every path, None if not indexed.
+    """
+    inv = inventory.Inventory()
+    roots = {}
+    result = []
+    for path in paths:
+        root, name = os.path.split(os.path.normpath(path))
+        if root not in roots:
+            try:
+                roots[root] = inv.entries(root)
+            except OSError:
+                roots[root] = {}
+        result.append(roots[root].get(name))
+    return result
+
+
+def fmt_ctime(x, mtime=None):
+    """Format the modification time of `x`'s kits folder, or of `x`.
+
+    Args:
+        mtime (float): Modification time, if known, e.g. from the inventory.
+    """
+    if mtime is None:
+        kits_path = os.path.join(x, 'kits')
+        if os.path.exists(kits_path):
+            x = kits_path
+        mtime = os.path.getmtime(x)
+    t = time.gmtime(mtime)
     return time.strftime("%a %b %d", t)
 
 
 def pformat_directories(l, absolute=False):
     """Pretty print directory listing.
 
-    Directories are listed along with the file creation date.
+    Directories are listed along with the file creation date, read from the
+    inventory.
     """
-    def fmt_dir(index, directory, absolute):
+    def fmt_dir(index, directory, entry, absolute):
         transform = os.path.basename
         if absolute:
             transform = lambda x: x
-        return FMT.format(index, transform(directory), fmt_ctime(directory))
+        mtime = entry.get('kits_mtime') if entry else None
+        return FMT.format(index, transform(directory),
+                          fmt_ctime(directory, mtime))
 
-    return '\n'.join(fmt_dir(i, d, absolute=absolute)
-                     for i, d in enumerate(l))
+    return '\n'.join(fmt_dir(i, d, e, absolute=absolute)
+                     for i, (d, e) in enumerate(zip(l, directory_entries(l))))
 
 
 @click.command('list', short_help='List available builds and patches.')
@@ -73,8 +104,8 @@ def cli(config, nx_version, build, patch, absolute):
                                   absolute=absolute))
 
     build_root, patch_root = utils.get_local_roots(config, nx_version)
-    logger.debug('Build root: %s' % build_root)
-    logger.debug('Patch root: %s' % patch_root)
+    logger.debug('Build root: %s', build_root)
+    logger.debug('Patch root: %s', patch_root)
     header_build, header_patch = ["List of %s:" % x
                                   for x in ('builds', 'patches')]
     if build and patch:
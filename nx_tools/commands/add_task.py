@@ -25,7 +25,7 @@ def cli(config):
     props.append('/ST %s' % starttime)
     props.append('/F')
     cmd = "schtasks /Create " + ' '.join(props)
-    logger.debug("Running command:\n%s" % cmd)
+    logger.debug("Running command:\n%s", cmd)
     proc = subprocess.Popen(cmd, shell=True)
     proc.wait()
     if proc.returncode == 0:
@@ -122,7 +122,7 @@ def edit():
     logger = logging.getLogger(__name__)
     filename = USER_CONFIG_PATH
     backup = filename + BACKUP_EXT
-    logger.debug('Backing up %s at %s' % (filename, backup))
+    logger.debug('Backing up %s at %s', filename, backup)
     shutil.copy(filename, backup)
     editor = NPP
     print('Opening %s with %s.' % (filename, editor))
@@ -134,7 +134,7 @@ def revert():
     logger = logging.getLogger(__name__)
     filename = USER_CONFIG_PATH
     backup = filename + BACKUP_EXT
-    logger.debug('Copying %s to %s' % (backup, filename))
+    logger.debug('Copying %s to %s', backup, filename)
     try:
         shutil.copy(backup, filename)
     except IOError as e:
@@ -0,0 +1,274 @@
+"""
+Hard-link deduplication of extracted builds.
+
+Identical files across the builds of a root directory are replaced with hard
+links to a single copy kept in a content-addressed store, laid out as
+<store>/<size>/<sha1>. The store must be on the same volume as the builds.
+"""
+from __future__ import print_function
+
+import click
+import collections
+import errno
+import hashlib
+import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+
+from .. import utils
+from ..transfer import format_size
+
+STORE_NAME = '.nx_store'
+# Smaller files are not worth a hash and a link.
+MIN_SIZE = 64 * 1024
+
+
+def default_store(root):
+    """Store used for `root` when none is configured: a sibling of `root`."""
+    return os.path.join(os.path.dirname(os.path.normpath(root)), STORE_NAME)
+
+
+def get_store(config, root):
+    return config['dedupe_store'] or default_store(root)
+
+
+def hash_file(path, blocksize=1024 * 1024):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(blocksize), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _walk_files(top, min_size):
+    for dirpath, _, filenames in os.walk(top):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            st = os.lstat(path)
+            if st.st_size >= min_size:
+                yield path, st
+
+
+def _win32_link_info(path):
+    """(volume, file index) and link count, from the file handle.
+
+    Python 2 on Windows reports neither inode numbers nor link counts.
+
+    Raises:
+        OSError: If the file cannot be opened.
+    """
+    import ctypes
+    from ctypes import wintypes
+
+    class FILE_INFO(ctypes.Structure):
+        _fields_ = [('attributes', wintypes.DWORD),
+                    ('creation_time', wintypes.FILETIME),
+                    ('access_time', wintypes.FILETIME),
+                    ('write_time', wintypes.FILETIME),
+                    ('volume', wintypes.DWORD),
+                    ('size_high', wintypes.DWORD),
+                    ('size_low', wintypes.DWORD),
+                    ('links', wintypes.DWORD),
+                    ('index_high', wintypes.DWORD),
+                    ('index_low', wintypes.DWORD)]
+
+    FILE_SHARE_ALL = 0x7
+    OPEN_EXISTING = 3
+    FILE_FLAG_BACKUP_SEMANTICS = 0x02000000
+    kernel32 = ctypes.windll.kernel32
+    kernel32.CreateFileW.restype = wintypes.HANDLE
+    handle = kernel32.CreateFileW(unicode(path), 0, FILE_SHARE_ALL, None,
+                                  OPEN_EXISTING, FILE_FLAG_BACKUP_SEMANTICS,
+                                  None)
+    if handle == wintypes.HANDLE(-1).value:
+        raise ctypes.WinError()
+    try:
+        info = FILE_INFO()
+        if not kernel32.GetFileInformationByHandle(handle,
+                                                   ctypes.byref(info)):
+            raise ctypes.WinError()
+    finally:
+        kernel32.CloseHandle(handle)
+    return ((info.volume, info.index_high, info.index_low), info.links)
+
+
+def _link_info(path, st):
+    """Key shared by all hard links to the same data, and their number.
+
+    Returns:
+        tuple : (identity, link count)
+    """
+    if st.st_ino:
+        return (st.st_dev, st.st_ino), st.st_nlink
+    if os.name == 'nt':
+        return _win32_link_info(path)
+    raise OSError(errno.ENOSYS, "No inode numbers", path)
+
+
+def _read_store(store):
+    """Files of the store, by size.
+
+    Returns:
+        dict : {size: {sha1: path}}
+    """
+    found = collections.defaultdict(dict)
+    if not os.path.isdir(store):
+        return found
+    for size in os.listdir(store):
+        size_dir = os.path.join(store, size)
+        for digest in os.listdir(size_dir):
+            found[int(size)][digest] = os.path.join(size_dir, digest)
+    return found
+
+
+def _replace_with_link(source, path):
+    """Replace `path` with a hard link to `source`.
+
+    Returns:
+        bool : False if `path` cannot be removed, e.g. a DLL in use.
+    """
+    logger = logging.getLogger(__name__)
+    tmp = path + '.nxlink'
+    utils.hard_link(source, tmp)
+    try:
+        os.remove(path)
+    except OSError as e:
+        logger.debug("Not linking %s: %s", path, e)
+        os.remove(tmp)
+        return False
+    os.rename(tmp, path)
+    return True
+
+
+def dedupe_root(root, store, min_size=MIN_SIZE, dry_run=False):
+    """Replace identical files in the builds of `root` with hard links.
+
+    Files are first grouped by size, and only files sharing their size with
+    another file (or with a stored one) are hashed. Files already linked to
+    the store are never hashed again. Files which cannot be replaced, e.g.
+    DLLs loaded by a running NX, are left alone.
+
+    Returns:
+        tuple : (number of files linked, bytes reclaimed)
+    """
+    logger = logging.getLogger(__name__)
+    stored = _read_store(store)
+    digests = {}
+    store_ids = {}
+    for size, files in stored.items():
+        for digest, path in files.items():
+            store_ids[path], _ = _link_info(path, os.stat(path))
+            digests[store_ids[path]] = digest
+
+    by_size = collections.defaultdict(list)
+    for name in os.listdir(root):
+        tree = os.path.join(root, name)
+        if os.path.isdir(tree):
+            for path, st in _walk_files(tree, min_size):
+                identity, links = _link_info(path, st)
+                by_size[st.st_size].append((path, identity, links))
+
+    # One hash per identity: files already linked together are hashed once.
+    to_hash = {}
+    for size, files in by_size.items():
+        identities = set(identity for _, identity, _ in files)
+        if len(identities) > 1 or size in stored:
+            for path, identity, _ in files:
+                if identity not in digests:
+                    to_hash.setdefault(identity, path)
+    logger.debug("Hashing %i files", len(to_hash))
+    pool = ThreadPool(multiprocessing.cpu_count())
+    try:
+        digests.update(zip(to_hash, pool.map(hash_file, to_hash.values())))
+    finally:
+        pool.close()
+        pool.join()
+
+    linked = 0
+    reclaimed = 0
+    for size, files in by_size.items():
+        for path, identity, links in files:
+            digest = digests.get(identity)
+            if digest is None:
+                continue
+            canonical = stored[size].get(digest)
+            if canonical is None:
+                # First of its kind: it becomes the stored copy.
+                canonical = os.path.join(store, str(size), digest)
+                stored[size][digest] = canonical
+                store_ids[canonical] = identity
+                if not dry_run:
+                    utils.ensure_dir_exists(os.path.dirname(canonical))
+                    utils.hard_link(path, canonical)
+                continue
+            if identity == store_ids[canonical]:
+                continue
+            if not dry_run and not _replace_with_link(canonical, path):
+                continue
+            linked += 1
+            # The data is only freed once its last link is gone.
+            if links <= 1:
+                reclaimed += size
+    return linked, reclaimed
+
+
+def prune_store(store, dry_run=False):
+    """Remove stored files which are not linked from any build anymore.
+
+    Returns:
+        int : Bytes freed.
+    """
+    freed = 0
+    for size, files in _read_store(store).items():
+        for path in files.values():
+            if _link_info(path, os.stat(path))[1] == 1:
+                freed += size
+                if not dry_run:
+                    os.remove(path)
+    return freed
+
+
+def dedupe(config, root, dry_run=False):
+    """Deduplicate the builds of `root` and print a report."""
+    store = get_store(config, root)
+    try:
+        linked, reclaimed = dedupe_root(root, store, dry_run=dry_run)
+    except OSError as e:
+        if e.errno == errno.EXDEV:
+            print("The store %s must be on the same drive as %s."
+                  % (store, root))
+            return
+        if e.errno == errno.ENOSYS:
+            print("Cannot deduplicate %s: hard links cannot be told apart."
+                  % root)
+            return
+        raise
+    freed = prune_store(store, dry_run=dry_run)
+    verb = "Would reclaim" if dry_run else "Reclaimed"
+    print("%s: %i files linked. %s %s." % (root, linked, verb,
+                                           format_size(reclaimed + freed)))
+
+
+@click.command('dedupe', short_help='Hard-link identical build files.')
+@click.argument('nx_version', nargs=1, required=False)
+@click.option('--all', 'all_versions', is_flag=True,
+              help="Deduplicate builds of every NX version.")
+@click.option('-n', '--dry-run', is_flag=True,
+              help="Only report what would be reclaimed.")
+@click.pass_obj
+def cli(config, nx_version, all_versions, dry_run):
+    logger = logging.getLogger(__name__)
+    logger.debug(utils.pformat_cli_args(locals()))
+    if all_versions:
+        versions = sorted(config['local']['build'])
+    elif nx_version is not None:
+        versions = [nx_version]
+    else:
+        raise click.UsageError("Missing argument \"nx_version\".")
+    for version in versions:
+        root = config['local']['build'][version]
+        if utils.is_exe(root) or not os.path.isdir(root):
+            logger.debug("Skipping %s", root)
+            continue
+        dedupe(config, root, dry_run=dry_run)
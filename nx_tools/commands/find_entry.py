@@ -1,22 +1,14 @@
 import click
 import os
 
-from .. import utils
-from ..constants import HISTORY_PATH
+from .. import history
 
 
 @click.command('find_entry', short_help="Used internally by the Identifier.")
 @click.argument('pid', nargs=1, type=click.INT)
 def cli(pid):
-    records = utils.load_json(HISTORY_PATH)
-    for entry in records.itervalues():
-        try:
-            entry_pid = entry["PID"]
-        except TypeError:
-            continue
-        if int(entry_pid) == pid:
-            break
-    else:
+    entry = history.find(pid)
+    if entry is None:
         print("Could not find entry with PID %s" % pid)
         return
 
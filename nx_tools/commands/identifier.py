@@ -14,5 +14,5 @@ def cli(config):
     identifier = os.path.join(PKG_BIN, 'nx_identifier.exe')
     logger = logging.getLogger(__name__)
     cmd = [identifier, config['identifier_hotkey']]
-    logger.debug("Calling %s" % cmd)
+    logger.debug("Calling %s", cmd)
     subprocess.Popen(cmd)
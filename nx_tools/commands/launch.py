@@ -4,15 +4,27 @@ Functions for launching NX.
 This command uses _list.
 """
 import click
+import fnmatch
+import glob
 import logging
 import os
-from pprint import pformat
+import re
 import subprocess
+import sys
+import time
 
-from ..constants import HISTORY_PATH, HISTORY_MAX_RECORDS
+from .. import history
+from .. import inventory
 from .. import utils
+from ..constants import USER_ROOT
 from . import _list
 
+_LATEST_RE = re.compile(r'^latest(?:-(\d+))?$', re.IGNORECASE)
+MATERIALIZE_LOG = os.path.join(USER_ROOT, 'materialize.log')
+_MATERIALIZE_CODE = ("import sys\n"
+                     "from nx_tools.commands import update\n"
+                     "update.materialize(sys.argv[1], sys.argv[2])\n")
+
 
 def query(dir_listing, msg):
     print(msg)
@@ -24,17 +36,74 @@ def query(dir_listing, msg):
     return dir_listing[chosen_idx]
 
 
-def set_tmg_var(patch):
-    print("Setting UGII_TMG_DIR to: " + patch)
-    os.environ["UGII_TMG_DIR"] = patch
+def select(dir_listing, selectors):
+    """Directories of `dir_listing` matching any of `selectors`.
+
+    Args:
+        dir_listing (list): Newest first, see `_list.list_directories`.
+        selectors (list): 'latest', 'latest-N' for the N newest, or glob
+            patterns of directory names.
+
+    Returns:
+        list : Newest first.
+
+    Raises:
+        click.BadParameter: If a selector matches nothing.
+    """
+    selected = set()
+    for selector in selectors:
+        match = _LATEST_RE.match(selector)
+        if match:
+            matches = dir_listing[:int(match.group(1) or 1)]
+        else:
+            matches = [d for d in dir_listing
+                       if fnmatch.fnmatch(os.path.basename(d), selector)]
+        if not matches:
+            raise click.BadParameter("%s matches nothing." % selector)
+        selected.update(matches)
+    return [d for d in dir_listing if d in selected]
+
+
+def start_ugraf(ugraf_exe, tmg_dir, working_dir):
+    """Start ugraf.exe in its own environment and working directory.
 
+    Args:
+        tmg_dir (str): UGII_TMG_DIR of the session, "" for the build's
+            internal TMG, None to inherit it.
+        working_dir (str): None for the current directory.
 
-def find_ugraf(build_dir, nxbin):
+    Returns:
+        int : PID
+    """
     logger = logging.getLogger(__name__)
-    ugii_ugraf = os.path.join(build_dir, 'kits', 'ugii', 'ugraf.exe')
-    nxbin_ugraf = os.path.join(build_dir, 'kits', 'nxbin', 'ugraf.exe')
-    nxbin_exists = os.path.exists(nxbin_ugraf)
-    ugii_exists = os.path.exists(ugii_ugraf)
+    env = dict(os.environ)
+    if tmg_dir is not None:
+        # Python 2 requires byte strings in the environment block.
+        if isinstance(tmg_dir, unicode):
+            tmg_dir = tmg_dir.encode(sys.getfilesystemencoding())
+        env['UGII_TMG_DIR'] = tmg_dir
+    cmd = [ugraf_exe]
+    logger.debug("Launch command:\n%r", cmd)
+    return subprocess.Popen(cmd, cwd=working_dir or None, env=env).pid
+
+
+def find_ugraf(build_dir, nxbin, indexed=True):
+    """Path of ugraf.exe in `build_dir`, as found by the inventory.
+
+    Args:
+        indexed (bool): False to only look on disk, e.g. for builds outside
+            of the local roots.
+    """
+    entry = _list.directory_entries([build_dir])[0] if indexed else None
+    found = entry.get('ugraf') if entry else None
+    if not found or not os.path.isfile(os.path.join(build_dir, found[0])):
+        # Not indexed, or the index is stale: look on disk.
+        found = [rel for rel in inventory.UGRAF_PATHS
+                 if os.path.exists(os.path.join(build_dir, rel))]
+    nxbin_ugraf, ugii_ugraf = [os.path.join(build_dir, rel)
+                               for rel in inventory.UGRAF_PATHS]
+    nxbin_exists = inventory.UGRAF_PATHS[0] in found
+    ugii_exists = inventory.UGRAF_PATHS[1] in found
     if nxbin_exists:
         if nxbin or not ugii_exists:
             return nxbin_ugraf
@@ -48,29 +117,148 @@ def find_ugraf(build_dir, nxbin):
     return ugii_ugraf
 
 
+def remote_builds(config, nx_version):
+    """Builds on the share, newest first.
 
-def log_entry(PID, nx_version, build_dir, patch_dir, name):
-    logger = logging.getLogger(__name__)
-    try:
-        records = utils.load_json(HISTORY_PATH)
-    except IOError:
-        records = dict(last_update=0)
-    last_update = int(records["last_update"])
-    if last_update >= HISTORY_MAX_RECORDS:
-        new_update = 1
-    else:
-        new_update = last_update + 1
-    records["last_update"] = new_update
+    A build may be there as an archive, as an extracted directory (with a
+    `kits` folder), or both.
+
+    Returns:
+        list : (name, extracted directory or None, archive or None)
+    """
+    from . import update
+    remote_dir = config['remote']['build'].get(nx_version)
+    if not remote_dir or not os.path.isdir(remote_dir):
+        return []
+    builds = {}
+    for name in inventory.list_dirs(remote_dir):
+        path = os.path.join(remote_dir, name)
+        if os.path.isdir(os.path.join(path, 'kits')):
+            builds[name] = [path, None]
+    for pattern in update.ARCHIVE_PATTERNS:
+        for archive in glob.glob(os.path.join(remote_dir, pattern)):
+            builds.setdefault(update.get_filename(archive),
+                              [None, None])[1] = archive
+    return [(name,) + tuple(builds[name])
+            for name in sorted(builds, reverse=True)]
+
+
+def query_remote(builds):
+    print("Pick a remote build:")
+    for i, (name, extracted, _) in enumerate(builds):
+        print("%i. %s -- %s" % (i, name,
+                                "extracted" if extracted else "archive"))
+    chosen_idx = click.prompt(
+            '> ', prompt_suffix='',
+            type=click.IntRange(min=0, max=len(builds) - 1)
+    )
+    return builds[chosen_idx]
+
+
+def resolve_remote(config, nx_version, latest):
+    """Build directory to launch with --remote.
+
+    The local copy of the chosen build is used if there is one. Otherwise,
+    its extracted copy on the share is launched while the local copy is made
+    by a background, low priority, process. Failing that, the build is
+    extracted straight from the share archive.
+
+    Returns:
+        tuple : (build directory, whether it is on the share)
+    """
+    from . import update
+    builds = remote_builds(config, nx_version)
+    if not builds:
+        print("Could not find any build on the share.")
+        raise click.Abort
+    name, extracted, archive = builds[0] if latest else query_remote(builds)
+    local_dir = config['local']['build'][nx_version]
+    utils.ensure_dir_exists(local_dir)
+    entry = inventory.Inventory().entries(local_dir).get(name)
+    if entry is not None and entry['status'] != inventory.EXTRACTING:
+        print("Using the local copy of %s." % name)
+        return os.path.join(local_dir, name), False
+    if extracted is not None:
+        if archive is None:
+            print("No archive of %s to copy locally." % name)
+        elif entry is not None:
+            print("%s is already being copied locally." % name)
+        else:
+            print("Copying %s locally in the background, see %s."
+                  % (name, MATERIALIZE_LOG))
+            utils.spawn_background([sys.executable, '-c', _MATERIALIZE_CODE,
+                                    nx_version, archive],
+                                   log_path=MATERIALIZE_LOG)
+        return extracted, True
+    print("Extracting %s straight from the share..." % name)
+    update.install_from_share(nx_version, config, archive)
+    return os.path.join(local_dir, name), False
+
+
+def make_entry(PID, nx_version, build_dir, patch_dir, name):
+    """History entry of a launch.
+
+    Args:
+        build_dir (str): Path of the build, or ugraf.exe if frozen.
+        patch_dir (str): Path of the patch, "" if vanilla.
+
+    Returns:
+        tuple : (entry, used), see `history.add_entry`.
+    """
     new_entry = dict(PID=PID,
                      nx_version=nx_version,
-                     build=build_dir,
-                     patch=patch_dir,
+                     build=os.path.basename(build_dir),
+                     patch=os.path.basename(patch_dir),
                      name=name)
+    used = [patch_dir]
+    if not utils.is_exe(build_dir):
+        used.append(build_dir)
+    return new_entry, used
+
+
+def log_entry(PID, nx_version, build_dir, patch_dir, name):
+    """Record a launch in the history. See `make_entry`."""
+    history.add_entry(*make_entry(PID, nx_version, build_dir, patch_dir,
+                                  name))
+
+
+def launch_matrix(nx_version, builds, patches, tmg_dir, name, working_dir,
+                  nxbin, stagger):
+    """Launch every combination of `builds` and `patches`.
 
-    logger.debug("New entry for counter %s:\n%s"
-                 % (new_update, pformat(new_entry)))
-    records[str(new_update)] = new_entry
-    utils.write_json(records, HISTORY_PATH)
+    Sessions are started `stagger` seconds apart, so that they do not all
+    load from the disk at once, and recorded in the history in one go.
+
+    Args:
+        builds (list): Build directories, or ugraf.exe if frozen.
+        patches (list): Patch directories.
+        tmg_dir: If not False, the UGII_TMG_DIR of every session (see
+            `start_ugraf`), instead of the `tmg` folder of its patch.
+    """
+    ugrafs = dict((build, build if utils.is_exe(build)
+                   else find_ugraf(build, nxbin)) for build in builds)
+    combinations = [(build, patch) for build in builds for patch in patches]
+    print("Launching %i NX sessions%s:"
+          % (len(combinations), " in %s" % working_dir if working_dir
+             else ""))
+    launches = []
+    try:
+        for i, (build, patch) in enumerate(combinations):
+            if i:
+                time.sleep(stagger)
+            session_tmg = (os.path.join(patch, 'tmg') if tmg_dir is False
+                           else tmg_dir)
+            PID = start_ugraf(ugrafs[build], session_tmg, working_dir)
+            session_name = '%s %i' % (name, i + 1) if name else name
+            print("  %i. %s + %s (PID %i)"
+                  % (i + 1, os.path.basename(build),
+                     os.path.basename(patch) or 'vanilla', PID))
+            launches.append(make_entry(PID, nx_version, build, patch,
+                                       session_name))
+    finally:
+        # Even if interrupted, the sessions started are recorded.
+        if launches:
+            history.add_entries(launches)
 
 
 @click.command('launch', short_help='Launcher.')
@@ -87,23 +275,69 @@ def log_entry(PID, nx_version, build_dir, patch_dir, name):
               help="Use current directory as working directory.")
 @click.option('--nxbin', is_flag=True,
               help="Launch ugraf.exe from 'nxbin' if possible.")
+@click.option('--matrix', is_flag=True,
+              help="Launch every combination of the builds and patches "
+                   "selected with -b and -p.")
+@click.option('-b', '--build', 'build_selectors', multiple=True,
+              help="Builds for --matrix: 'latest', 'latest-N' or a glob, "
+                   "e.g. 'NX1102_00*'. Repeatable, 'latest' by default.")
+@click.option('-p', '--patch', 'patch_selectors', multiple=True,
+              help="Patches for --matrix, like --build.")
+@click.option('--stagger', type=click.FLOAT,
+              help="Seconds between two launches of --matrix, "
+                   "`launch_stagger` by default.")
+@click.option('--remote', is_flag=True,
+              help="Pick the build from the share, and launch it before it "
+                   "is copied locally.")
 @click.pass_obj
-def cli(config, nx_version, latest, vanilla, env_var, name, cwd, nxbin):
+def cli(config, nx_version, latest, vanilla, env_var, name, cwd, nxbin,
+        matrix, build_selectors, patch_selectors, stagger, remote):
     logger = logging.getLogger(__name__)
     if cwd:
         working_dir = os.getcwd()
     else:
         working_dir = config['start_in']
     logger.debug(utils.pformat_cli_args(locals()))
+    if (build_selectors or patch_selectors) and not matrix:
+        raise click.UsageError("--build and --patch require --matrix.")
+    if remote and matrix:
+        raise click.UsageError("--remote cannot be used with --matrix.")
     build_root, patch_root = utils.get_local_roots(config, nx_version)
-    # Get Build
-    if utils.is_exe(build_root):
+    frozen = utils.is_exe(build_root)
+    if remote and frozen:
+        raise click.UsageError("--remote cannot be used with frozen builds.")
+    if frozen:
         print("Frozen build.")
-        logger.debug("%s is Frozen." % build_root)
-        chosen_build = build_root
-        ugraf_exe = chosen_build
+        logger.debug("%s is Frozen.", build_root)
         if working_dir is None:
             working_dir = 'D:\\'
+    if matrix:
+        if frozen:
+            builds = [build_root]
+        else:
+            builds = select(_list.list_directories(build_root),
+                            build_selectors or ['latest'])
+        if vanilla:
+            patches, tmg_dir = [""], ""
+        elif env_var:
+            patches, tmg_dir = [os.environ.get('UGII_TMG_DIR', "")], None
+        else:
+            patches = select(_list.list_directories(patch_root),
+                             patch_selectors or ['latest'])
+            tmg_dir = False
+        if stagger is None:
+            stagger = config['launch_stagger']
+        launch_matrix(nx_version, builds, patches, tmg_dir, name,
+                      working_dir, nxbin, stagger)
+        return
+
+    # Get Build
+    if frozen:
+        chosen_build = build_root
+        ugraf_exe = chosen_build
+    elif remote:
+        chosen_build, on_share = resolve_remote(config, nx_version, latest)
+        ugraf_exe = find_ugraf(chosen_build, nxbin, indexed=not on_share)
     else:
         builds_list = _list.list_directories(build_root)
         if latest:
@@ -112,12 +346,13 @@ def cli(config, nx_version, latest, vanilla, env_var, name, cwd, nxbin):
             chosen_build = query(builds_list, "Pick a build:")
         ugraf_exe = find_ugraf(chosen_build, nxbin)
 
-    # Get Patch and set TMG
+    # Get Patch and TMG
     if vanilla:
         chosen_patch = ""
-        set_tmg_var("")
+        tmg_dir = ""
     elif env_var:
         chosen_patch = os.environ['UGII_TMG_DIR']
+        tmg_dir = None
         print("Not setting UGII_TMG_DIR. Currently set to: %s" % chosen_patch)
     else:
         patches_list = _list.list_directories(patch_root)
@@ -126,21 +361,17 @@ def cli(config, nx_version, latest, vanilla, env_var, name, cwd, nxbin):
         else:
             chosen_patch = query(patches_list, "Pick a patch:")
         tmg_dir = os.path.join(chosen_patch, 'tmg')
-        set_tmg_var(tmg_dir)
+    if tmg_dir is not None:
+        print("Setting UGII_TMG_DIR to: " + tmg_dir)
 
-    if working_dir:
-        os.chdir(working_dir)
-    cmd = [ugraf_exe]
-    logger.debug("Launch command:\n%r" % cmd)
     msg = 'Launching NX from:'
     space = len(msg)
     msg += ' ' + str(ugraf_exe) + '\n'
     msg += '%*s %s' % (space, 'in:', working_dir) if working_dir else ''
     print(msg)
-    proc = subprocess.Popen(cmd)
-    PID = proc.pid
+    PID = start_ugraf(ugraf_exe, tmg_dir, working_dir)
     log_entry(PID=PID,
               nx_version=nx_version,
-              build_dir=os.path.basename(chosen_build),
-              patch_dir=os.path.basename(chosen_patch),
+              build_dir=chosen_build,
+              patch_dir=chosen_patch,
               name=name)
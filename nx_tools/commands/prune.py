@@ -0,0 +1,289 @@
+"""
+Retention of local builds and patches.
+
+When a root directory goes over its quota (`retention_quota`, in bytes, per
+kind and NX version), its least recently used items are deleted until it
+fits again. An item was last used when it was last launched, according to
+the launch history, or else when it was installed. The newest
+`retention_keep` items, the ones still running and the ones being extracted
+are never deleted.
+
+Items are first renamed into a `.nx_trash` folder next to the root, which
+is instant, and then deleted by a detached, low priority, process.
+"""
+from __future__ import print_function
+
+import click
+import logging
+import os
+import sys
+import time
+
+from .. import history
+from .. import inventory
+from .. import manifest
+from .. import utils
+from ..transfer import format_size
+
+TRASH_NAME = '.nx_trash'
+# Extracted size of an item per archive byte, when nothing better is known.
+DEFAULT_EXTRACT_RATIO = 3.0
+_DELETE_CODE = ("import shutil, sys\n"
+                "for path in sys.argv[1:]:\n"
+                "    shutil.rmtree(path, True)\n")
+
+
+def trash_dir(root):
+    return os.path.join(os.path.dirname(os.path.normpath(root)), TRASH_NAME)
+
+
+def _archive_path(root, name):
+    item_manifest = manifest.load(name)
+    if item_manifest and item_manifest['archive']:
+        path = os.path.join(root, item_manifest['archive'])
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def _tree_size(path):
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            size += os.lstat(os.path.join(dirpath, filename)).st_size
+    return size
+
+
+def item_size(root, name, entry=None, measured=None):
+    """Size of the item `name` of `root`, archive included.
+
+    Read from the manifest of the item when there is one, or else from its
+    inventory `entry` if measured since its directory last changed. Files
+    hard linked by `dedupe` are counted in full, although deleting them
+    frees nothing while other builds link them.
+
+    Args:
+        measured (dict): Filled with {name: inventory fields} when the
+            directory had to be walked, see `Inventory.annotate`.
+
+    Returns:
+        int
+    """
+    item_manifest = manifest.load(name)
+    if item_manifest and item_manifest['members']:
+        size = sum(member[0] for member in item_manifest['members'].values())
+    elif entry and (entry.get('disk_size') or [None])[0] == entry['mtime']:
+        size = entry['disk_size'][1]
+    else:
+        size = _tree_size(os.path.join(root, name))
+        if entry and measured is not None:
+            measured[name] = dict(disk_size=[entry['mtime'], size])
+    archive = _archive_path(root, name)
+    if archive:
+        size += os.path.getsize(archive)
+    return size
+
+
+def extract_ratio(root):
+    """Extracted size per archive byte, over the items of `root` whose
+    manifest knows both.
+
+    Returns:
+        float : DEFAULT_EXTRACT_RATIO if no item tells.
+    """
+    archives = extracted = 0
+    for name in inventory.Inventory().entries(root):
+        item_manifest = manifest.load(name)
+        if (item_manifest and item_manifest['members']
+                and item_manifest['size']):
+            archives += item_manifest['size']
+            extracted += sum(member[0] for member
+                             in item_manifest['members'].values())
+    if not archives:
+        return DEFAULT_EXTRACT_RATIO
+    return float(extracted) / archives
+
+
+def expected_size(root, archive_size):
+    """Disk space taken while installing archives of `archive_size` bytes
+    to `root`: the archives and their extracted content.
+
+    Returns:
+        int
+    """
+    return int(archive_size * (1 + extract_ratio(root)))
+
+
+def protected_names(config, kind, root):
+    """Names of the items of the `kind` root `root` currently running.
+
+    Launches of every NX version are considered, since several versions
+    may share a root, e.g. nx1002 and nx1003 use the nx10 patches (see
+    `utils.get_local_roots`).
+    """
+    root = history.path_key(root)
+    names = set()
+    for entry in history.running_entries():
+        try:
+            roots = utils.get_local_roots(config, entry['nx_version'])
+        except KeyError:
+            continue
+        entry_root = roots[0] if kind == 'build' else roots[1]
+        if entry[kind] and history.path_key(entry_root) == root:
+            names.add(entry[kind])
+    return names
+
+
+def plan(root, quota, keep, protected=(), reserve=0):
+    """Items of `root` to delete to fit in `quota` bytes.
+
+    Args:
+        keep (int): Number of newest items never deleted.
+        protected (set): Names of items never deleted.
+        reserve (int): Bytes to free on top of the quota, e.g. for items
+            about to be installed.
+
+    Returns:
+        tuple : (list of (name, size, last use) to delete, least recently
+                 used first; usage of `root` once they are deleted)
+    """
+    entries = inventory.Inventory().entries(root)
+    names = sorted(entries, reverse=True)
+    measured = {}
+    sizes = dict((name, item_size(root, name, entries[name], measured))
+                 for name in names)
+    if measured:
+        inventory.Inventory().annotate(root, measured)
+    usage = sum(sizes.values())
+
+    def last_use(name):
+        return (history.last_used(os.path.join(root, name))
+                or entries[name]['mtime'] or 0)
+    candidates = [name for name in names[keep:]
+                  if name not in protected
+                  and entries[name]['status'] != inventory.EXTRACTING]
+    candidates.sort(key=last_use)
+    doomed = []
+    for name in candidates:
+        if usage + reserve <= quota:
+            break
+        doomed.append((name, sizes[name], last_use(name)))
+        usage -= sizes[name]
+    return doomed, usage
+
+
+def delete(root, names):
+    """Move the items `names` of `root` to the trash, and empty it.
+
+    Items which cannot be moved, e.g. because they are in use, are skipped.
+
+    Returns:
+        list : Names of the deleted items.
+    """
+    logger = logging.getLogger(__name__)
+    trash = trash_dir(root)
+    batch = os.path.join(trash, '%i.%i' % (time.time(), os.getpid()))
+    utils.ensure_dir_exists(batch)
+    deleted = []
+    for name in names:
+        archive = _archive_path(root, name)
+        moved = []
+        try:
+            # The archive first: the directory is the one most likely in
+            # use, and both are put back if it cannot be moved.
+            if archive:
+                target = os.path.join(batch, os.path.basename(archive))
+                os.rename(archive, target)
+                moved.append((archive, target))
+            os.rename(os.path.join(root, name), os.path.join(batch, name))
+        except OSError as e:
+            for source, target in moved:
+                try:
+                    os.rename(target, source)
+                except OSError as undo_error:
+                    logger.debug("Could not restore %s: %s", source,
+                                 undo_error)
+            print("Could not delete %s: %s" % (name, e))
+            continue
+        try:
+            os.remove(manifest.manifest_path(name))
+        except OSError:
+            pass
+        deleted.append(name)
+    # Batches left behind by interrupted deletions are emptied as well.
+    batches = [os.path.join(trash, d) for d in os.listdir(trash)]
+    logger.debug("Emptying %s", batches)
+    utils.spawn_background([sys.executable, '-c', _DELETE_CODE] + batches)
+    return deleted
+
+
+def enforce(config, kind, nx_version, archives=0, dry_run=False):
+    """Apply the retention policy to the `kind` root of `nx_version`.
+
+    Args:
+        archives (int): Size of the archives about to be installed. Room is
+            made for them and their extracted content, see `expected_size`.
+
+    Returns:
+        list : Names of the items deleted, or that would be with `dry_run`.
+            None if there is no quota.
+    """
+    quota = config['retention_quota'][kind].get(nx_version)
+    root = config['local'][kind].get(nx_version)
+    if (not quota or not root or utils.is_exe(root)
+            or not os.path.isdir(root)):
+        return None
+    doomed, usage = plan(root, quota, config['retention_keep'],
+                         protected=protected_names(config, kind, root),
+                         reserve=expected_size(root, archives)
+                         if archives else 0)
+    if not doomed:
+        return []
+    verb = "Would delete" if dry_run else "Deleting"
+    print("%s %i %s %s(s) from %s:" % (verb, len(doomed), nx_version, kind,
+                                       root))
+    for name, size, last_use in doomed:
+        print("  %-30s %10s  last used %s"
+              % (name, format_size(size),
+                 time.strftime('%Y-%m-%d', time.localtime(last_use))))
+    freed = sum(size for _, size, _ in doomed)
+    print("  %s %sfreed, %s of %s used." % (format_size(freed),
+                                            "would be " if dry_run else "",
+                                            format_size(usage),
+                                            format_size(quota)))
+    names = [name for name, _, _ in doomed]
+    if dry_run:
+        return names
+    return delete(root, names)
+
+
+@click.command('prune', short_help='Delete least recently used items.')
+@click.argument('nx_version', nargs=1, required=False)
+@click.option('--all', 'all_versions', is_flag=True,
+              help="Prune every NX version.")
+@click.option('--build', is_flag=True,
+              help="Only prune builds.")
+@click.option('--patch', is_flag=True,
+              help="Only prune patches.")
+@click.option('-n', '--dry-run', is_flag=True,
+              help="Only report what would be deleted.")
+@click.pass_obj
+def cli(config, nx_version, all_versions, build, patch, dry_run):
+    """Delete the least recently launched builds and patches of the roots
+    over their `retention_quota`.
+    """
+    logger = logging.getLogger(__name__)
+    logger.debug(utils.pformat_cli_args(locals()))
+    if all_versions:
+        versions = sorted(set(config['local']['build'])
+                          | set(config['local']['patch']))
+    elif nx_version is not None:
+        versions = [nx_version]
+    else:
+        raise click.UsageError("Missing argument \"nx_version\".")
+    kinds = [k for k, wanted in (('build', not patch), ('patch', not build))
+             if wanted]
+    for version in versions:
+        for kind in kinds:
+            if enforce(config, kind, version, dry_run=dry_run) is None:
+                logger.debug("No quota for %s %s", version, kind)
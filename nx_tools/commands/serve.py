@@ -0,0 +1,399 @@
+"""
+Caching proxy shared by the updaters of a site.
+
+`nx_tools serve` answers HTTP requests for /<kind>/<nx_version>/<archive>,
+where kind is 'build' or 'patch'. Each archive is fetched once from its
+origin (the FTP server for patches, the build share for builds) into
+`serve_cache_dir`, and then served to every client from there. Clients
+being served while the archive is still being fetched receive the data as
+it arrives. Range requests are supported, so that clients can resume. HEAD
+requests are answered without fetching the archive.
+
+Archives missing at their origin are answered with 404. When the origin
+cannot be reached or fails, the answer is 503 or 502, so that clients can
+tell that they may try again.
+
+Clients use the server when `cache_server` is set, e.g. to
+"http://hostname:8719", and fall back to the origin when it fails.
+
+There is no access control: anyone who can reach the port can download
+every build and patch of the configuration. The server only listens on
+localhost unless told otherwise with `--bind`.
+"""
+from __future__ import print_function
+
+import BaseHTTPServer
+import click
+import ftplib
+import logging
+import os
+import re
+import socket
+import SocketServer
+import threading
+import urllib
+
+from .. import utils
+from .. import transfer
+from ..cache import JSONCache
+from ..constants import USER_ROOT
+
+KINDS = ('build', 'patch')
+_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def get_cache_dir(config):
+    return config['serve_cache_dir'] or os.path.join(USER_ROOT, 'serve')
+
+
+class OriginError(Exception):
+    """The requested archive cannot be found at its origin."""
+
+
+# Origin failures which may not last.
+_TRANSIENT_ERRORS = (socket.error, EOFError, ftplib.error_temp)
+
+
+def parse_range(header, size):
+    """Bytes requested by the Range `header` of a GET of `size` bytes.
+
+    Returns:
+        tuple : (start, end), None for all, or False if unsatisfiable.
+    """
+    if not header:
+        return None
+    match = _RANGE_RE.match(header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last) + 1, size) if last else size
+    else:
+        start, end = max(0, size - int(last)), size
+    if start >= end:
+        return False
+    return start, end
+
+
+class _Fetch(object):
+    """An archive of the cache, complete or being fetched.
+
+    `ready` is set once the fetch started, i.e. `size` is known, or failed
+    to, with `failure`. Readers then wait on `cond` for more data until
+    `done` is set.
+    """
+
+    def __init__(self, path, size=None):
+        self.path = path
+        self.size = size
+        self.done = False
+        self.error = None
+        self.failure = None
+        self.cond = threading.Condition()
+        self.ready = threading.Event()
+        if size is not None:
+            self.ready.set()
+
+    def notify(self, done=False, error=None):
+        with self.cond:
+            self.done = self.done or done
+            self.error = error
+            self.cond.notify_all()
+
+    def read(self, start, end, blocksize):
+        """Yield the bytes [start, end) of the archive, as they arrive.
+
+        Raises:
+            IOError: If the fetch failed.
+        """
+        with open(self.path, 'rb') as fh:
+            fh.seek(start)
+            while start < end:
+                # Read first: once done, everything was written.
+                done = self.done
+                block = fh.read(min(blocksize, end - start))
+                if block:
+                    start += len(block)
+                    yield block
+                    continue
+                if done:
+                    raise IOError("Archive truncated at byte %i" % start)
+                # Clears the end of file flag, which Python 2 file objects
+                # keep even once the file grows.
+                fh.seek(start)
+                with self.cond:
+                    if self.error is not None:
+                        raise IOError("Fetch failed: %s" % self.error)
+                    if not self.done:
+                        self.cond.wait(1)
+
+
+class ArchiveCache(object):
+    """Archives fetched from their origin, by (kind, nx_version, name).
+
+    The index of complete archives is kept in the cache directory, so that
+    they survive a restart. Anything else found there is fetched again.
+    """
+
+    def __init__(self, config):
+        self.logger = logging.getLogger(__name__)
+        self.config = config
+        self.cache_dir = get_cache_dir(config)
+        self.index = JSONCache('index', cache_dir=self.cache_dir)
+        self._fetches = {}
+        self._lock = threading.Lock()
+
+    def _key(self, kind, nx_version, name):
+        return '/'.join((kind, nx_version, name))
+
+    def _cached_size(self, key, path):
+        """Size of the complete archive `key` of the cache, None if it is
+        not there."""
+        entry, _ = self.index.get(key)
+        if (entry and os.path.isfile(path)
+                and os.path.getsize(path) == entry['size']):
+            return entry['size']
+        return None
+
+    def get(self, kind, nx_version, name):
+        """The archive, complete or started fetching.
+
+        The entry is reserved under the lock, but the origin is only
+        contacted outside of it, so that a slow origin holds up the clients
+        of that archive only.
+
+        Raises:
+            OriginError, EnvironmentError, ftplib.all_errors: If the
+                archive is not found at its origin, or the origin fails.
+        """
+        key = self._key(kind, nx_version, name)
+        path = os.path.join(self.cache_dir, kind, nx_version, name)
+        start = False
+        with self._lock:
+            fetch = self._fetches.get(key)
+            if fetch is None or fetch.error is not None:
+                size = self._cached_size(key, path)
+                if size is not None:
+                    fetch = _Fetch(path, size)
+                    fetch.done = True
+                else:
+                    fetch = _Fetch(path)
+                    start = True
+                self._fetches[key] = fetch
+        if start:
+            try:
+                self._start(kind, nx_version, name, fetch)
+            except BaseException as e:
+                fetch.error = str(e) or e.__class__.__name__
+                fetch.failure = e
+                with self._lock:
+                    if self._fetches.get(key) is fetch:
+                        del self._fetches[key]
+                fetch.ready.set()
+                raise
+        fetch.ready.wait()
+        if fetch.size is None:
+            raise fetch.failure
+        return fetch
+
+    def size(self, kind, nx_version, name):
+        """Size of the archive, without fetching it.
+
+        Raises:
+            See `get`.
+        """
+        key = self._key(kind, nx_version, name)
+        with self._lock:
+            fetch = self._fetches.get(key)
+        if (fetch is not None and fetch.size is not None
+                and fetch.error is None):
+            return fetch.size
+        size = self._cached_size(
+                key, os.path.join(self.cache_dir, kind, nx_version, name))
+        if size is not None:
+            return size
+        size, _, close = self._open_origin(kind, nx_version, name)
+        close()
+        return size
+
+    def _remote_dir(self, kind, nx_version):
+        try:
+            return self.config['remote'][kind][nx_version]
+        except KeyError:
+            raise OriginError("No remote %s for %s" % (kind, nx_version))
+
+    def _open_origin(self, kind, nx_version, name):
+        """Size of the archive at its origin, and how to fetch it.
+
+        Returns:
+            tuple : (size, stream, close). stream(write) fetches the
+                archive, returns its SHA-256 and closes the origin, which
+                close() does without fetching.
+        """
+        remote_dir = self._remote_dir(kind, nx_version)
+        blocksize = self.config['%s_blocksize' % ('ftp' if kind == 'patch'
+                                                  else 'copy')]
+        if kind == 'patch':
+            ftp = transfer.ftp_connect(self.config['ftp_host'], remote_dir,
+                                       self.config['ftp_timeout'])
+            size = transfer.ftp_size(ftp, name)
+            if size is None:
+                ftp.close()
+                raise OriginError("%s not found on the FTP server" % name)
+
+            def stream(write):
+                try:
+                    return transfer.ftp_stream(ftp, name, write, blocksize,
+                                               progress=False)
+                finally:
+                    ftp.close()
+            return size, stream, ftp.close
+        src = os.path.join(remote_dir, name)
+        if not os.path.isfile(src):
+            raise OriginError("%s not found" % src)
+
+        def stream(write):
+            return transfer.file_stream(src, write, blocksize,
+                                        progress=False)
+        return os.path.getsize(src), stream, lambda: None
+
+    def _start(self, kind, nx_version, name, fetch):
+        """Find the size of the archive at its origin and start fetching it
+        in the background."""
+        size, stream, _ = self._open_origin(kind, nx_version, name)
+        utils.ensure_dir_exists(os.path.dirname(fetch.path))
+        # Created before the thread starts, so that readers can open it.
+        open(fetch.path, 'wb').close()
+        fetch.size = size
+        thread = threading.Thread(target=self._fetch,
+                                  args=(fetch, stream, kind, nx_version,
+                                        name))
+        thread.daemon = True
+        thread.start()
+        fetch.ready.set()
+
+    def _fetch(self, fetch, stream, kind, nx_version, name):
+        print("Fetching %s %s %s..." % (nx_version, kind, name))
+        try:
+            with open(fetch.path, 'wb') as fh:
+                def write(block):
+                    fh.write(block)
+                    # Readers only see what is flushed.
+                    fh.flush()
+                    fetch.notify()
+                sha256 = stream(write)
+                if fh.tell() != fetch.size:
+                    raise EOFError("Origin closed at byte %i" % fh.tell())
+        except (EnvironmentError, EOFError) + ftplib.all_errors as e:
+            self.logger.debug("Fetch of %s failed: %s", name, e)
+            print("Could not fetch %s: %s" % (name, e))
+            fetch.notify(error=str(e) or e.__class__.__name__)
+            return
+        self.index.set(self._key(kind, nx_version, name),
+                       dict(size=fetch.size, sha256=sha256))
+        print("Fetched %s." % name)
+        fetch.notify(done=True)
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    server_version = 'nx_tools'
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        self._serve(body=False)
+
+    def do_GET(self):
+        self._serve(body=True)
+
+    def _serve(self, body):
+        parts = [urllib.unquote(part) for part in
+                 self.path.split('?')[0].strip('/').split('/')]
+        if (len(parts) != 3 or parts[0] not in KINDS
+                or parts[2] in ('', '.', '..')
+                or os.path.basename(parts[2]) != parts[2]
+                or '\\' in parts[2]):
+            self.send_error(404)
+            return
+        kind, nx_version, name = parts
+        cache = self.server.cache
+        try:
+            if body:
+                fetch = cache.get(kind, nx_version, name)
+                size = fetch.size
+            else:
+                size = cache.size(kind, nx_version, name)
+        except OriginError as e:
+            self.send_error(404, str(e))
+            return
+        except _TRANSIENT_ERRORS as e:
+            self.send_error(503, "Origin unavailable: %s" % e)
+            return
+        except (EnvironmentError,) + ftplib.all_errors as e:
+            self.send_error(502, "Origin failed: %s" % e)
+            return
+        requested = parse_range(self.headers.getheader('Range'), size)
+        if requested is False:
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%i' % size)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        start, end = requested or (0, size)
+        self.send_response(206 if requested else 200)
+        if requested:
+            self.send_header('Content-Range',
+                             'bytes %i-%i/%i' % (start, end - 1, size))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start))
+        self.end_headers()
+        if not body:
+            return
+        try:
+            for block in fetch.read(start, end, self.server.blocksize):
+                self.wfile.write(block)
+        except EnvironmentError as e:
+            # Headers are gone already: the client sees a short read.
+            self.log_error("%s: %s", self.path, e)
+            self.close_connection = 1
+
+    def log_message(self, fmt, *args):
+        logging.getLogger(__name__).info("%s - " + fmt,
+                                         self.client_address[0], *args)
+
+
+class CacheServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, config):
+        BaseHTTPServer.HTTPServer.__init__(self, address, _Handler)
+        self.cache = ArchiveCache(config)
+        self.blocksize = 256 * 1024
+
+
+@click.command('serve', short_help='Serve builds and patches to peers.')
+@click.option('-p', '--port', type=click.INT,
+              help="Port to listen on, `serve_port` by default.")
+@click.option('--bind', default='127.0.0.1',
+              help="Address to listen on, localhost by default. Use "
+                   "0.0.0.0 to serve other machines: anyone reaching the "
+                   "port can then download every build and patch.")
+@click.pass_obj
+def cli(config, port, bind):
+    """Cache builds and patches fetched from their origin, and serve them
+    over HTTP to the machines whose `cache_server` points here.
+    """
+    logger = logging.getLogger(__name__)
+    logger.debug(utils.pformat_cli_args(locals()))
+    port = port or config['serve_port']
+    server = CacheServer((bind, port), config)
+    print("Serving %s on %s:%i. Press Ctrl+C to stop."
+          % (get_cache_dir(config), bind, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
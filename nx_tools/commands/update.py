@@ -4,16 +4,35 @@ Functions for updating NX patch and build.
 from __future__ import print_function
 
 import click
+import contextlib
 import ftplib
 import glob
+import json
 import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os
 import shutil
 import subprocess
 import sys
+import tarfile
+import threading
+import time
+import urllib
 
+from .. import cache
 from .. import utils
 from .. import exceptions
+from .. import inventory
+from .. import manifest
+from .. import scheduler
+from .. import sevenzip
+from .. import spans
+from .. import transfer
+from . import dedupe
+from . import prune
+
+ARCHIVE_PATTERNS = ("*.7z", "*.tar", "*.tar.gz", "*.tgz")
 
 
 def get_process_output(process):
@@ -22,34 +41,54 @@ def get_process_output(process):
     return errmsg
 
 
-def extract(archive_filepath, exe):
+def extract(archive_filepath, exe, threads=None, output_dir=None):
     """Extracts archive file to folder in same directory.
 
     Args:
       archive_filepath (str): Absolute path to archive file.
       exe (str): Extract command.
+      threads (int): Number of threads used by 7-Zip. Defaults to 7-Zip's
+        own choice.
+      output_dir (str): Folder to extract to, instead of the one next to the
+        archive.
 
     Raises:
       OSError: If the command cannot be run.
+      ExtractionError: If the extraction fails.
     """
     logger = logging.getLogger(__name__)
-    output_dir = os.path.join(os.path.dirname(archive_filepath),
-                              get_filename(archive_filepath))
-    command = [exe, "x", archive_filepath, "-o" + output_dir]
+    if output_dir is None:
+        output_dir = os.path.join(os.path.dirname(archive_filepath),
+                                  get_filename(archive_filepath))
+    if transfer.is_streamable(archive_filepath):
+        print("Extracting...")
+        try:
+            with contextlib.closing(tarfile.open(archive_filepath)) as tar:
+                transfer.extract_tar(tar, output_dir)
+        except tarfile.TarError as e:
+            raise exceptions.ExtractionError(
+                    "Could not extract %s successfully. %s"
+                    % (os.path.basename(archive_filepath), e))
+        logger.debug("File successfully extracted to: %s", output_dir)
+        return
+    # Overwrite what an interrupted extraction may have left behind.
+    command = [exe, "x", archive_filepath, "-o" + output_dir, "-y"]
+    if threads:
+        command.append("-mmt=%i" % threads)
     try:
         print("Extracting...")
         p = subprocess.Popen(command, stdout=subprocess.PIPE,
                              stderr=subprocess.PIPE)
-    except WindowsError:
+    except OSError:
         print("Could not run " + exe)
         raise
     p.wait()
     if p.returncode != 0:
         process_output = get_process_output(process=p)
-        print("Could not extract successfully." + process_output)
-        # raise WindowsError
-        sys.exit()
-    logger.debug("File successfully extracted to: " + output_dir)
+        raise exceptions.ExtractionError(
+                "Could not extract %s successfully. %s"
+                % (os.path.basename(archive_filepath), process_output))
+    logger.debug("File successfully extracted to: %s", output_dir)
 
 
 def get_filename(filepath):
@@ -60,24 +99,109 @@ def get_filename(filepath):
 
 def delete_file(filepath):
     logger = logging.getLogger(__name__)
-    logger.debug("Deleting file: " + filepath)
+    logger.debug("Deleting file: %s", filepath)
     print("Deleting archive...")
     os.remove(filepath)
 
 
-def is_new(f, target_dir):
-    filename = get_filename(f)
-    if os.path.isdir(os.path.join(target_dir, filename)):
+class StageTimer(object):
+    """Accumulate the time spent in each stage of the update pipeline.
+
+    Stages may be timed from several threads at once. They are also recorded
+    as spans, children of the span open when the timer was created.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.totals = {}
+        self.counts = {}
+        self.span = spans.current()
+        self._lock = threading.Lock()
+
+    def time(self, stage, func, *args, **kwargs):
+        """Call `func` and add its duration to `stage`."""
+        start = time.time()
+        try:
+            with spans.span(stage, self.span):
+                return func(*args, **kwargs)
+        finally:
+            with self._lock:
+                self.totals[stage] = (self.totals.get(stage, 0.0)
+                                      + time.time() - start)
+                self.counts[stage] = self.counts.get(stage, 0) + 1
+
+    def pformat(self):
+        lines = ["Timings:"]
+        for stage in ('transfer', 'stream', 'delta', 'extract', 'delete'):
+            if stage in self.totals:
+                lines.append("  %-8s : %6.1f s (%i)" % (
+                        stage, self.totals[stage], self.counts[stage]))
+        lines.append("  %-8s : %6.1f s" % ('total', time.time() - self.start))
+        return '\n'.join(lines)
+
+
+def _clone(source, dest, size):
+    """Hard link, or else copy, an unchanged file of a previous build.
+
+    Returns:
+        bool: False if `source` is missing or was modified.
+    """
+    try:
+        if os.path.getsize(source) != size:
+            return False
+        utils.ensure_dir_exists(os.path.dirname(dest))
+        if os.path.exists(dest):
+            os.remove(dest)
+        try:
+            utils.hard_link(source, dest)
+        except OSError:
+            shutil.copy2(source, dest)
+    except EnvironmentError:
         return False
     return True
 
 
+def extraction_workers(config):
+    """Number of parallel extractions and 7-Zip threads for each of them.
+
+    Returns:
+        tuple : (workers, threads)
+    """
+    cpus = multiprocessing.cpu_count()
+    workers = config['extract_workers'] or cpus
+    threads = config['7z_threads'] or max(1, cpus // workers)
+    return workers, threads
+
+
+def new_items(items, target_dir):
+    """Items which are not installed in `target_dir` yet.
+
+    Installed items are looked up in the inventory, i.e. `target_dir` is only
+    scanned if it changed since the last time. Items which failed their last
+    verification are installed again.
+
+    Returns:
+        list
+    """
+    installed = inventory.Inventory().installed(target_dir)
+
+    def is_new(f):
+        name = get_filename(f)
+        if name not in installed:
+            return True
+        item_manifest = manifest.load(name)
+        return (item_manifest is not None
+                and item_manifest['status'] == manifest.CORRUPT)
+    return [f for f in items if is_new(f)]
+
+
 class _Updater(object):
 
     item_name = None
     item_name_plural = None
+    priority = None
 
-    def __init__(self, nx_version, config, source_key):
+    def __init__(self, nx_version, config, source_key, progress=True):
         self.logger = logging.getLogger(__name__)
         self.nx_version = nx_version.lower()
         try:
@@ -87,34 +211,268 @@ class _Updater(object):
             print("No configuration found for %s %s."
                   % (nx_version, self.item_name_plural))
             raise exceptions.NXToolsError
+        self.config = config
         self.delete_zip = config["delete_zip"]
         self.zip_exe = config['7z_exe']
+        self.stream_extract = config['stream_extract']
+        self.progress = progress
         self.new_items = None
+        self.scheduler = scheduler.get_scheduler(config)
+        # StageTimer of the last update.
+        self.timer = None
+        self._tickets = None
         utils.ensure_dir_exists(self.local_dir)
 
-    def _is_new(self, f):
-        return is_new(f, self.local_dir)
+    def _new_items(self, items):
+        return new_items(items, self.local_dir)
+
+    def span(self, phase):
+        """Span timing `phase`, e.g. 'check', of this updater."""
+        return spans.span('%s %s %s' % (phase, self.nx_version,
+                                        self.item_name))
+
+    def queue(self):
+        """Take the scheduler tickets of the transfers of the new items.
+
+        Done by `update` if not done before.
+        """
+        if self._tickets is None:
+            self._tickets = dict(
+                    (item, self.scheduler.submit(self.priority,
+                                                 self.item_size(item)))
+                    for item in self.new_items)
+
+    def claim(self):
+        """Claim the scheduler tickets of the new items, so that worse
+        transfers of other updaters wait for them, see `Scheduler.claim`.
+
+        Done by `update`, which must then run, if not done before. Only
+        claim before `update` if it runs in a thread of its own.
+        """
+        self.queue()
+        self.scheduler.claim(sorted(self._tickets.values()))
+
+    def _record(self, item, **fields):
+        inventory.Inventory().record(self.local_dir, get_filename(item),
+                                     source=os.path.basename(item), **fields)
 
     def update(self):
+        """Transfer and extract every new item.
+
+        Returns:
+            list: Names of the items that were installed.
+        """
         if self.new_items is None:
             self.check()
         if self.new_items == []:
+            self._tickets = None
             print("No new %s." % self.item_name)
-            return
+            return []
+        self.claim()
+        try:
+            return self._install_new()
+        finally:
+            # Left by a failure: worse transfers must not wait for them.
+            for ticket in self._tickets.values():
+                self.scheduler.cancel(ticket)
+            self._tickets = None
 
+    def _install_new(self):
+        """See `update`, once the tickets of the new items are claimed."""
         number = len(self.new_items)
         if number != 1:
             print("%i new %s found:" % (number, self.item_name_plural))
         else:
             print("One new %s found:" % self.item_name)
         print('\n'.join(map(get_filename, self.new_items)))
-        for item in self.new_items:
-            dest_zip = os.path.join(self.local_dir, os.path.basename(item))
-            self._transfer(item, dest_zip)
-            extract(dest_zip, exe=self.zip_exe)
-            if self.delete_zip == True:
-                delete_file(dest_zip)
+
+        # Transfers run one after the other in this thread, smallest first and
+        # when the scheduler allows, while archives already transferred are
+        # extracted by the pool in the meantime.
+        items = sorted(self.new_items, key=self._tickets.get)
+        # Make room first, extraction slows down on a nearly full disk.
+        prune.enforce(self.config, self.item_name, self.nx_version,
+                      archives=sum(t[2] or 0 for t in self._tickets.values()))
+        timer = self.timer = StageTimer()
+        workers, threads = extraction_workers(self.config)
+        pool = ThreadPool(min(workers, number), *_pool_args())
+        results = []
+        try:
+            for item in items:
+                dest_zip = os.path.join(self.local_dir,
+                                        os.path.basename(item))
+                with self.scheduler.transfer(self._tickets.pop(item)):
+                    if self._install_direct(item, dest_zip, threads, timer):
+                        continue
+                    if not self._is_transferred(dest_zip):
+                        sha256 = timer.time('transfer', self._fetch, item,
+                                            dest_zip)
+                        manifest.update(get_filename(item),
+                                        archive=os.path.basename(item),
+                                        size=os.path.getsize(dest_zip),
+                                        mtime=os.path.getmtime(dest_zip),
+                                        sha256=sha256,
+                                        status=manifest.TRANSFERRED)
+                results.append(pool.apply_async(
+                        self._extract, (dest_zip, threads, timer)))
+            pool.close()
+            errors = []
+            for result in results:
+                try:
+                    result.get()
+                except (exceptions.ExtractionError, EnvironmentError) as e:
+                    errors.append(e)
+        finally:
+            pool.terminate()
+            pool.join()
+        if errors:
+            raise errors[0]
         print("Success!")
+        print(timer.pformat())
+        return list(map(get_filename, self.new_items))
+
+    def _cache_url(self, item):
+        """URL of `item` on the `cache_server`, or None if there is none."""
+        server = self.config['cache_server']
+        if not server:
+            return None
+        return '%s/%s/%s/%s' % (server.rstrip('/'), self.item_name,
+                                self.nx_version,
+                                urllib.quote(os.path.basename(item)))
+
+    def _fetch(self, item, dest_file):
+        """Transfer `item` from the cache server, or else from the origin.
+
+        Returns:
+            str : SHA-256 hex digest of the file.
+        """
+        url = self._cache_url(item)
+        if url is not None:
+            print("Downloading from cache server...")
+            try:
+                return transfer.http_download(
+                        url, dest_file, blocksize=self.blocksize,
+                        retries=self.config['ftp_retries'],
+                        timeout=self.config['ftp_timeout'],
+                        progress=self.progress,
+                        throttle=self.scheduler.throttle)
+            except transfer.HTTP_ERRORS as e:
+                print("Cache server failed (%s), using the origin." % e)
+        return self._transfer(item, dest_file)
+
+    def _fetch_stream(self, item, write):
+        """Stream `item` from the cache server, or else from the origin.
+
+        Returns:
+            str : SHA-256 hex digest of the content.
+        """
+        url = self._cache_url(item)
+        if url is None:
+            return self._transfer_stream(item, write)
+        received = []
+
+        def tee(block):
+            received.append(len(block))
+            write(block)
+        try:
+            return transfer.http_stream(url, tee, blocksize=self.blocksize,
+                                        timeout=self.config['ftp_timeout'],
+                                        progress=self.progress,
+                                        throttle=self.scheduler.throttle)
+        except transfer.HTTP_ERRORS as e:
+            if received:
+                raise
+            print("Cache server failed (%s), using the origin." % e)
+        return self._transfer_stream(item, write)
+
+    def _is_transferred(self, dest_zip):
+        """Whether `dest_zip` is already here and matches its manifest.
+
+        This is the case when a previous update was interrupted after the
+        transfer. The archive is only hashed again if it was modified since
+        it was hashed while being transferred.
+        """
+        item_manifest = manifest.load(get_filename(dest_zip))
+        if (not os.path.isfile(dest_zip) or item_manifest is None
+                or not item_manifest['sha256']
+                or item_manifest['size'] != os.path.getsize(dest_zip)):
+            return False
+        if (item_manifest.get('mtime') != os.path.getmtime(dest_zip)
+                and transfer.file_digest(dest_zip).hexdigest()
+                != item_manifest['sha256']):
+            return False
+        print("%s already transferred." % os.path.basename(dest_zip))
+        return True
+
+    def _extract(self, dest_zip, threads, timer):
+        self._record(dest_zip, status=inventory.EXTRACTING,
+                     size=os.path.getsize(dest_zip))
+        members = None
+        if not transfer.is_streamable(dest_zip):
+            # Read before extraction, as the archive may be deleted after.
+            try:
+                members = sevenzip.list_members(dest_zip, self.zip_exe)
+            except (exceptions.ExtractionError, OSError) as e:
+                self.logger.debug("Could not list members: %s", e)
+        timer.time('extract', extract, dest_zip, exe=self.zip_exe,
+                   threads=threads)
+        self._installed(dest_zip, members)
+        if self.delete_zip == True:
+            timer.time('delete', delete_file, dest_zip)
+
+    def _installed(self, item, members=None, **fields):
+        """Record `item` as installed, with the manifest of its files.
+
+        Args:
+            members (dict): Files of the archive, see `manifest`. Computed
+                from the installed files if not given.
+        """
+        name = get_filename(item)
+        if members is None:
+            members = manifest.hash_tree(os.path.join(self.local_dir, name))
+        manifest.update(name, archive=os.path.basename(item),
+                        members=members, status=manifest.OK, **fields)
+        self._record(item, status=inventory.EXTRACTED)
+
+    def _install_direct(self, item, dest_zip, threads, timer):
+        """Install `item` without transferring its archive first.
+
+        Returns:
+            bool: False if `item` still needs to be transferred and extracted.
+        """
+        return (self.stream_extract and transfer.is_streamable(item)
+                and timer.time('stream', self._stream, item, dest_zip))
+
+    def _stream(self, item, dest_zip):
+        """Extract `item` while it is being transferred.
+
+        The archive itself is only kept if `delete_zip` is false.
+
+        Returns:
+            bool: False if streaming failed and a regular transfer is needed.
+        """
+        output_dir = os.path.join(self.local_dir, get_filename(item))
+        tee_file = None if self.delete_zip else dest_zip
+        print("Downloading and extracting...")
+        sink = transfer.StreamExtractor(output_dir, tee_file=tee_file)
+        self._record(item, status=inventory.EXTRACTING)
+        try:
+            sha256 = self._fetch_stream(item, sink.write)
+            sink.close()
+        except (tarfile.TarError,) + ftplib.all_errors as e:
+            sink.abort()
+            if isinstance(e, EOFError):
+                # ftplib raises it without a message.
+                reason = ("archive truncated, %s"
+                          % (str(e) or "connection closed"))
+            else:
+                reason = str(e) or e.__class__.__name__
+            print("Could not extract %s while downloading (%s)."
+                  % (os.path.basename(item), reason))
+            return False
+        self._installed(item, sha256=sha256, size=None)
+        self.logger.debug("File successfully extracted to: %s", output_dir)
+        return True
 
 
 def _check(updater, nx_version, config):
@@ -122,67 +480,187 @@ def _check(updater, nx_version, config):
         my_updater = updater(nx_version, config)
     except exceptions.NXToolsError:
         return False
-    return my_updater.check()
+    with my_updater.span('check'):
+        return my_updater.check()
+
 
+def check_items(updater, nx_version, config):
+    """Check for new items, timing the check.
 
-def _update(updater, nx_version, config):
+    Errors are caught and reported in the result, so that checks can run
+    concurrently.
+
+    Returns:
+        dict : new ({'name', 'size'} of every new item), latency (seconds)
+            and error (str or None); or None if `updater` is not configured
+            for `nx_version`.
+    """
+    start = time.time()
     try:
         my_updater = updater(nx_version, config)
+    except exceptions.NXToolsError:
+        return None
+    result = dict(new=[], error=None)
+    try:
+        with my_updater.span('check'):
+            found = my_updater.check()
+        if found:
+            result['new'] = [dict(name=get_filename(item),
+                                  size=my_updater.item_size(item))
+                             for item in my_updater.new_items]
+    except ((exceptions.NXToolsError, EnvironmentError)
+            + ftplib.all_errors) as e:
+        # EnvironmentError: e.g. OSError from an unreachable build share.
+        result['error'] = str(e) or e.__class__.__name__
+    result['latency'] = round(time.time() - start, 3)
+    return result
+
+
+def _update(updater, nx_version, config, **kwargs):
+    try:
+        my_updater = updater(nx_version, config, **kwargs)
     except exceptions.NXToolsError:
         return False
-    my_updater.update()
+    with my_updater.span('update'):
+        return my_updater.update()
 
 
 class _TMGUpdater(_Updater):
     item_name = 'patch'
     item_name_plural = 'patches'
+    priority = scheduler.PATCH
+
+    def __init__(self, nx_version, config, **kwargs):
+        super(_TMGUpdater, self).__init__(nx_version, config, 'patch',
+                                          **kwargs)
+        self.blocksize = config['ftp_blocksize']
+        self.retries = config['ftp_retries']
+        self.timeout = config['ftp_timeout']
+        self.segments = config['ftp_segments']
+        self.listing_ttl = config['listing_ttl']
+        self.upload_settle = config['upload_settle']
+        self.listings = cache.JSONCache('listings')
+        self.sizes = {}
+        self.uploading = []
+        self._ftp = None
 
-    def __init__(self, nx_version, config):
-        super(_TMGUpdater, self).__init__(nx_version, config, 'patch')
-        self._connect()
+    @property
+    def ftp(self):
+        """FTP session, only opened when first needed."""
+        if self._ftp is None:
+            self._ftp = self._connect()
+        return self._ftp
 
+    @ftp.setter
+    def ftp(self, value):
+        self._ftp = value
+
+    @spans.span('ftp connect')
     def _connect(self):
-        # print("Connecting to FTP server...")
-        ftp = ftplib.FTP('ftp')
-        ftp.login()
-        ftp.cwd(self.remote_dir)
-        self.ftp = ftp
+        return transfer.ftp_connect(self.config['ftp_host'], self.remote_dir,
+                                    self.timeout)
+
+    def keepalive(self):
+        """Keep the FTP session, if any, from timing out."""
+        if self._ftp is None:
+            return
+        try:
+            self._ftp.voidcmd('NOOP')
+        except ftplib.all_errors as e:
+            self.logger.debug("FTP session lost: %s", e)
+            self.close()
+
+    def close(self):
+        """Close the FTP session, if any. It is reopened when needed."""
+        if self._ftp is None:
+            return
+        try:
+            self._ftp.close()
+        except ftplib.all_errors:
+            pass
+        self._ftp = None
 
     def _find_windows_patches(self):
+        """List windows patches, skipping the ones still being uploaded.
+
+        The listing is cached for `listing_ttl` seconds, so that a `check`
+        followed by an `update` only lists the FTP directory once. A patch is
+        considered to be uploading if its size changed since the previous
+        listing, or if it was modified less than `upload_settle` seconds ago.
+
+        Returns:
+            list
+        """
         def is_windows(filename):
             return 'wntx64' in filename or 'win64' in filename
-        listings = []
-        self.ftp.retrlines("LIST", listings.append)
-        found = []
-        for listing in listings:
-            name = listing.split(None, 8)[-1].lstrip()
-            if is_windows(name):
-                found.append(name)
-        return found
+        key = 'ftp:' + self.remote_dir
+        listing, age = self.listings.get(key)
+        if listing is None or age > self.listing_ttl:
+            previous = listing['files'] if listing else {}
+            ftp = self.ftp
+            with spans.span('list'):
+                files = transfer.ftp_list(ftp, is_windows)
+            now = time.time()
+            uploading = sorted(
+                    name for name, entry in files.items()
+                    if (name in previous
+                        and previous[name]['size'] != entry['size'])
+                    or (entry['mtime'] is not None
+                        and now - entry['mtime'] < self.upload_settle))
+            listing = dict(files=files, uploading=uploading)
+            self.listings.set(key, listing)
+        else:
+            self.logger.debug("Using listing cached %.0f s ago", age)
+        self.sizes = dict((name, entry['size'])
+                          for name, entry in listing['files'].items())
+        self.uploading = listing['uploading']
+        for name in listing['uploading']:
+            print("Skipping %s: upload in progress." % name)
+        return sorted(name for name in listing['files']
+                      if name not in listing['uploading'])
+
+    def item_size(self, ftp_file):
+        """Size of `ftp_file` according to the last listing, if known."""
+        return self.sizes.get(ftp_file)
 
     def _transfer(self, ftp_file, dest_file):
         print("Downloading patch to local directory...")
-        self.logger.debug("Patch downloaded to: " + dest_file)
+        self.logger.debug("Patch downloaded to: %s", dest_file)
         try:
-            with open(dest_file, "wb") as fh:
-                self.ftp.retrbinary("RETR " + ftp_file, fh.write)
+            self.ftp, sha256 = transfer.ftp_download(
+                    self.ftp, ftp_file, dest_file, connect=self._connect,
+                    blocksize=self.blocksize, retries=self.retries,
+                    progress=self.progress, segments=self.segments,
+                    throttle=self.scheduler.throttle)
         except IOError:
             print("FATAL: Check local directory exists.")
             raise
+        return sha256
+
+    def _transfer_stream(self, ftp_file, write):
+        try:
+            return transfer.ftp_stream(self.ftp, ftp_file, write,
+                                       blocksize=self.blocksize,
+                                       progress=self.progress,
+                                       throttle=self.scheduler.throttle)
+        except (tarfile.TarError,) + ftplib.all_errors:
+            # The aborted transfer leaves the session in an unknown state.
+            # It is reopened when needed, even if that fails now.
+            self.close()
+            raise
 
     def check(self):
         self.new_items = []
-        self.logger.debug("Checking for %s patch on FTP server..." %
+        self.logger.debug("Checking for %s patch on FTP server...",
                           self.nx_version.upper())
         windows_patches = self._find_windows_patches()
         if windows_patches == []:
             print("Could not find windows patch.")
             return False
 
-        new_patches = [patch for patch in windows_patches
-                       if self._is_new(patch)]
+        new_patches = self._new_items(windows_patches)
         if new_patches == []:
-            self.logger.debug("Not new patch:\n%r" % windows_patches)
+            self.logger.debug("Not new patch:\n%r", windows_patches)
             return False
 
         self.new_items = new_patches
@@ -193,44 +671,163 @@ def check_TMG(nx_version, config):
     return _check(_TMGUpdater, nx_version, config)
 
 
-def update_TMG(nx_version, config):
-    _update(_TMGUpdater, nx_version, config)
+def update_TMG(nx_version, config, **kwargs):
+    return _update(_TMGUpdater, nx_version, config, **kwargs)
 
 
 class _BuildUpdater(_Updater):
     item_name = 'build'
     item_name_plural = 'builds'
-    def __init__(self, nx_version, config):
-        super(_BuildUpdater, self).__init__(nx_version, config, 'build')
+    priority = scheduler.BUILD
+    def __init__(self, nx_version, config, **kwargs):
+        super(_BuildUpdater, self).__init__(nx_version, config, 'build',
+                                            **kwargs)
+        self.blocksize = config['copy_blocksize']
+        self.copy_readers = config['copy_readers']
+        self.verify_copy = config['verify_copy']
+        self.delta_builds = config['delta_builds']
+
+    def update(self):
+        installed = super(_BuildUpdater, self).update()
+        if installed and self.config['dedupe_builds']:
+            print("Deduplicating builds...")
+            # The builds are installed already, whatever happens here.
+            try:
+                with spans.span('dedupe'):
+                    dedupe.dedupe(self.config, self.local_dir)
+            except EnvironmentError as e:
+                print("Could not deduplicate builds: %s" % e)
+        return installed
+
+    def _install_direct(self, item, dest_zip, threads, timer):
+        if self.delta_builds and timer.time('delta', self._delta, item,
+                                            threads):
+            return True
+        return super(_BuildUpdater, self)._install_direct(
+                item, dest_zip, threads, timer)
+
+    def _previous_build(self):
+        """Newest installed build which has a manifest.
+
+        Returns:
+            tuple : (name, manifest), or (None, None)
+        """
+        installed = inventory.Inventory().installed(self.local_dir)
+        for name in sorted(installed, reverse=True):
+            previous = manifest.load(name)
+            if previous is not None and previous['members'] is not None:
+                return name, previous
+        return None, None
 
+    def _delta(self, item, threads):
+        """Install `item` from the newest local build and its changes only.
+
+        The members of the remote archive are compared with the manifest of
+        the newest local build, by size and CRC. Unchanged files are hard
+        linked (or copied) from that build, and only the changed ones are
+        extracted, straight from the remote archive.
+
+        Returns:
+            bool: False if there is no previous build to start from.
+        """
+        previous_name, previous = self._previous_build()
+        if previous is None:
+            self.logger.debug("No previous build manifest, full update.")
+            return False
+        name = get_filename(item)
+        try:
+            members, dirs = sevenzip.list_archive(item, self.zip_exe)
+        except (exceptions.ExtractionError, OSError) as e:
+            print("Could not list %s (%s), full update."
+                  % (os.path.basename(item), e))
+            return False
+
+        previous_dir = os.path.join(self.local_dir, previous_name)
+        output_dir = os.path.join(self.local_dir, name)
+        self._record(item, status=inventory.EXTRACTING)
+        # Empty ones included, as a full extraction would.
+        for path in dirs:
+            directory = os.path.join(output_dir, path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        changed = []
+        for path, (size, crc) in members.items():
+            source = os.path.join(previous_dir, path)
+            if (previous['members'].get(path) != [size, crc] or not crc
+                    or not _clone(source, os.path.join(output_dir, path),
+                                  size)):
+                changed.append(path)
+        print("Delta update from %s: %i of %i files changed."
+              % (previous_name, len(changed), len(members)))
+        if changed:
+            sevenzip.extract_members(item, output_dir, changed,
+                                     exe=self.zip_exe, threads=threads)
+        self._installed(item, members)
+        return True
+
+    def install_remote(self, item):
+        """Install `item` straight from its remote archive, which is not
+        copied first.
+
+        Unchanged files are taken from the newest local build when possible,
+        see `_delta`.
+        """
+        _, threads = extraction_workers(self.config)
+        if self._delta(item, threads):
+            return
+        self._record(item, status=inventory.EXTRACTING)
+        members = None
+        if not transfer.is_streamable(item):
+            try:
+                members = sevenzip.list_members(item, self.zip_exe)
+            except (exceptions.ExtractionError, OSError) as e:
+                self.logger.debug("Could not list members: %s", e)
+        extract(item, exe=self.zip_exe, threads=threads,
+                output_dir=os.path.join(self.local_dir, get_filename(item)))
+        self._installed(item, members)
+
+    def item_size(self, src):
+        return os.path.getsize(src)
+
+    @spans.span('list')
     def _find_builds(self):
         if not os.path.exists(self.remote_dir):
             raise IOError
 
-        zips = list(glob.glob(os.path.join(self.remote_dir, "*.7z")))
+        zips = []
+        for pattern in ARCHIVE_PATTERNS:
+            zips.extend(glob.glob(os.path.join(self.remote_dir, pattern)))
         return zips
 
     def _transfer(self, src, dest):
         print("Copying to local directory...")
-        self.logger.debug("Copying: {0}\nto: {1}".format(src, dest))
+        self.logger.debug("Copying: %s\nto: %s", src, dest)
         try:
-            shutil.copy(src, dest)
-        except IOError as e:
-            print('Could not copy\n%s' % e)
-            sys.exit(1)
+            return transfer.copy_file(src, dest, blocksize=self.blocksize,
+                                      readers=self.copy_readers,
+                                      verify=self.verify_copy,
+                                      progress=self.progress,
+                                      throttle=self.scheduler.throttle)
+        except (EnvironmentError, exceptions.TransferError) as e:
+            raise exceptions.TransferError('Could not copy\n%s' % e)
+
+    def _transfer_stream(self, src, write):
+        return transfer.file_stream(src, write, blocksize=self.blocksize,
+                                    progress=self.progress,
+                                    throttle=self.scheduler.throttle)
 
     def check(self):
         self.new_items = []
-        self.logger.debug("Checking for %s build in Luc's T drive..."
-                          % self.nx_version.upper())
+        self.logger.debug("Checking for %s build in Luc's T drive...",
+                          self.nx_version.upper())
         try:
             builds = self._find_builds()
         except IOError:
             print("Can't find remote directory: %s" % self.remote_dir)
             return False
-        new_builds = [build for build in builds if self._is_new(build)]
+        new_builds = self._new_items(builds)
         if new_builds == []:
-            self.logger.debug("Not new build:\n%r" % builds)
+            self.logger.debug("Not new build:\n%r", builds)
             return False
 
         self.new_items = new_builds
@@ -252,26 +849,321 @@ def check_build(nx_version, config):
     return _check(_BuildUpdater, nx_version, config)
 
 
-def update_build(nx_version, config):
-    _update(_BuildUpdater, nx_version, config)
+def update_build(nx_version, config, **kwargs):
+    return _update(_BuildUpdater, nx_version, config, **kwargs)
+
+
+@spans.span('install from share')
+def install_from_share(nx_version, config, archive):
+    """Install the build `archive` without copying it first.
+
+    See `_BuildUpdater.install_remote`.
+    """
+    _BuildUpdater(nx_version, config).install_remote(archive)
+
+
+def materialize(nx_version, archive, config=None):
+    """Copy and extract the build `archive`, e.g. in the background.
+
+    Args:
+        config (dict): Read from the configuration files by default.
+
+    Returns:
+        list: Names of the items that were installed.
+    """
+    config = config or utils.read_config()
+    updater = _BuildUpdater(nx_version, config, progress=False)
+    if (get_filename(archive)
+            in inventory.Inventory().installed(updater.local_dir)):
+        return []
+    updater.new_items = [archive]
+    return updater.update()
+
+
+_UPDATERS = {'build': _BuildUpdater, 'patch': _TMGUpdater}
+
+
+def remote_versions(config):
+    """All NX versions with a remote build or patch source.
+
+    Returns:
+        list
+    """
+    remote = config['remote']
+    return sorted(set(remote['build']) | set(remote['patch']))
+
+
+_JOB_ERRORS = ((exceptions.NXToolsError, EnvironmentError, SystemExit)
+               + ftplib.all_errors)
+
+
+class _LabelledOutput(object):
+    """Stream prefixing the lines written by a thread with its label.
+
+    Lines are written whole, so that the output of concurrent updaters does
+    not interleave within a line. Threads without a label write through.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def label(self, text):
+        """Prefix the lines written by this thread with `text`."""
+        self._set_prefix('[%s] ' % text)
+        try:
+            yield
+        finally:
+            if self._local.pending:
+                self.write('\n')
+            self._local.prefix = None
+
+    def _set_prefix(self, prefix):
+        self._local.prefix = prefix
+        self._local.pending = ''
+
+    def inherit(self):
+        """Arguments of a ThreadPool whose threads get the label of this
+        thread."""
+        return self._set_prefix, (getattr(self._local, 'prefix', None),)
+
+    def write(self, data):
+        prefix = getattr(self._local, 'prefix', None)
+        if prefix is None:
+            with self._lock:
+                self.stream.write(data)
+            return
+        lines = (self._local.pending + data).split('\n')
+        self._local.pending = lines.pop()
+        if lines:
+            with self._lock:
+                self.stream.write(''.join(prefix + line + '\n'
+                                          for line in lines))
+
+    def flush(self):
+        with self._lock:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def _pool_args():
+    """Arguments of the ThreadPools of an updater, see `_LabelledOutput`."""
+    if isinstance(sys.stdout, _LabelledOutput):
+        return sys.stdout.inherit()
+    return ()
+
+
+def _prepare_update_job(job, progress=False):
+    """Check a single (kind, nx_version) job and queue its transfers.
+
+    Returns:
+        tuple : (job, updater or None, error or None). The updater is None
+            if not configured, or if the check failed.
+    """
+    kind, nx_version, config = job
+    try:
+        updater = _UPDATERS[kind](nx_version, config, progress=progress)
+    except exceptions.NXToolsError:
+        return job, None, None
+    try:
+        with updater.span('check'):
+            updater.check()
+        updater.queue()
+    except _JOB_ERRORS as e:
+        return job, None, e
+    return job, updater, None
+
+
+def _run_update_job(prepared):
+    """Run a single (kind, nx_version) update inside a worker thread.
+
+    Errors are caught so that one failing version does not abort the others.
+
+    Returns:
+        tuple : (job, installed items, False if not configured or None,
+                 error or None)
+    """
+    job, updater, error = prepared
+    if error is not None:
+        return job, None, error
+    if updater is None:
+        return job, False, None
+    try:
+        with updater.span('update'):
+            return job, updater.update(), None
+    except _JOB_ERRORS as e:
+        return job, None, e
+
+
+def update_jobs(jobs, workers):
+    """Update (kind, nx_version, config) `jobs` concurrently.
+
+    Every job runs in its own thread of a pool bounded by `workers`, so the
+    total time is set by the slowest one. All of them are checked first.
+    Transfers waiting for the shared scheduler then run patches first, then
+    smallest first. When there are several jobs, their output lines are
+    prefixed with their NX version and kind.
+
+    Returns:
+        list : (kind, nx_version, installed items, False if not configured
+                or None, error or None)
+    """
+    if not jobs:
+        return []
+    if len(jobs) == 1:
+        prepared = _prepare_update_job(jobs[0], progress=True)
+        results = [_run_update_job(prepared)]
+    else:
+        output = _LabelledOutput(sys.stdout)
+
+        def prepare(job):
+            with output.label('%s %s' % (job[1], job[0])):
+                # Live progress reports would garble each other.
+                return _prepare_update_job(job)
+
+        def run(prepared):
+            job = prepared[0]
+            with output.label('%s %s' % (job[1], job[0])):
+                return _run_update_job(prepared)
+        pool = ThreadPool(min(workers, len(jobs)))
+        sys.stdout = output
+        try:
+            prepared = pool.map(prepare, jobs)
+            if workers >= len(jobs):
+                # Every updater runs at once: claim their transfers before
+                # the first one starts, see `Scheduler.claim`.
+                for _, updater, _ in prepared:
+                    if updater is not None and updater.new_items:
+                        updater.claim()
+            results = pool.map(run, prepared)
+        finally:
+            sys.stdout = output.stream
+            pool.close()
+            pool.join()
+    return [(kind, nx_version, items, error)
+            for (kind, nx_version, _), items, error in results]
+
+
+def update_all(config, workers, builds=True, patches=True):
+    """Update builds and patches of every configured NX version concurrently.
+
+    See `update_jobs`.
+
+    Returns:
+        list : (kind, nx_version, installed items or None, error or None)
+    """
+    jobs = []
+    for nx_version in remote_versions(config):
+        if builds and not is_frozen_build(nx_version, config):
+            jobs.append(('build', nx_version, config))
+        if patches and nx_version in config['remote']['patch']:
+            jobs.append(('patch', nx_version, config))
+    return update_jobs(jobs, workers)
+
+
+def pformat_summary(results):
+    """Pretty format the results of `update_all`."""
+    lines = ["Summary:"]
+    for kind, nx_version, items, error in results:
+        if error is not None:
+            status = "FAILED (%s)" % (str(error) or error.__class__.__name__)
+        elif items is False:
+            status = "not configured"
+        elif not items:
+            status = "up to date"
+        else:
+            status = "%i new -- %s" % (len(items), ', '.join(items))
+        lines.append("  %s %s : %s" % (nx_version, kind, status))
+    return '\n'.join(lines)
+
+
+def check_all(config, versions, workers):
+    """Check builds and patches of `versions` concurrently.
+
+    Returns:
+        dict : {nx_version: {'build': result, 'patch': result}}, see
+            `check_items`. Frozen builds are not checked, i.e. None.
+    """
+    jobs = []
+    for nx_version in versions:
+        if not is_frozen_build(nx_version, config):
+            jobs.append((nx_version, 'build', _BuildUpdater))
+        jobs.append((nx_version, 'patch', _TMGUpdater))
+    status = dict((nx_version, dict(build=None, patch=None))
+                  for nx_version in versions)
+    if not jobs:
+        return status
+    pool = ThreadPool(min(workers, len(jobs)))
+    try:
+        results = pool.map(
+                lambda job: check_items(job[2], job[0], config), jobs)
+    finally:
+        pool.close()
+        pool.join()
+    for (nx_version, kind, _), result in zip(jobs, results):
+        status[nx_version][kind] = result
+    return status
+
+
+@contextlib.contextmanager
+def _stdout_to_stderr():
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        yield
+    finally:
+        sys.stdout = stdout
 
 
 @click.command('check', short_help="Used internally by the Task Scheduler.")
-@click.argument('nx_version', nargs=1)
+@click.argument('nx_version', nargs=1, required=False)
+@click.option('--all', 'all_versions', is_flag=True,
+              help="Check every configured NX version.")
+@click.option('--json', 'as_json', is_flag=True,
+              help="Print the status of every check as JSON.")
 @click.pass_obj
-def check_cli(config, nx_version):
+def check_cli(config, nx_version, all_versions, as_json):
     """
     Return Codes:
         200 : Nothing new
         201 : New Build
         202 : New Patch
         203 : Both New Build and New Patch
+
+    With --all, the return code covers every configured NX version.
     """
-    new_build = False
-    new_patch = False
-    if not is_frozen_build(nx_version, config):
-        new_build = check_build(nx_version, config)
-    new_patch = check_TMG(nx_version, config)
+    if all_versions and nx_version is not None:
+        raise click.UsageError("--all cannot be used with an NX version.")
+    if all_versions:
+        versions = remote_versions(config)
+    elif nx_version is not None:
+        versions = [nx_version]
+    else:
+        raise click.UsageError("Missing argument \"nx_version\".")
+    if as_json:
+        # Keep stdout for the JSON document.
+        with _stdout_to_stderr():
+            status = check_all(config, versions, config['update_workers'])
+        print(json.dumps(status, indent=4, sort_keys=True))
+    else:
+        status = check_all(config, versions, config['update_workers'])
+
+    def any_new(kind):
+        return any(checks[kind] and checks[kind]['new']
+                   for checks in status.values())
+    new_build = any_new('build')
+    new_patch = any_new('patch')
+    if as_json:
+        sys.exit(200 + new_build + 2 * new_patch)
+    for nx_version, checks in sorted(status.items()):
+        for kind, result in sorted(checks.items()):
+            if result and result['error']:
+                print("%s %s check failed: %s"
+                      % (nx_version, kind, result['error']), file=sys.stderr)
     if new_build and new_patch:
         print("New Build and Patch Available.")
         sys.exit(203)
@@ -285,16 +1177,41 @@ def check_cli(config, nx_version):
     sys.exit(200)
 
 @click.command('update', short_help='Updater.')
-@click.argument('nx_version', nargs=1)
+@click.argument('nx_version', nargs=1, required=False)
 @click.option('--build', is_flag=True,
               help="Only update build.")
 @click.option('--patch', is_flag=True,
               help="Only update patch.")
+@click.option('--all', 'all_versions', is_flag=True,
+              help="Update every configured NX version concurrently.")
+@click.option('-j', '--jobs', type=click.IntRange(min=1),
+              help="Number of concurrent updaters used by --all.")
 @click.pass_obj
-def update_cli(config, nx_version, build, patch):
+def update_cli(config, nx_version, build, patch, all_versions, jobs):
     logger = logging.getLogger(__name__)
     logger.debug(utils.pformat_cli_args(locals()))
+    if all_versions and nx_version is not None:
+        raise click.UsageError("--all cannot be used with an NX version.")
+    if all_versions:
+        results = update_all(config, jobs or config['update_workers'],
+                             builds=not patch, patches=not build)
+        print(pformat_summary(results))
+        if any(error is not None for _, _, _, error in results):
+            sys.exit(1)
+        return
+    if nx_version is None:
+        raise click.UsageError("Missing argument \"nx_version\".")
+    version_jobs = []
     if not patch and not is_frozen_build(nx_version, config):
-        update_build(nx_version, config)
+        version_jobs.append(('build', nx_version, config))
     if not build:
-        update_TMG(nx_version, config)
+        version_jobs.append(('patch', nx_version, config))
+    # Concurrently, so that the patch is not transferred after the build.
+    failed = False
+    for _, _, items, error in update_jobs(version_jobs, len(version_jobs)):
+        if error is not None and str(error):
+            print(error)
+        # Not configured: the updater said so.
+        failed = failed or items is False or error is not None
+    if failed:
+        sys.exit(1)
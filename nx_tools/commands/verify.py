@@ -0,0 +1,80 @@
+"""
+Verification of installed builds and patches against their manifests.
+"""
+from __future__ import print_function
+
+import click
+import logging
+import os
+import sys
+
+from .. import inventory
+from .. import manifest
+from .. import utils
+
+
+def local_roots(config, versions, builds=True, patches=True):
+    """Local build and patch directories of `versions`, frozen builds aside.
+
+    Returns:
+        list
+    """
+    keys = [k for k, wanted in (('build', builds), ('patch', patches))
+            if wanted]
+    roots = []
+    for key in keys:
+        for version in versions:
+            root = config['local'][key].get(version)
+            if root and not utils.is_exe(root) and os.path.isdir(root):
+                roots.append(root)
+    return sorted(set(roots))
+
+
+@click.command('verify', short_help='Verify installed builds and patches.')
+@click.argument('nx_version', nargs=1, required=False)
+@click.option('--all', 'all_versions', is_flag=True,
+              help="Verify every NX version.")
+@click.option('--build', is_flag=True,
+              help="Only verify builds.")
+@click.option('--patch', is_flag=True,
+              help="Only verify patches.")
+@click.pass_obj
+def cli(config, nx_version, all_versions, build, patch):
+    """Re-hash installed files, in parallel, and compare them with the
+    manifests written by the updater. Corrupted items are installed again by
+    the next update.
+    """
+    logger = logging.getLogger(__name__)
+    logger.debug(utils.pformat_cli_args(locals()))
+    if all_versions:
+        versions = (set(config['local']['build'])
+                    | set(config['local']['patch']))
+    elif nx_version is not None:
+        versions = [nx_version]
+    else:
+        raise click.UsageError("Missing argument \"nx_version\".")
+
+    corrupt = 0
+    workers = manifest.pool()
+    try:
+        for root in local_roots(config, versions, builds=not patch,
+                                patches=not build):
+            for name in sorted(inventory.Inventory().installed(root)):
+                problems = manifest.verify(name, root, workers)
+                if problems is None:
+                    logger.debug("No manifest for %s", name)
+                    continue
+                if not problems:
+                    print("%s: OK" % name)
+                    continue
+                corrupt += 1
+                print("%s: CORRUPT" % name)
+                for path, problem in problems:
+                    print("    %s: %s" % (path, problem))
+    finally:
+        workers.close()
+        workers.join()
+    if corrupt:
+        print("%i corrupted item(s) will be installed again by the next "
+              "update." % corrupt)
+        sys.exit(1)
@@ -0,0 +1,371 @@
+"""
+Resident update watcher.
+
+Every configured build and patch source is watched by its own thread, which
+keeps its updater (and, for patches, its FTP session) between checks:
+
+- Build directories are watched with FindFirstChangeNotificationW on Windows,
+  or by polling their modification time elsewhere. A full check still runs
+  every `watch_max_interval` seconds in case a notification was missed.
+- FTP directories are polled. The interval starts at `watch_min_interval`,
+  doubles after every check that found nothing, up to `watch_max_interval`,
+  and is randomized by `watch_jitter` so that clients do not poll in sync.
+  The session is kept alive with NOOP every `watch_keepalive` seconds.
+
+The state of every source is checkpointed under USER_ROOT, so that a
+restarted watcher resumes its intervals and does not announce again the
+items it already announced.
+"""
+from __future__ import print_function
+
+import click
+import ctypes
+import ftplib
+import logging
+import os
+import random
+import threading
+import time
+
+from .. import exceptions
+from .. import utils
+from ..cache import JSONCache
+from ..constants import USER_ROOT
+from . import update
+
+# Granularity of the waits, so that the watcher stops promptly.
+_TICK = 1.0
+# Modification time polling interval, when notifications are not available.
+_STAT_INTERVAL = 10.0
+# Only one update at a time, whatever the source.
+_update_lock = threading.Lock()
+
+
+class _StatNotifier(object):
+    """Detects changes to a directory by polling its modification time."""
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = self._getmtime()
+        self.checked = time.time()
+
+    def _getmtime(self):
+        try:
+            return os.path.getmtime(self.path)
+        except OSError:
+            return None
+
+    def wait(self, timeout):
+        """Wait at most `timeout` seconds for a change.
+
+        The directory is stat'ed at most every _STAT_INTERVAL seconds,
+        however short the timeouts.
+
+        Returns:
+            bool : Whether the directory changed.
+        """
+        deadline = time.time() + timeout
+        while True:
+            now = time.time()
+            if now - self.checked >= _STAT_INTERVAL:
+                self.checked = now
+                mtime = self._getmtime()
+                if mtime != self.mtime:
+                    self.mtime = mtime
+                    return True
+            if now >= deadline:
+                return False
+            time.sleep(min(deadline, self.checked + _STAT_INTERVAL) - now)
+
+    def close(self):
+        pass
+
+
+class _WindowsNotifier(object):
+    """Detects changes to a directory with FindFirstChangeNotificationW.
+
+    Raises:
+        OSError: If the directory cannot be watched, e.g. some network shares.
+    """
+    FILE_NOTIFY_CHANGE_FILE_NAME = 0x01
+    FILE_NOTIFY_CHANGE_SIZE = 0x08
+    FILE_NOTIFY_CHANGE_LAST_WRITE = 0x10
+    WAIT_OBJECT_0 = 0
+    INVALID_HANDLE_VALUE = ctypes.c_void_p(-1).value
+
+    def __init__(self, path):
+        from ctypes import wintypes
+        self.kernel32 = ctypes.windll.kernel32
+        self.kernel32.FindFirstChangeNotificationW.argtypes = [
+                wintypes.LPCWSTR, wintypes.BOOL, wintypes.DWORD]
+        self.kernel32.FindFirstChangeNotificationW.restype = ctypes.c_void_p
+        self.kernel32.FindNextChangeNotification.argtypes = [ctypes.c_void_p]
+        self.kernel32.FindCloseChangeNotification.argtypes = [ctypes.c_void_p]
+        self.kernel32.WaitForSingleObject.argtypes = [ctypes.c_void_p,
+                                                      wintypes.DWORD]
+        self.kernel32.WaitForSingleObject.restype = wintypes.DWORD
+        flags = (self.FILE_NOTIFY_CHANGE_FILE_NAME
+                 | self.FILE_NOTIFY_CHANGE_SIZE
+                 | self.FILE_NOTIFY_CHANGE_LAST_WRITE)
+        self.handle = self.kernel32.FindFirstChangeNotificationW(
+                path, False, flags)
+        if self.handle in (None, self.INVALID_HANDLE_VALUE):
+            raise ctypes.WinError()
+
+    def wait(self, timeout):
+        ret = self.kernel32.WaitForSingleObject(self.handle,
+                                                int(timeout * 1000))
+        if ret != self.WAIT_OBJECT_0:
+            return False
+        self.kernel32.FindNextChangeNotification(self.handle)
+        return True
+
+    def close(self):
+        self.kernel32.FindCloseChangeNotification(self.handle)
+
+
+def make_notifier(path):
+    """Best available notifier for `path`."""
+    logger = logging.getLogger(__name__)
+    if os.name == 'nt':
+        try:
+            return _WindowsNotifier(path)
+        except (OSError, AttributeError) as e:
+            logger.debug("Polling %s instead: %s", path, e)
+    return _StatNotifier(path)
+
+
+class _Source(threading.Thread):
+    """Watches one build or patch source.
+
+    Args:
+        key (str): e.g. 'nx11:patch', identifies the source in the state.
+        updater (update._Updater)
+        state (dict): Checkpointed state of this source.
+    """
+    errors = (exceptions.NXToolsError, EnvironmentError)
+
+    def __init__(self, key, updater, config, state, save, stop,
+                 auto_update=False):
+        super(_Source, self).__init__(name=key)
+        self.daemon = True
+        self.logger = logging.getLogger(__name__)
+        self.key = key
+        self.updater = updater
+        self.min_interval = config['watch_min_interval']
+        self.max_interval = config['watch_max_interval']
+        self.jitter = config['watch_jitter']
+        self.state = state
+        self.state.setdefault('interval', self.min_interval)
+        self.state.setdefault('announced', [])
+        self.save = save
+        self.stop = stop
+        self.auto_update = auto_update
+
+    def jittered(self, interval):
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def next_interval(self, changed):
+        """Back off while nothing changes, poll often after a change."""
+        if changed:
+            interval = self.min_interval
+        else:
+            interval = min(self.state['interval'] * 2, self.max_interval)
+        self.state['interval'] = interval
+        return self.jittered(interval)
+
+    def wait(self, timeout):
+        """Wait `timeout` seconds, or less if a change is detected.
+
+        Returns:
+            bool : Whether a change was detected.
+        """
+        self.stop.wait(timeout)
+        return False
+
+    def poll(self):
+        """Check the source, announce and optionally install new items.
+
+        Returns:
+            bool : Whether something changed.
+        """
+        self.state['last_check'] = time.time()
+        self.state['error'] = None
+        try:
+            with self.updater.span('check'):
+                found = self.updater.check()
+        except self.errors as e:
+            self.state['error'] = str(e) or e.__class__.__name__
+            self.logger.debug("%s check failed: %s", self.key, e)
+            self.reset()
+            return False
+        names = sorted(map(update.get_filename, self.updater.new_items))
+        fresh = [name for name in names if name not in self.state['announced']]
+        self.state['announced'] = names
+        if fresh:
+            self.state['last_change'] = time.time()
+            print("%s  %s: new %s:\n%s"
+                  % (time.strftime('%Y-%m-%d %H:%M'), self.key,
+                     self.updater.item_name, '\n'.join(fresh)))
+        if found and self.auto_update:
+            with _update_lock:
+                try:
+                    with self.updater.span('update'):
+                        self.updater.update()
+                except self.errors as e:
+                    self.state['error'] = str(e) or e.__class__.__name__
+                    print("%s: update failed: %s" % (self.key, e))
+        return bool(fresh)
+
+    def run(self):
+        try:
+            while not self.stop.is_set():
+                changed = self.poll()
+                self.save(self.key, self.state)
+                delay = self.next_interval(changed)
+                self.logger.debug("%s: next check in %.0f s", self.key, delay)
+                self.wait(delay)
+        finally:
+            self.close()
+
+    def reset(self):
+        """Drop whatever state a failed check may have left behind."""
+        pass
+
+    def close(self):
+        pass
+
+
+class _BuildSource(_Source):
+
+    def __init__(self, *args, **kwargs):
+        super(_BuildSource, self).__init__(*args, **kwargs)
+        self.settle = self.updater.config['upload_settle']
+        self.notifier = make_notifier(self.updater.remote_dir)
+
+    def _wait_change(self, timeout):
+        deadline = time.time() + timeout
+        while not self.stop.is_set():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            if self.notifier.wait(min(_TICK, remaining)):
+                return True
+        return False
+
+    def wait(self, timeout):
+        if not self._wait_change(timeout):
+            return False
+        # Wait for the copy of the new build to the share to complete.
+        self.logger.debug("%s changed, waiting for it to settle", self.key)
+        while self._wait_change(self.settle):
+            pass
+        return True
+
+    def next_interval(self, changed):
+        # Changes are notified: only poll now and then in case one was lost.
+        return self.jittered(self.max_interval)
+
+    def close(self):
+        self.notifier.close()
+
+
+class _PatchSource(_Source):
+    errors = _Source.errors + ftplib.all_errors
+
+    def __init__(self, *args, **kwargs):
+        super(_PatchSource, self).__init__(*args, **kwargs)
+        self.keepalive = self.updater.config['watch_keepalive']
+        # The watcher decides when to list the server.
+        self.updater.listing_ttl = 0
+
+    def next_interval(self, changed):
+        # Patches being uploaded will be ready soon.
+        return super(_PatchSource, self).next_interval(
+                changed or bool(self.updater.uploading))
+
+    def wait(self, timeout):
+        deadline = time.time() + timeout
+        while not self.stop.is_set():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            self.stop.wait(min(self.keepalive, remaining))
+            if not self.stop.is_set():
+                self.updater.keepalive()
+        return False
+
+    def reset(self):
+        # The next check reconnects.
+        self.updater.close()
+
+    def close(self):
+        self.updater.close()
+
+
+class Watcher(object):
+    """Watches the sources of `versions` until interrupted."""
+
+    def __init__(self, config, versions, auto_update=False):
+        self.logger = logging.getLogger(__name__)
+        self.checkpoint = JSONCache('watch', cache_dir=USER_ROOT)
+        self.stop = threading.Event()
+        self.sources = []
+        for nx_version in versions:
+            kinds = [('patch', update._TMGUpdater, _PatchSource)]
+            if not update.is_frozen_build(nx_version, config):
+                kinds.insert(0, ('build', update._BuildUpdater, _BuildSource))
+            for kind, updater_cls, source_cls in kinds:
+                key = '%s:%s' % (nx_version, kind)
+                try:
+                    updater = updater_cls(nx_version, config, progress=False)
+                except exceptions.NXToolsError:
+                    continue
+                state, _ = self.checkpoint.get(key)
+                self.sources.append(source_cls(
+                        key, updater, config, state or {}, self.save,
+                        self.stop, auto_update=auto_update))
+
+    def save(self, key, state):
+        self.checkpoint.set(key, state)
+
+    def run(self):
+        if not self.sources:
+            print("Nothing to watch.")
+            return
+        print("Watching %s. Press Ctrl+C to stop."
+              % ', '.join(source.key for source in self.sources))
+        for source in self.sources:
+            source.start()
+        try:
+            while any(source.is_alive() for source in self.sources):
+                # A timeout keeps the main thread responsive to Ctrl+C.
+                for source in self.sources:
+                    source.join(_TICK)
+        except KeyboardInterrupt:
+            print("Stopping...")
+        finally:
+            self.stop.set()
+            for source in self.sources:
+                source.join(_TICK * 5)
+
+
+@click.command('watch', short_help='Watch for new builds and patches.')
+@click.argument('nx_version', nargs=1, required=False)
+@click.option('--all', 'all_versions', is_flag=True,
+              help="Watch every configured NX version.")
+@click.option('--auto-update', is_flag=True,
+              help="Install new builds and patches as soon as they are "
+                   "found.")
+@click.pass_obj
+def cli(config, nx_version, all_versions, auto_update):
+    """Keep checking for new builds and patches, until interrupted."""
+    logger = logging.getLogger(__name__)
+    logger.debug(utils.pformat_cli_args(locals()))
+    if all_versions:
+        versions = update.remote_versions(config)
+    elif nx_version is not None:
+        versions = [nx_version]
+    else:
+        raise click.UsageError("Missing argument \"nx_version\".")
+    Watcher(config, versions, auto_update=auto_update).run()
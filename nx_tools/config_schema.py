@@ -0,0 +1,209 @@
+"""
+    nx_tools.config_schema
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Schema of the merged configuration.
+
+    The configuration is validated once, when it is merged (see
+    `utils.read_config`), so that a bad value is reported up front rather
+    than as a KeyError deep inside a command. Keys which are not in the
+    schema are ignored.
+"""
+import re
+
+from .exceptions import ConfigError
+
+
+class _Spec(object):
+    """Base of the specifications of configuration values."""
+
+    description = None
+
+    def errors(self, value, path):
+        """Problems with `value`, found at `path`.
+
+        Returns:
+            list : Messages, empty if `value` is valid.
+        """
+        if not self.check(value):
+            return self.mismatch(value, path)
+        return []
+
+    def mismatch(self, value, path):
+        return ["%s: expected %s, got %r" % (path, self.description, value)]
+
+    def check(self, value):
+        raise NotImplementedError
+
+
+class Str(_Spec):
+    description = "a string"
+
+    def check(self, value):
+        return isinstance(value, basestring)
+
+
+class Bool(_Spec):
+    description = "true or false"
+
+    def check(self, value):
+        return isinstance(value, bool)
+
+
+class Number(_Spec):
+    """Number greater than or equal to `minimum`."""
+
+    types = (int, long, float)
+    kind = "a number"
+
+    def __init__(self, minimum=0):
+        self.minimum = minimum
+        self.description = "%s >= %s" % (self.kind, minimum)
+
+    def check(self, value):
+        # JSON's true and false are ints to Python.
+        return (isinstance(value, self.types) and not isinstance(value, bool)
+                and value >= self.minimum)
+
+
+class Int(Number):
+    types = (int, long)
+    kind = "an integer"
+
+
+class Pattern(Str):
+    """String matching the regular expression `regex`."""
+
+    def __init__(self, regex, description):
+        self.regex = re.compile(regex)
+        self.description = description
+
+    def check(self, value):
+        return Str.check(self, value) and bool(self.regex.match(value))
+
+
+class Nullable(_Spec):
+    """`spec`, or null."""
+
+    def __init__(self, spec):
+        self.spec = spec
+
+    def errors(self, value, path):
+        if value is None:
+            return []
+        return self.spec.errors(value, path)
+
+
+class MapOf(_Spec):
+    """Object of values matching `spec`, e.g. by NX version."""
+
+    description = "an object"
+
+    def __init__(self, spec):
+        self.spec = spec
+
+    def errors(self, value, path):
+        if not isinstance(value, dict):
+            return self.mismatch(value, path)
+        errors = []
+        for key in sorted(value):
+            errors.extend(self.spec.errors(value[key],
+                                           '%s.%s' % (path, key)))
+        return errors
+
+
+class ListOf(_Spec):
+    """List of values matching `spec`."""
+
+    description = "a list"
+
+    def __init__(self, spec):
+        self.spec = spec
+
+    def errors(self, value, path):
+        if not isinstance(value, list):
+            return self.mismatch(value, path)
+        errors = []
+        for i, item in enumerate(value):
+            errors.extend(self.spec.errors(item, '%s[%i]' % (path, i)))
+        return errors
+
+
+class Struct(_Spec):
+    """Object with the keys of `fields`, each matching its spec."""
+
+    description = "an object"
+
+    def __init__(self, **fields):
+        self.fields = fields
+
+    def errors(self, value, path):
+        if not isinstance(value, dict):
+            return self.mismatch(value, path)
+        errors = []
+        for key in sorted(self.fields):
+            field_path = '%s.%s' % (path, key) if path else key
+            if key not in value:
+                errors.append("%s: missing" % field_path)
+            else:
+                errors.extend(self.fields[key].errors(value[key],
+                                                      field_path))
+        return errors
+
+
+_TIME = Pattern(r'^([01]?\d|2[0-3]):[0-5]\d$', "a time of day, HH:MM")
+_ROOTS = Struct(build=MapOf(Str()), patch=MapOf(Str()))
+
+SCHEMA = Struct(**{
+    '7z_exe': Str(),
+    '7z_threads': Nullable(Int(1)),
+    'cache_server': Nullable(Str()),
+    'copy_blocksize': Int(1),
+    'copy_readers': Int(1),
+    'dedupe_builds': Bool(),
+    'dedupe_store': Nullable(Str()),
+    'delete_zip': Bool(),
+    'delta_builds': Bool(),
+    'download_rate_limit': Nullable(Number(0)),
+    'download_rate_profiles': ListOf(Struct(start=_TIME, end=_TIME,
+                                            rate=Nullable(Number(0)))),
+    'download_slots': Int(1),
+    'extract_workers': Nullable(Int(1)),
+    'ftp_blocksize': Int(1),
+    'ftp_host': Str(),
+    'ftp_retries': Int(0),
+    'ftp_segments': Int(1),
+    'ftp_timeout': Number(0),
+    'identifier_hotkey': Str(),
+    'launch_stagger': Number(0),
+    'listing_ttl': Number(0),
+    'local': _ROOTS,
+    'remote': _ROOTS,
+    'retention_keep': Int(0),
+    'retention_quota': Struct(build=MapOf(Int(0)), patch=MapOf(Int(0))),
+    'serve_cache_dir': Nullable(Str()),
+    'serve_port': Int(1),
+    'start_in': Nullable(Str()),
+    'stream_extract': Bool(),
+    'update_workers': Int(1),
+    'upgrade_check_timeout': Number(0),
+    'upgrade_check_ttl': Number(0),
+    'upload_settle': Number(0),
+    'verify_copy': Bool(),
+    'watch_jitter': Number(0),
+    'watch_keepalive': Number(0),
+    'watch_max_interval': Number(0),
+    'watch_min_interval': Number(0),
+})
+
+
+def validate(config):
+    """Check `config` against SCHEMA.
+
+    Raises:
+        ConfigError: Listing every problem found.
+    """
+    errors = SCHEMA.errors(config, '')
+    if errors:
+        raise ConfigError("Invalid configuration:\n  " + "\n  ".join(errors),
+                          config)
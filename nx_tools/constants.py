@@ -1,15 +1,26 @@
 import os
-import pkg_resources
 
-PKG = pkg_resources.resource_filename(__name__, '')
+# The package is installed unzipped (zip_safe=False), so that its data files
+# are found next to this module.
+PKG = os.path.dirname(os.path.abspath(__file__))
 PKG_DATA = os.path.join(PKG, 'data')
 PKG_BIN = os.path.join(PKG, 'bin')
 DEFAULT_CONFIG_PATH = os.path.join(PKG_DATA, 'default_config.json')
 
-USER_ROOT = os.path.join('D:\\', '.nx_tools')
+# NX_TOOLS_ROOT relocates the user files, e.g. for benchmarks.
+USER_ROOT = (os.environ.get('NX_TOOLS_ROOT')
+             or os.path.join('D:\\', '.nx_tools'))
 USER_CONFIG_PATH = os.path.join(USER_ROOT, 'nx_tools.json')
+CACHE_DIR = os.path.join(USER_ROOT, 'cache')
+MANIFEST_DIR = os.path.join(USER_ROOT, 'manifests')
+# Merged and validated configuration.
+CONFIG_CACHE_PATH = os.path.join(CACHE_DIR, 'config.json')
 
 # History
+HISTORY_DIR = os.path.join(USER_ROOT, 'history')
+# Records per segment of the history, before it is compacted.
+HISTORY_SEGMENT_RECORDS = 1000
+# Ring buffer of earlier versions, migrated to HISTORY_DIR.
 HISTORY_PATH = os.path.join(USER_ROOT, 'history.json')
 HISTORY_MAX_RECORDS = 20
 
@@ -6,3 +6,22 @@ class NXToolsError(Exception):
 class UserConfigNotFound(NXToolsError):
     """User Configuration file not found"""
     pass
+
+
+class ExtractionError(NXToolsError):
+    """Archive could not be extracted"""
+    pass
+
+
+class TransferError(NXToolsError):
+    """File could not be transferred"""
+    pass
+
+
+class ConfigError(NXToolsError):
+    """Configuration does not match its schema"""
+
+    def __init__(self, message, config=None):
+        NXToolsError.__init__(self, message)
+        # The invalid configuration, e.g. for the commands fixing it.
+        self.config = config
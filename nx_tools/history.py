@@ -0,0 +1,417 @@
+"""
+    nx_tools.history
+    ~~~~~~~~~~~~~~~~
+
+    Launch history, stored in HISTORY_DIR.
+
+    Launches are appended, one JSON record per line, to numbered segments
+    ("history.<n>.jsonl"), under a lock shared by all processes. Each record
+    is a dict with keys:
+        PID (int): Process ID of ugraf.exe.
+        nx_version (str)
+        build (str): Name of the build directory.
+        patch (str): Name of the patch directory, "" if vanilla.
+        name (str): Name given to the process, if any.
+        time (float): Launch time. Missing from older records.
+
+    An index ("index.json") gives the segment and offset of the latest record
+    of every PID, so that a launch is found without reading the history.
+    Once a segment holds HISTORY_SEGMENT_RECORDS records, it is compacted:
+    gzipped, and the PIDs it holds are dropped from the index unless their
+    process may still be running. Nothing is ever deleted.
+
+    The ring buffer kept in HISTORY_PATH by earlier versions is migrated on
+    first use.
+
+    The time every build and patch was last launched is also kept, by
+    resolved path (see `path_key`), in the 'last_used' cache.
+"""
+import contextlib
+import errno
+import glob
+import gzip
+import json
+import logging
+import os
+import re
+import time
+
+from .cache import JSONCache
+from .constants import (HISTORY_DIR, HISTORY_MAX_RECORDS, HISTORY_PATH,
+                        HISTORY_SEGMENT_RECORDS)
+from . import spans
+from . import utils
+
+_INDEX_PATH = os.path.join(HISTORY_DIR, 'index.json')
+_LOCK_PATH = os.path.join(HISTORY_DIR, 'lock')
+_SEGMENT_RE = re.compile(r'^history\.(\d+)\.jsonl(\.gz)?$')
+
+
+@contextlib.contextmanager
+def _locked():
+    """Hold the history lock, shared by all processes."""
+    utils.ensure_dir_exists(HISTORY_DIR)
+    with utils.file_lock(_LOCK_PATH):
+        yield
+
+
+def _segment_path(number, compacted=False):
+    return os.path.join(HISTORY_DIR, 'history.%i.jsonl%s'
+                        % (number, '.gz' if compacted else ''))
+
+
+def _segments():
+    """Segments on disk, oldest first.
+
+    A segment found both compacted and not is one whose compaction was
+    interrupted after the compacted copy was complete: that copy is used.
+
+    Returns:
+        list : (number, path, compacted)
+    """
+    segments = {}
+    for path in glob.glob(os.path.join(HISTORY_DIR, 'history.*.jsonl*')):
+        match = _SEGMENT_RE.match(os.path.basename(path))
+        if match:
+            number, compacted = int(match.group(1)), bool(match.group(2))
+            if compacted or number not in segments:
+                segments[number] = (number, path, compacted)
+    return sorted(segments.values())
+
+
+def _open_segment(path, compacted):
+    if compacted:
+        return contextlib.closing(gzip.open(path, 'rb'))
+    return open(path, 'rb')
+
+
+def _read_segment(path, compacted):
+    """Records of a segment with their offsets, oldest first.
+
+    Returns:
+        list : (offset, record)
+    """
+    records = []
+    with _open_segment(path, compacted) as f:
+        offset = 0
+        for line in f:
+            try:
+                records.append((offset, json.loads(line)))
+            except ValueError:
+                # Line cut short by a crash.
+                pass
+            offset += len(line)
+    return records
+
+
+def _read_at(location):
+    """Record at an index `location`, None if it cannot be read."""
+    number, offset = location[:2]
+    path = _segment_path(number)
+    compacted = not os.path.exists(path)
+    if compacted:
+        path = _segment_path(number, compacted=True)
+    try:
+        with _open_segment(path, compacted) as f:
+            f.seek(offset)
+            return json.loads(f.readline())
+    except (IOError, ValueError):
+        return None
+
+
+def boot_time():
+    """Time the system started, 0 if unknown."""
+    if os.name == 'nt':
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        kernel32.GetTickCount64.restype = ctypes.c_ulonglong
+        return time.time() - kernel32.GetTickCount64() / 1000.0
+    try:
+        with open('/proc/uptime') as f:
+            return time.time() - float(f.read().split()[0])
+    except (IOError, ValueError):
+        return 0
+
+
+def _may_run(location, boot):
+    """Whether the process of an index `location` may still be running."""
+    return location[2] >= boot and pid_exists(location[3])
+
+
+def _location(number, offset, record):
+    return [number, offset, record.get('time', 0), int(record['PID'])]
+
+
+def _rebuild_index():
+    """Index of the segments on disk, see `_load_index`."""
+    logger = logging.getLogger(__name__)
+    logger.debug("Rebuilding the history index")
+    segments = _segments()
+    index = dict(segment=segments[-1][0] if segments else 1, count=0,
+                 bytes=0, pids={})
+    for number, path, compacted in segments:
+        if compacted and os.path.exists(_segment_path(number)):
+            os.remove(_segment_path(number))
+        records = _read_segment(path, compacted)
+        if number == index['segment'] and not compacted:
+            index['count'] = len(records)
+            index['bytes'] = os.path.getsize(path)
+        for offset, record in records:
+            index['pids'][str(record['PID'])] = _location(number, offset,
+                                                          record)
+    if segments and segments[-1][2]:
+        # The latest segment was compacted already.
+        index['segment'] += 1
+    boot = boot_time()
+    index['pids'] = dict(
+            (pid, location) for pid, location in index['pids'].items()
+            if location[0] == index['segment'] or _may_run(location, boot))
+    return index
+
+
+def _covers(index):
+    """Whether `index` covers the end of the history on disk.
+
+    It does not if a process stopped between writing to the history and
+    saving the index.
+    """
+    segments = _segments()
+    if not segments:
+        return index['bytes'] == 0
+    number, path, compacted = segments[-1]
+    if compacted:
+        return index['segment'] == number + 1 and index['bytes'] == 0
+    return (index['segment'] == number
+            and index['bytes'] == os.path.getsize(path))
+
+
+def _load_index():
+    """Index of the history, rebuilt if missing, corrupt or behind.
+
+    Returns:
+        tuple : (index, whether it was rebuilt). The index is a dict with
+            keys segment (number of the segment appended to), count and
+            bytes (records and size of that segment) and pids ({PID:
+            [segment, offset, time, PID]} of the latest record of every
+            PID).
+    """
+    try:
+        index = utils.load_json(_INDEX_PATH)
+        if _covers(index):
+            return index, False
+    except (IOError, ValueError, KeyError, TypeError):
+        pass
+    return _rebuild_index(), True
+
+
+def _save_index(index):
+    tmp = '%s.%i.tmp' % (_INDEX_PATH, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(index, f, separators=(',', ':'))
+    # Windows cannot rename over an existing file. Readers hold the lock,
+    # so none can see the index missing.
+    if os.path.exists(_INDEX_PATH):
+        os.remove(_INDEX_PATH)
+    os.rename(tmp, _INDEX_PATH)
+
+
+def _compact(index):
+    """Gzip the segment appended to, start the next one, and drop from the
+    index the PIDs which cannot be running any more."""
+    logger = logging.getLogger(__name__)
+    number = index['segment']
+    source = _segment_path(number)
+    logger.debug("Compacting %s", source)
+    tmp = _segment_path(number, compacted=True) + '.tmp'
+    with open(source, 'rb') as f_in:
+        with contextlib.closing(gzip.open(tmp, 'wb')) as f_out:
+            for line in f_in:
+                f_out.write(line)
+    os.rename(tmp, _segment_path(number, compacted=True))
+    os.remove(source)
+    boot = boot_time()
+    index['pids'] = dict((pid, location)
+                         for pid, location in index['pids'].items()
+                         if _may_run(location, boot))
+    index['segment'] = number + 1
+    index['count'] = 0
+    index['bytes'] = 0
+
+
+def _append(records, index):
+    """Append `records` to the history, updating `index`."""
+    with open(_segment_path(index['segment']), 'a+b') as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell():
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != '\n':
+                # Line cut short by a crash: end it, it is skipped when read.
+                f.seek(0, os.SEEK_END)
+                f.write('\n')
+        f.seek(0, os.SEEK_END)
+        for record in records:
+            offset = f.tell()
+            f.write(json.dumps(record, separators=(',', ':')) + '\n')
+            index['pids'][str(record['PID'])] = _location(
+                    index['segment'], offset, record)
+            index['count'] += 1
+        f.flush()
+        os.fsync(f.fileno())
+        index['bytes'] = f.tell()
+    if index['count'] >= HISTORY_SEGMENT_RECORDS:
+        _compact(index)
+
+
+def _migrate(index):
+    """Append the records of the ring buffer of earlier versions."""
+    logger = logging.getLogger(__name__)
+    try:
+        records = utils.load_json(HISTORY_PATH)
+        last = int(records['last_update'])
+    except (IOError, ValueError, KeyError):
+        records, last = {}, 0
+    logger.debug("Migrating %s", HISTORY_PATH)
+    # Ring buffer order: the oldest first, from the one after the latest.
+    keys = [str((last + i) % HISTORY_MAX_RECORDS + 1)
+            for i in range(HISTORY_MAX_RECORDS)]
+    old = [records[key] for key in keys if isinstance(records.get(key),
+                                                      dict)]
+    if old:
+        _append(old, index)
+    # Left by an earlier migration, e.g. before a downgrade. Windows cannot
+    # rename over it.
+    migrated = HISTORY_PATH + '.migrated'
+    if os.path.exists(migrated):
+        os.remove(migrated)
+    os.rename(HISTORY_PATH, migrated)
+
+
+@contextlib.contextmanager
+def _store():
+    """Index of the history, with the lock held.
+
+    The history of earlier versions is migrated first. Changes made to the
+    index are saved on exit.
+    """
+    with _locked():
+        index, rebuilt = _load_index()
+        before = json.dumps(index, sort_keys=True)
+        if os.path.exists(HISTORY_PATH):
+            _migrate(index)
+        yield index
+        if rebuilt or json.dumps(index, sort_keys=True) != before:
+            _save_index(index)
+
+
+def entries(limit=None):
+    """Launch records, latest first.
+
+    Args:
+        limit (int): Maximum number of records, all by default. Older
+            segments are only read if needed.
+
+    Returns:
+        list
+    """
+    result = []
+    with _store():
+        for _, path, compacted in reversed(_segments()):
+            records = _read_segment(path, compacted)
+            result.extend(record for _, record in reversed(records))
+            if limit is not None and len(result) >= limit:
+                return result[:limit]
+    return result
+
+
+def find(pid):
+    """Latest launch record of `pid`, None if there is none.
+
+    PIDs of launches which cannot be running any more are forgotten when
+    their segment is compacted.
+    """
+    with _store() as index:
+        location = index['pids'].get(str(pid))
+        return _read_at(location) if location else None
+
+
+def add_entry(entry, used=()):
+    """Record a launch.
+
+    Args:
+        entry (dict): See module docstring. `time` is added if missing.
+        used (list): Absolute paths of the build and patch launched.
+    """
+    add_entries([(entry, used)])
+
+
+@spans.span('history write')
+def add_entries(launches):
+    """Record several launches with a single append to the history.
+
+    Args:
+        launches (list): (entry, used) of every launch, see `add_entry`.
+    """
+    logger = logging.getLogger(__name__)
+    used_times = {}
+    for entry, used in launches:
+        entry.setdefault('time', time.time())
+        logger.debug("New entry:\n%s", utils.lazy_pformat(entry))
+        for path in used:
+            if path:
+                used_times[path_key(path)] = entry['time']
+    with _store() as index:
+        _append([entry for entry, _ in launches], index)
+    JSONCache('last_used').update(used_times)
+
+
+def path_key(path):
+    """`path` resolved, to compare it with another one."""
+    return os.path.normcase(os.path.realpath(path))
+
+
+def last_used(path):
+    """Last launch time of the build or patch at `path`, or None."""
+    value, _ = JSONCache('last_used').get(path_key(path))
+    return value
+
+
+def pid_exists(pid):
+    """Whether a process with this `pid` is running."""
+    if os.name == 'nt':
+        import ctypes
+        PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+        STILL_ACTIVE = 259
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION,
+                                      False, pid)
+        if not handle:
+            return False
+        try:
+            code = ctypes.c_ulong()
+            if not kernel32.GetExitCodeProcess(handle, ctypes.byref(code)):
+                return False
+            return code.value == STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def running_entries():
+    """Records of the launches still running, found with the index.
+
+    Launches from before the system started are ignored, but PIDs may still
+    have been reused by other processes since, in which case an entry is
+    wrongly considered running.
+
+    Returns:
+        list
+    """
+    boot = boot_time()
+    with _store() as index:
+        records = [_read_at(location) for location in index['pids'].values()
+                   if _may_run(location, boot)]
+    return [record for record in records if record is not None]
@@ -0,0 +1,199 @@
+"""
+    nx_tools.inventory
+    ~~~~~~~~~~~~~~~~~~
+
+    Persistent index of the local builds and patches.
+
+    Every root directory (e.g. the local NX11 builds) is indexed along with
+    its mtime. Adding or removing an entry changes the mtime of the root,
+    which invalidates the index and triggers a rescan. Otherwise, entries are
+    read from the index without touching the root at all, which matters on
+    mapped network drives.
+
+    A rescan lists the root once, with `scandir` when available (Python 3.5+
+    or the `scandir` package), which also gives the entries' mtimes for free
+    on Windows. Only the entries that are new or whose mtime changed are
+    then looked into.
+"""
+import logging
+import os
+import stat
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+from .cache import JSONCache
+
+EXTRACTING = 'extracting'
+EXTRACTED = 'extracted'
+# Found on disk, but not installed by the updater.
+FOUND = 'found'
+
+BUILD = 'build'
+PATCH = 'patch'
+# Locations of ugraf.exe inside a build, in order of preference.
+UGRAF_PATHS = (os.path.join('kits', 'nxbin', 'ugraf.exe'),
+               os.path.join('kits', 'ugii', 'ugraf.exe'))
+# Records of an older layout are rescanned.
+_LAYOUT = 2
+
+
+def _getmtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def list_dirs(root):
+    """Subdirectories of `root` and their mtimes, in a single pass.
+
+    Returns:
+        dict : {name: mtime}
+    """
+    dirs = {}
+    if scandir is not None:
+        for entry in scandir(root):
+            try:
+                if entry.is_dir():
+                    dirs[entry.name] = entry.stat().st_mtime
+            except OSError:
+                continue
+        return dirs
+    for name in os.listdir(root):
+        try:
+            st = os.stat(os.path.join(root, name))
+        except OSError:
+            continue
+        if stat.S_ISDIR(st.st_mode):
+            dirs[name] = st.st_mtime
+    return dirs
+
+
+def probe(path):
+    """Kind, `kits` mtime and ugraf.exe locations of the entry at `path`.
+
+    Returns:
+        dict : kind (BUILD, PATCH or None), kits_mtime (mtime of the `kits`
+            folder, or of the entry if it has none, None if missing) and
+            ugraf (paths of ugraf.exe relative to the entry, see
+            UGRAF_PATHS).
+    """
+    kits = os.path.join(path, 'kits')
+    kits_mtime = _getmtime(kits)
+    if kits_mtime is not None:
+        kind = BUILD
+    elif os.path.isdir(os.path.join(path, 'tmg')):
+        kind = PATCH
+    else:
+        kind = None
+    ugraf = ([rel for rel in UGRAF_PATHS
+              if os.path.isfile(os.path.join(path, rel))]
+             if kind == BUILD else [])
+    return dict(kind=kind, kits_mtime=kits_mtime or _getmtime(path),
+                ugraf=ugraf)
+
+
+class Inventory(object):
+    """Index of the entries found in local root directories.
+
+    Each entry is a dict with keys:
+        status (str): EXTRACTING, EXTRACTED or FOUND.
+        mtime (float): Modification time of the entry's directory.
+        size (int): Size of the source archive, if known.
+        source (str): Source archive, if installed by the updater.
+        kind, kits_mtime, ugraf: See `probe`.
+        disk_size (list): [mtime, bytes] of the directory's content, when
+            it was last measured. Missing until then.
+
+    Records are read, modified and saved under the lock of the cache, as
+    several processes may update them at once, e.g. an update and the
+    background copy of `launch --remote`.
+    """
+
+    def __init__(self):
+        self._cache = JSONCache('inventory')
+
+    def _scan(self, root, previous):
+        logger = logging.getLogger(__name__)
+        logger.debug("Scanning %s", root)
+        old_entries = {}
+        if previous and previous.get('layout') == _LAYOUT:
+            old_entries = previous['entries']
+        entries = {}
+        for name, mtime in list_dirs(root).items():
+            entry = old_entries.get(name) or dict(status=FOUND, size=None,
+                                                  source=None)
+            if entry.get('mtime') != mtime or 'kind' not in entry:
+                entry.update(probe(os.path.join(root, name)))
+            entry['mtime'] = mtime
+            entries[name] = entry
+        return entries
+
+    def _load(self, root):
+        """Index record of `root`.
+
+        Raises:
+            OSError: If `root` does not exist.
+        """
+        with self._cache.locked():
+            mtime = os.path.getmtime(root)
+            record, _ = self._cache.get(root)
+            if (record is None or record['mtime'] != mtime
+                    or record.get('layout') != _LAYOUT):
+                record = dict(mtime=mtime, layout=_LAYOUT,
+                              entries=self._scan(root, record))
+                self._cache.set(root, record)
+            return record
+
+    def entries(self, root):
+        """Entries of `root`, rescanned only if `root` changed.
+
+        Returns:
+            dict : {name: entry}
+        """
+        return self._load(root)['entries']
+
+    def installed(self, root):
+        """Names of the entries of `root` which are ready to be used.
+
+        Returns:
+            set
+        """
+        return set(name for name, entry in self.entries(root).items()
+                   if entry['status'] != EXTRACTING)
+
+    def record(self, root, name, **fields):
+        """Create or update the entry `name` of `root`."""
+        path = os.path.join(root, name)
+        probed = probe(path)
+        with self._cache.locked():
+            record = self._load(root)
+            entry = record['entries'].setdefault(
+                    name, dict(status=FOUND, size=None, source=None))
+            entry.update(fields)
+            entry['mtime'] = _getmtime(path)
+            entry.update(probed)
+            # The entry's directory was most likely just created.
+            record['mtime'] = _getmtime(root)
+            self._cache.set(root, record)
+
+    def annotate(self, root, fields):
+        """Update existing entries of `root`, with a single write.
+
+        Unlike `record`, entries are not probed again.
+
+        Args:
+            fields (dict): {name: fields}
+        """
+        with self._cache.locked():
+            record = self._load(root)
+            for name, values in fields.items():
+                if name in record['entries']:
+                    record['entries'][name].update(values)
+            self._cache.set(root, record)
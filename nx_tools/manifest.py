@@ -0,0 +1,148 @@
+"""
+    nx_tools.manifest
+    ~~~~~~~~~~~~~~~~~
+
+    Manifests of the items installed by the updater, stored in MANIFEST_DIR
+    as <item name>.json.
+
+    A manifest is a dict with keys:
+        archive (str): Name of the source archive.
+        size (int): Size of the archive, if it was transferred.
+        sha256 (str): SHA-256 of the archive, if it was transferred.
+        mtime (float): Modification time of the archive when `sha256` was
+            computed. Missing from older manifests.
+        members (dict): Installed files, as {path: [size, crc]}, where crc
+            is the CRC-32 in upper case hex.
+        status (str): TRANSFERRED, OK or CORRUPT.
+        verified (float): Time of the last verification, if any.
+"""
+import logging
+import multiprocessing
+import os
+import time
+import zlib
+
+from .constants import MANIFEST_DIR
+from . import utils
+
+TRANSFERRED = 'transferred'
+OK = 'ok'
+CORRUPT = 'corrupt'
+
+
+def manifest_path(name):
+    return os.path.join(MANIFEST_DIR, name + '.json')
+
+
+def load(name):
+    """Manifest of the item `name`, or None if there is none."""
+    try:
+        return utils.load_json(manifest_path(name))
+    except (IOError, ValueError):
+        return None
+
+
+def save(name, manifest):
+    logger = logging.getLogger(__name__)
+    logger.debug("Saving manifest of %s", name)
+    utils.write_json(manifest, manifest_path(name))
+
+
+def update(name, **fields):
+    """Update the manifest of `name`, creating it if needed.
+
+    Returns:
+        dict
+    """
+    manifest = load(name) or dict(archive=None, size=None, sha256=None,
+                                  members=None, status=None, verified=None,
+                                  mtime=None)
+    manifest.update(fields)
+    save(name, manifest)
+    return manifest
+
+
+def crc32_file(path, blocksize=1024 * 1024):
+    crc = 0
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(blocksize), b''):
+            crc = zlib.crc32(block, crc)
+    return '%08X' % (crc & 0xffffffff)
+
+
+def _hash_member(args):
+    root, path = args
+    full_path = os.path.join(root, path)
+    return path, [os.path.getsize(full_path), crc32_file(full_path)]
+
+
+def _check_member(args):
+    root, path, expected = args
+    full_path = os.path.join(root, path)
+    try:
+        size = os.path.getsize(full_path)
+        if size != expected[0]:
+            return path, 'size %i instead of %i' % (size, expected[0])
+        if expected[1] and crc32_file(full_path) != expected[1]:
+            return path, 'CRC mismatch'
+    except EnvironmentError:
+        return path, 'missing'
+    return path, None
+
+
+def pool():
+    """Process pool to hash files on every core."""
+    # CRC-32 holds the GIL, hence processes rather than threads.
+    return multiprocessing.Pool(multiprocessing.cpu_count())
+
+
+def hash_tree(root):
+    """Members of the installed tree `root`, hashed in parallel.
+
+    Used for archives whose headers do not provide CRCs.
+
+    Returns:
+        dict : {path: [size, crc]}
+    """
+    paths = []
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            paths.append(os.path.relpath(os.path.join(dirpath, filename),
+                                         root))
+    workers = pool()
+    try:
+        return dict(workers.imap_unordered(_hash_member,
+                                           [(root, p) for p in paths], 16))
+    finally:
+        workers.close()
+        workers.join()
+
+
+def verify_tree(root, members, workers):
+    """Check the installed tree `root` against its manifest's members.
+
+    Args:
+        workers (multiprocessing.Pool): See `pool`.
+
+    Returns:
+        list : (path, problem) for every member which does not match.
+    """
+    args = [(root, path, expected) for path, expected in members.items()]
+    return sorted((path, problem) for path, problem
+                  in workers.imap_unordered(_check_member, args, 16)
+                  if problem is not None)
+
+
+def verify(name, root, workers):
+    """Verify the item `name` installed in `root` and record the outcome.
+
+    Returns:
+        list : Problems found, or None if `name` has no manifest.
+    """
+    manifest = load(name)
+    if manifest is None or manifest['members'] is None:
+        return None
+    problems = verify_tree(os.path.join(root, name), manifest['members'],
+                           workers)
+    update(name, status=CORRUPT if problems else OK, verified=time.time())
+    return problems
@@ -0,0 +1,204 @@
+"""
+    nx_tools.scheduler
+    ~~~~~~~~~~~~~~~~~~
+
+    Download scheduling shared by every updater of the process.
+
+    Transfers are queued by priority, patches before builds, then smallest
+    first, and only `download_slots` of them run at a time. All transfers
+    draw from a single token bucket, which limits their total throughput to
+    `download_rate_limit` bytes per second, or to the rate of the entry of
+    `download_rate_profiles` matching the time of day, e.g.:
+
+        "download_rate_profiles": [
+            {"start": "08:00", "end": "18:00", "rate": 2097152}
+        ]
+
+    A rate of null (or 0) means unlimited.
+"""
+import contextlib
+import datetime
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+PATCH = 0
+BUILD = 1
+# How often the time-of-day profiles are re-evaluated, in seconds.
+PROFILE_INTERVAL = 60
+
+
+def _minutes(hhmm):
+    hours, minutes = hhmm.split(':')
+    return int(hours) * 60 + int(minutes)
+
+
+def rate_limit(config, now=None):
+    """Rate limit in effect at `now`.
+
+    Profiles may wrap around midnight, e.g. from "22:00" to "06:00".
+
+    Returns:
+        int : Bytes per second, or None if unlimited.
+    """
+    now = now or datetime.datetime.now()
+    minutes = now.hour * 60 + now.minute
+    for profile in config['download_rate_profiles']:
+        start = _minutes(profile['start'])
+        end = _minutes(profile['end'])
+        if start <= end:
+            active = start <= minutes < end
+        else:
+            active = minutes >= start or minutes < end
+        if active:
+            return profile['rate'] or None
+    return config['download_rate_limit'] or None
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket, one token per byte.
+
+    Consumers go into debt rather than waiting for enough tokens, and then
+    sleep until the debt is paid off, so blocks larger than the bucket are
+    fine.
+
+    Args:
+        rate (int): Tokens added per second, None for unlimited.
+        burst (float): Capacity of the bucket, in seconds of `rate`.
+    """
+
+    def __init__(self, rate=None, burst=1.0):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = 0.0
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def set_rate(self, rate):
+        with self._lock:
+            self.rate = rate
+            self.tokens = min(self.tokens, 0.0)
+
+    def consume(self, nbytes):
+        """Take `nbytes` tokens, sleeping as long as the rate requires."""
+        with self._lock:
+            now = time.time()
+            if self.rate is None:
+                self._last = now
+                return
+            self.tokens = min(self.tokens + (now - self._last) * self.rate,
+                              self.rate * self.burst)
+            self._last = now
+            self.tokens -= nbytes
+            delay = -self.tokens / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Scheduler(object):
+    """Orders transfers and limits their total throughput.
+
+    Every transfer gets a ticket from `submit`, and then runs inside
+    `transfer`, which waits for a free slot. Ordering is advisory: a free
+    slot goes to the best ticket among the transfers waiting for one and
+    the ones claimed by a running thread (see `claim`), never to a ticket
+    which no thread will run yet, so that updaters without a thread of
+    their own cannot hold up the others.
+    """
+
+    def __init__(self, config):
+        self.logger = logging.getLogger(__name__)
+        self.config = config
+        self.slots = max(1, config['download_slots'])
+        self.bucket = TokenBucket(rate_limit(config))
+        self._rate_checked = time.time()
+        # Tickets of the transfers waiting in `transfer`, or claimed.
+        self._waiting = []
+        self._active = 0
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+
+    def submit(self, priority, size=None):
+        """Ticket of a transfer.
+
+        Args:
+            priority (int): PATCH or BUILD.
+            size (int): Size of the transfer, if known. Unknown sizes go
+                last among their priority.
+
+        Returns:
+            tuple : Ticket to pass to `transfer` or `cancel`. Tickets sort
+                in the order transfers should run.
+        """
+        return (priority, size is None, size, next(self._counter))
+
+    def claim(self, tickets):
+        """Make worse tickets wait for `tickets`, before their transfers
+        wait for a slot.
+
+        The caller must run the transfers of `tickets`, in order, or cancel
+        them.
+        """
+        with self._cond:
+            for ticket in tickets:
+                if ticket not in self._waiting:
+                    heapq.heappush(self._waiting, ticket)
+
+    def cancel(self, ticket):
+        """Forget a transfer which will not run after all."""
+        with self._cond:
+            if ticket in self._waiting:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def transfer(self, ticket):
+        """Wait until a slot is free and `ticket` is the best one waiting."""
+        with self._cond:
+            if ticket not in self._waiting:
+                heapq.heappush(self._waiting, ticket)
+            try:
+                while (self._active >= self.slots
+                       or self._waiting[0] != ticket):
+                    # A timeout keeps the main thread responsive to Ctrl+C.
+                    self._cond.wait(1)
+            except BaseException:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+                raise
+            heapq.heappop(self._waiting)
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._active -= 1
+                self._cond.notify_all()
+
+    def throttle(self, nbytes):
+        """Account for `nbytes` transferred, sleeping to honor the limit."""
+        now = time.time()
+        if now - self._rate_checked > PROFILE_INTERVAL:
+            self._rate_checked = now
+            rate = rate_limit(self.config)
+            if rate != self.bucket.rate:
+                self.logger.debug("Download rate limit: %s", rate)
+                self.bucket.set_rate(rate)
+        self.bucket.consume(nbytes)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler(config):
+    """The scheduler shared by every updater of the process."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = Scheduler(config)
+        return _scheduler
@@ -0,0 +1,91 @@
+"""
+    nx_tools.sevenzip
+    ~~~~~~~~~~~~~~~~~
+
+    Helpers around the 7-Zip command line.
+"""
+import os
+import subprocess
+import tempfile
+
+from .exceptions import ExtractionError
+
+
+def console_exe(exe):
+    """Console version of the configured 7-Zip executable.
+
+    The configured executable is usually the GUI one, 7zG.exe, which cannot
+    list archives.
+    """
+    dirname, basename = os.path.split(exe)
+    if basename.lower() == '7zg.exe':
+        return os.path.join(dirname, '7z.exe')
+    return exe
+
+
+def _run(command):
+    p = subprocess.Popen(command, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    if p.returncode != 0:
+        raise ExtractionError("%s failed: %s"
+                              % (' '.join(command[:2]), err.decode('utf-8')))
+    return out.decode('utf-8')
+
+
+def list_archive(archive, exe):
+    """Files of `archive` with their size and CRC, and its directories,
+    read from its headers.
+
+    Only the archive's index is read, not its content.
+
+    Returns:
+        tuple : ({path: [size, crc]} of the files, list of the paths of the
+                 directories)
+
+    Raises:
+        ExtractionError: If the archive cannot be listed.
+        OSError: If `exe` cannot be run.
+    """
+    output = _run([console_exe(exe), 'l', '-slt', archive])
+    output = output.replace('\r\n', '\n')
+    # Technical listing: the header, then one block of "Key = Value" lines
+    # per member, separated by blank lines.
+    _, _, body = output.partition('\n----------\n')
+    members = {}
+    dirs = []
+    for block in body.split('\n\n'):
+        fields = dict(line.split(' = ', 1) for line in block.splitlines()
+                      if ' = ' in line)
+        if 'Path' not in fields:
+            continue
+        if 'D' in fields.get('Attributes', ''):
+            dirs.append(fields['Path'])
+            continue
+        members[fields['Path']] = [int(fields.get('Size') or 0),
+                                   fields.get('CRC', '')]
+    return members, dirs
+
+
+def list_members(archive, exe):
+    """Files of `archive` with their size and CRC, see `list_archive`.
+
+    Returns:
+        dict : {path: [size, crc]}
+    """
+    return list_archive(archive, exe)[0]
+
+
+def extract_members(archive, output_dir, members, exe, threads=None):
+    """Extract only `members` of `archive` into `output_dir`."""
+    fd, listfile = tempfile.mkstemp(suffix='.txt')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write('\n'.join(members).encode('utf-8'))
+        command = [exe, 'x', archive, '-o' + output_dir, '-y',
+                   '@' + listfile]
+        if threads:
+            command.append('-mmt=%i' % threads)
+        _run(command)
+    finally:
+        os.remove(listfile)
@@ -0,0 +1,143 @@
+"""
+    nx_tools.spans
+    ~~~~~~~~~~~~~~
+
+    Timing of the phases of a command, reported by `nx_tools --profile`.
+
+    Phases are timed with `span`, as a context manager or a decorator:
+
+        with spans.span('connect'):
+            ftp = ftplib.FTP(host)
+
+    A span opened while another one is open on the same thread is recorded as
+    its child. Spans of worker threads have no parent, unless one is given
+    explicitly (see `current`). Spans with the same name and parent are
+    merged, their durations added up and counted.
+
+    Nothing is recorded until `enable` is called, so that spans cost a single
+    test otherwise.
+"""
+import functools
+import threading
+import time
+
+_local = threading.local()
+_lock = threading.Lock()
+_root = None
+
+
+class _Node(object):
+    """Total duration and count of the spans of a given name and parent."""
+
+    def __init__(self, name):
+        self.name = name
+        self.total = 0.0
+        self.count = 0
+        # By name, and in the order they were first opened (OrderedDict is
+        # missing from Python 2.6).
+        self.children = {}
+        self.order = []
+
+    def child(self, name):
+        with _lock:
+            node = self.children.get(name)
+            if node is None:
+                node = self.children[name] = _Node(name)
+                self.order.append(node)
+            return node
+
+
+def _stack():
+    try:
+        return _local.stack
+    except AttributeError:
+        _local.stack = []
+        return _local.stack
+
+
+def enable():
+    """Start recording spans, discarding any previous recording."""
+    global _root
+    _root = _Node('total')
+    _root.start = time.time()
+
+
+def enabled():
+    return _root is not None
+
+
+def current():
+    """Span open on this thread, to be passed as the parent of the spans of
+    worker threads. None if there is none or recording is disabled."""
+    if _root is None:
+        return None
+    stack = _stack()
+    return stack[-1] if stack else None
+
+
+class span(object):
+    """Time the phase `name`.
+
+    Args:
+        name (str)
+        parent: Parent span, see `current`. By default, the span open on
+            this thread.
+    """
+
+    def __init__(self, name, parent=None):
+        self.name = name
+        self.parent = parent
+        self._node = None
+        self._start = None
+
+    def __enter__(self):
+        if _root is None:
+            return self
+        stack = _stack()
+        parent = self.parent or (stack[-1] if stack else _root)
+        self._node = parent.child(self.name)
+        stack.append(self._node)
+        self._start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        node, self._node = self._node, None
+        if node is None:
+            return False
+        elapsed = time.time() - self._start
+        stack = _stack()
+        if stack and stack[-1] is node:
+            stack.pop()
+        with _lock:
+            node.total += elapsed
+            node.count += 1
+        return False
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(self.name, self.parent):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+def pformat():
+    """Pretty format the tree of the spans recorded so far.
+
+    Returns:
+        str
+    """
+    if _root is None:
+        return ''
+    _root.total = time.time() - _root.start
+    _root.count = 1
+    lines = ["Spans:"]
+
+    def add(node, depth):
+        label = '  ' * depth + node.name
+        count = ' (%i)' % node.count if node.count > 1 else ''
+        lines.append("  %-40s %8.3f s%s" % (label, node.total, count))
+        for child in node.order:
+            add(child, depth + 1)
+    add(_root, 0)
+    return '\n'.join(lines)
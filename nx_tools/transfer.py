@@ -0,0 +1,1057 @@
+"""
+    nx_tools.transfer
+    ~~~~~~~~~~~~~~~~~
+
+    Low-level transfer helpers used by the updaters.
+"""
+from __future__ import print_function
+
+import calendar
+import contextlib
+import errno
+import ftplib
+import hashlib
+import json
+import logging
+import os
+import shutil
+import socket
+import sys
+import tarfile
+import threading
+import time
+import urllib2
+
+from .exceptions import TransferError
+
+PART_EXT = '.part'
+# Progress of a partial copy, used to resume it.
+STATE_EXT = '.part.json'
+SEGMENTS_EXT = '.segments'
+# Smaller segments are not worth the extra FTP sessions.
+MIN_SEGMENT_SIZE = 8 * 1024 * 1024
+# Archives which can be extracted as they are received. 7z and zip archives
+# store their index at the end, so they must be complete before extraction.
+STREAMABLE_EXTS = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2')
+
+
+def format_size(nbytes):
+    """Human readable size, e.g. 1.5 GB.
+
+    Returns:
+        str
+    """
+    size = float(nbytes)
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(size) < 1024:
+            return '%.1f %s' % (size, unit)
+        size /= 1024
+    return '%.1f TB' % size
+
+
+class Progress(object):
+    """Report transferred bytes and throughput.
+
+    The report is refreshed in place at most every `interval` seconds when
+    `stream` is a terminal. Otherwise, only the final summary is written.
+
+    Args:
+        total (int): Expected number of bytes, if known.
+        done (int): Number of bytes already transferred, e.g. when resuming.
+        enabled (bool): If False, nothing is ever written.
+        throttle (callable): Called with the number of bytes of every
+            update, and expected to block as long as needed to limit the
+            throughput, e.g. `scheduler.Scheduler.throttle`.
+    """
+
+    def __init__(self, total=None, done=0, enabled=True, interval=0.5,
+                 stream=sys.stdout, throttle=None):
+        self.total = total
+        self.done = done
+        self.enabled = enabled
+        self.interval = interval
+        self.stream = stream
+        self.throttle = throttle
+        self.live = enabled and stream.isatty()
+        self.start = time.time()
+        self.transferred = 0
+        self._last_report = 0
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self):
+        """Bytes per second transferred since the start."""
+        elapsed = time.time() - self.start
+        return self.transferred / elapsed if elapsed > 0 else 0.0
+
+    def update(self, nbytes):
+        with self._lock:
+            self.done += nbytes
+            self.transferred += nbytes
+            now = time.time()
+            if self.live and now - self._last_report >= self.interval:
+                self._last_report = now
+                self.stream.write('\r' + self._format() + ' ' * 4)
+                self.stream.flush()
+        if self.throttle is not None:
+            self.throttle(nbytes)
+
+    def close(self):
+        if not self.enabled:
+            return
+        if self.live:
+            self.stream.write('\r')
+        elapsed = time.time() - self.start
+        self.stream.write('%s in %.1f s\n' % (self._format(), elapsed))
+        self.stream.flush()
+
+    def _format(self):
+        done = format_size(self.done)
+        if self.total:
+            done += ' / %s (%.0f%%)' % (format_size(self.total),
+                                       100.0 * self.done / self.total)
+        return '%s -- %s/s' % (done, format_size(self.rate))
+
+
+def _getsize(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _remove(path):
+    """Remove `path`, if it exists."""
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def file_digest(path, blocksize=1024 * 1024, size=None):
+    """SHA-256 of the first `size` bytes of `path`, or of the whole file.
+
+    Returns:
+        hashlib object, which can be updated with the bytes that follow.
+    """
+    digest = hashlib.sha256()
+    remaining = os.path.getsize(path) if size is None else size
+    with open(path, 'rb') as fh:
+        while remaining > 0:
+            block = fh.read(min(blocksize, remaining))
+            if not block:
+                break
+            digest.update(block)
+            remaining -= len(block)
+    return digest
+
+
+def _is_complete(path, size):
+    return os.path.isfile(path) and os.path.getsize(path) == size
+
+
+class OrderedDigest(object):
+    """SHA-256 of a file written as parallel byte `ranges`, computed in
+    order while they are written.
+
+    The range holding the next byte to hash feeds its writes straight to
+    the digest. Bytes written ahead of that, by later ranges or by an
+    earlier run, are read back from `path` as soon as their turn comes,
+    i.e. while they are still in the OS cache, rather than in a second
+    pass over the whole file once it is complete.
+
+    Args:
+        path (str): File the ranges are written to.
+        ranges (list): (start, end) of the ranges, contiguous and in order.
+    """
+
+    def __init__(self, path, ranges, blocksize):
+        self.path = path
+        self.ranges = ranges
+        self.blocksize = blocksize
+        self.size = ranges[-1][1] if ranges else 0
+        self.pos = 0
+        self._digest = hashlib.sha256()
+        self._complete = [False] * len(ranges)
+        self._lock = threading.Lock()
+
+    def _read_back(self, end):
+        with open(self.path, 'rb') as fh:
+            fh.seek(self.pos)
+            while self.pos < end:
+                block = fh.read(min(self.blocksize, end - self.pos))
+                if not block:
+                    # Left to `hexdigest`.
+                    return
+                self._digest.update(block)
+                self.pos += len(block)
+
+    def update(self, index, offset, block, fh):
+        """`block` was written at `offset` of range `index`, through `fh`.
+
+        Called by the thread writing the range only.
+        """
+        with self._lock:
+            if not self.ranges[index][0] <= self.pos <= offset:
+                return
+            if self.pos < offset:
+                fh.flush()
+                self._read_back(offset)
+                if self.pos < offset:
+                    return
+            self._digest.update(block)
+            self.pos += len(block)
+
+    def complete(self, index):
+        """Range `index` is written, and its file handle closed."""
+        with self._lock:
+            self._complete[index] = True
+            for i, (_, end) in enumerate(self.ranges):
+                if self.pos >= end:
+                    continue
+                if not self._complete[i]:
+                    break
+                self._read_back(end)
+
+    def hexdigest(self):
+        """Digest of the file, once every range is complete."""
+        with self._lock:
+            if self.pos != self.size:
+                # Some bytes could not be hashed as they were written.
+                return file_digest(self.path, self.blocksize).hexdigest()
+            return self._digest.hexdigest()
+
+
+def ftp_connect(address, remote_dir, timeout):
+    """Anonymous FTP session in `remote_dir`.
+
+    Args:
+        address (str): 'host' or 'host:port'.
+    """
+    host, _, port = address.partition(':')
+    ftp = ftplib.FTP(timeout=timeout)
+    ftp.connect(host, int(port or ftplib.FTP_PORT))
+    ftp.login()
+    ftp.cwd(remote_dir)
+    return ftp
+
+
+def ftp_size(ftp, ftp_file):
+    """Size of `ftp_file`, or None if the server refuses SIZE."""
+    try:
+        ftp.voidcmd('TYPE I')
+        return ftp.size(ftp_file)
+    except (ftplib.error_perm, ftplib.error_reply):
+        return None
+
+
+def _parse_mlsd(line):
+    facts, _, name = line.partition(' ')
+    entry = dict(type=None, size=None, mtime=None)
+    for fact in facts.split(';'):
+        key, _, value = fact.partition('=')
+        key = key.lower()
+        if key == 'type':
+            entry['type'] = value.lower()
+        elif key == 'size':
+            entry['size'] = int(value)
+        elif key == 'modify':
+            t = time.strptime(value[:14], '%Y%m%d%H%M%S')
+            entry['mtime'] = calendar.timegm(t)
+    return name, entry
+
+
+def _parse_list(line):
+    # Unix style: perms links owner group size month day time|year name
+    fields = line.split(None, 8)
+    name = fields[-1].lstrip()
+    entry = dict(type='file', size=None, mtime=None)
+    if len(fields) == 9:
+        if fields[0].startswith('d'):
+            entry['type'] = 'dir'
+        try:
+            entry['size'] = int(fields[4])
+        except ValueError:
+            pass
+    return name, entry
+
+
+def ftp_list(ftp, accept=lambda name: True):
+    """List files of the current FTP directory with their size and mtime.
+
+    The machine readable MLSD command is used if supported, LIST otherwise.
+    Lines are parsed as they arrive, and only the names passing `accept` are
+    kept.
+
+    Returns:
+        dict : {name: {'size': int or None, 'mtime': int or None}}
+    """
+    found = {}
+
+    def collect(parse):
+        def callback(line):
+            name, entry = parse(line)
+            if entry['type'] in ('file', None) and accept(name):
+                del entry['type']
+                found[name] = entry
+        return callback
+    try:
+        ftp.retrlines('MLSD', collect(_parse_mlsd))
+    except ftplib.error_perm:
+        found.clear()
+        ftp.retrlines('LIST', collect(_parse_list))
+    return found
+
+
+def ftp_supports_rest(ftp):
+    """Whether the server accepts the REST command."""
+    try:
+        ftp.sendcmd('REST 0')
+    except (ftplib.error_perm, ftplib.error_reply):
+        return False
+    return True
+
+
+def split_ranges(total, count):
+    """Split `total` bytes into `count` contiguous (start, end) ranges.
+
+    Returns:
+        list
+    """
+    step = -(-total // count)
+    return [(start, min(start + step, total))
+            for start in range(0, total, step)]
+
+
+def _quit(ftp):
+    try:
+        ftp.quit()
+    except ftplib.all_errors:
+        ftp.close()
+
+
+def ftp_download(ftp, ftp_file, dest_file, connect, blocksize, retries,
+                 progress=True, segments=1, throttle=None):
+    """Download `ftp_file` to `dest_file`, resuming interrupted transfers.
+
+    Data is first written to `dest_file` + PART_EXT, which is renamed once
+    complete. If a partial file is found, the transfer restarts at its size
+    using the FTP REST command. A dropped connection is re-established with
+    `connect` and resumed the same way, up to `retries` times.
+
+    With `segments` > 1, the file is fetched in as many byte ranges over
+    parallel FTP sessions, see `_ftp_download_segmented`. This falls back to
+    a single stream if the server refuses SIZE or REST.
+
+    Args:
+        ftp (ftplib.FTP): Logged in FTP session.
+        connect (callable): Returns a new logged in FTP session.
+        blocksize (int): Block size passed to retrbinary, also used to size
+            the write buffer.
+        progress (bool): Report bytes/sec while downloading.
+        segments (int): Number of parallel FTP sessions.
+        throttle (callable): Bandwidth limiter, see `Progress`.
+
+    Returns:
+        tuple : (ftplib.FTP session in use at the end of the transfer,
+                 SHA-256 hex digest of the file)
+        The digest is computed while the data is received, see
+        `OrderedDigest` for segmented downloads.
+    """
+    logger = logging.getLogger(__name__)
+    part_file = dest_file + PART_EXT
+    total = ftp_size(ftp, ftp_file)
+    if total is not None and _is_complete(dest_file, total):
+        logger.debug("Already downloaded: %s", dest_file)
+        return ftp, file_digest(dest_file, blocksize).hexdigest()
+
+    if segments > 1 and not os.path.exists(part_file):
+        segments = min(segments, (total or 0) // MIN_SEGMENT_SIZE)
+        if total is None or not ftp_supports_rest(ftp):
+            logger.debug("SIZE or REST refused, using a single stream.")
+        elif segments > 1:
+            sha256 = _ftp_download_segmented(
+                    ftp_file, dest_file, total, connect, blocksize, retries,
+                    progress, segments, throttle)
+            return ftp, sha256
+
+    meter = Progress(total=total, done=_getsize(part_file), enabled=progress,
+                     throttle=throttle)
+    attempt = 0
+    while True:
+        rest = _getsize(part_file)
+        if rest:
+            logger.debug("Resuming %s at byte %i", ftp_file, rest)
+            digest = file_digest(part_file, blocksize)
+        else:
+            digest = hashlib.sha256()
+        try:
+            with open(part_file, 'ab', 4 * blocksize) as fh:
+                def write(block):
+                    fh.write(block)
+                    digest.update(block)
+                    meter.update(len(block))
+                ftp.retrbinary('RETR ' + ftp_file, write, blocksize,
+                               rest=rest or None)
+            break
+        except ftplib.error_perm:
+            if not rest:
+                raise
+            # Server refused REST: start over from scratch.
+            logger.debug("REST refused, restarting %s", ftp_file)
+            os.remove(part_file)
+            meter.done = 0
+        except ftplib.all_errors as e:
+            attempt += 1
+            if attempt > retries:
+                raise
+            print("Transfer interrupted (%s), resuming..." % e)
+            time.sleep(min(2 ** attempt, 30))
+            ftp.close()
+            ftp = connect()
+    meter.close()
+    _finalize(part_file, dest_file)
+    return ftp, digest.hexdigest()
+
+
+def _finalize(part_file, dest_file):
+    if os.path.exists(dest_file):
+        os.remove(dest_file)
+    os.rename(part_file, dest_file)
+
+
+def _ftp_fetch_range(ftp_file, seg_file, start, end, connect, blocksize,
+                     retries, meter, digest=None, index=0):
+    """Write bytes [start, end) of `ftp_file` at the same offset in `seg_file`.
+
+    The range is requested with REST and the data connection is dropped as
+    soon as `end` is reached. The data is fed to `digest`, an
+    `OrderedDigest`, as range `index`.
+    """
+    logger = logging.getLogger(__name__)
+    attempt = 0
+    with open(seg_file, 'r+b') as fh:
+        while start < end:
+            ftp = None
+            try:
+                ftp = connect()
+                ftp.voidcmd('TYPE I')
+                conn = ftp.transfercmd('RETR ' + ftp_file, rest=start)
+                fh.seek(start)
+                try:
+                    while start < end:
+                        data = conn.recv(min(blocksize, end - start))
+                        if not data:
+                            raise EOFError("Connection closed at byte %i"
+                                           % start)
+                        fh.write(data)
+                        if digest is not None:
+                            digest.update(index, start, data, fh)
+                        start += len(data)
+                        meter.update(len(data))
+                finally:
+                    conn.close()
+            except ftplib.all_errors as e:
+                attempt += 1
+                if attempt > retries:
+                    raise
+                logger.debug("Segment interrupted (%s), resuming at %i",
+                             e, start)
+                time.sleep(min(2 ** attempt, 30))
+            finally:
+                if ftp is not None:
+                    # The server answers 426 to the aborted RETR.
+                    _quit(ftp)
+
+
+def _ftp_download_segmented(ftp_file, dest_file, total, connect, blocksize,
+                            retries, progress, segments, throttle=None):
+    """Fetch `ftp_file` as `segments` byte ranges over parallel sessions.
+
+    Every range is written at its own position in a file preallocated to
+    `total` bytes. Unlike single stream downloads, an interrupted segmented
+    download is not resumed by a later run.
+
+    Returns:
+        str : SHA-256 hex digest of the file.
+    """
+    logger = logging.getLogger(__name__)
+    seg_file = dest_file + SEGMENTS_EXT
+    with open(seg_file, 'wb') as fh:
+        fh.truncate(total)
+    ranges = split_ranges(total, segments)
+    logger.debug("Downloading %s in %i segments", ftp_file, len(ranges))
+    meter = Progress(total=total, enabled=progress, throttle=throttle)
+    digest = OrderedDigest(seg_file, ranges, blocksize)
+    errors = []
+
+    def fetch(index):
+        start, end = ranges[index]
+        try:
+            _ftp_fetch_range(ftp_file, seg_file, start, end, connect,
+                             blocksize, retries, meter, digest, index)
+            digest.complete(index)
+        except Exception as e:
+            # Any error, e.g. writing to a full disk, is raised after the
+            # join: the file must not be finalized with a range missing.
+            errors.append(e)
+
+    threads = [threading.Thread(target=fetch, args=(i,))
+               for i in range(len(ranges))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        os.remove(seg_file)
+        raise errors[0]
+    meter.close()
+    sha256 = digest.hexdigest()
+    _finalize(seg_file, dest_file)
+    return sha256
+
+
+# Errors after which an HTTP transfer is worth retrying.
+HTTP_ERRORS = (urllib2.URLError, socket.error, EOFError)
+
+
+def _http_open(url, timeout, start=0):
+    """Response to a GET of `url`, from byte `start`.
+
+    Raises:
+        urllib2.HTTPError: Not retried if a client error, e.g. 404.
+    """
+    request = urllib2.Request(url)
+    if start:
+        request.add_header('Range', 'bytes=%i-' % start)
+    return urllib2.urlopen(request, timeout=timeout)
+
+
+def http_download(url, dest_file, blocksize, retries, timeout=60,
+                  progress=True, throttle=None):
+    """Download `url` to `dest_file`, resuming interrupted transfers.
+
+    Like `ftp_download`, data is written to `dest_file` + PART_EXT, and
+    resumed with a Range request after a dropped connection, up to
+    `retries` times. Errors before the transfer started are raised.
+
+    Returns:
+        str : SHA-256 hex digest of the file.
+    """
+    logger = logging.getLogger(__name__)
+    part_file = dest_file + PART_EXT
+    meter = None
+    attempt = 0
+    while True:
+        rest = _getsize(part_file)
+        try:
+            response = _http_open(url, timeout, start=rest)
+            if rest and response.getcode() != 206:
+                logger.debug("Range ignored, restarting %s", url)
+                rest = 0
+            length = response.info().getheader('Content-Length')
+            total = rest + int(length) if length is not None else None
+            if meter is None:
+                meter = Progress(total=total, done=rest, enabled=progress,
+                                 throttle=throttle)
+            else:
+                meter.done = rest
+            digest = (file_digest(part_file, blocksize, size=rest) if rest
+                      else hashlib.sha256())
+            with open(part_file, 'ab' if rest else 'wb') as fh:
+                fh.truncate(rest)
+                for block in iter(lambda: response.read(blocksize), b''):
+                    fh.write(block)
+                    digest.update(block)
+                    meter.update(len(block))
+                received = fh.tell()
+            if total is not None and received != total:
+                raise EOFError("Connection closed at byte %i" % received)
+            break
+        except HTTP_ERRORS as e:
+            # Only dropped transfers are retried, so that the caller can
+            # quickly fall back to another source if the server is down.
+            if meter is None or (isinstance(e, urllib2.HTTPError)
+                                 and e.code < 500):
+                raise
+            attempt += 1
+            if attempt > retries:
+                raise
+            print("Transfer interrupted (%s), resuming..." % e)
+            time.sleep(min(2 ** attempt, 30))
+    meter.close()
+    _finalize(part_file, dest_file)
+    return digest.hexdigest()
+
+
+def http_stream(url, write, blocksize, timeout=60, progress=True,
+                throttle=None):
+    """Pass the content of `url` to `write` as it is received.
+
+    Returns:
+        str : SHA-256 hex digest of the content.
+    """
+    response = _http_open(url, timeout)
+    length = response.info().getheader('Content-Length')
+    meter = Progress(total=int(length) if length is not None else None,
+                     enabled=progress, throttle=throttle)
+    digest = hashlib.sha256()
+    for block in iter(lambda: response.read(blocksize), b''):
+        write(block)
+        digest.update(block)
+        meter.update(len(block))
+    meter.close()
+    if length is not None and meter.done != int(length):
+        raise EOFError("Connection closed at byte %i" % meter.done)
+    return digest.hexdigest()
+
+
+def is_streamable(filename):
+    """Whether `filename` can be extracted while it is being received."""
+    return filename.lower().endswith(STREAMABLE_EXTS)
+
+
+def _is_within(directory, path):
+    directory = os.path.realpath(directory)
+    path = os.path.realpath(path)
+    return path == directory or path.startswith(
+            directory.rstrip(os.sep) + os.sep)
+
+
+def _checked_members(tar, output_dir):
+    """Members of `tar`, checked one at a time as they are read."""
+    for member in tar:
+        target = os.path.join(output_dir, member.name)
+        if member.issym():
+            link = os.path.join(os.path.dirname(target), member.linkname)
+        elif member.islnk():
+            link = os.path.join(output_dir, member.linkname)
+        else:
+            link = target
+        if (not _is_within(output_dir, target)
+                or not _is_within(output_dir, link) or member.isdev()):
+            raise tarfile.ExtractError("Unsafe member in archive: %s"
+                                       % member.name)
+        yield member
+
+
+def extract_tar(tar, output_dir):
+    """Extract `tar` to `output_dir`.
+
+    Members with absolute paths, paths or link targets outside of
+    `output_dir`, and devices are refused before anything of theirs is
+    written.
+
+    Raises:
+        tarfile.ExtractError: On such a member.
+    """
+    tar.extractall(output_dir, _checked_members(tar, output_dir))
+
+
+class StreamExtractor(object):
+    """Extract a tar archive from the bytes written to it.
+
+    Extraction runs in a background thread reading from a pipe, so that it
+    progresses as fast as the data arrives. The archive is optionally kept,
+    i.e. teed to `tee_file`.
+
+    Args:
+        output_dir (str): Directory the archive is extracted to.
+        tee_file (str): Where to keep a copy of the archive, if at all.
+    """
+
+    def __init__(self, output_dir, tee_file=None):
+        self.output_dir = output_dir
+        self.tee_file = tee_file
+        self.error = None
+        read_fd, write_fd = os.pipe()
+        self._reader = os.fdopen(read_fd, 'rb')
+        self._writer = os.fdopen(write_fd, 'wb')
+        self._tee = None
+        if tee_file is not None:
+            self._tee = open(tee_file + PART_EXT, 'wb')
+        self._thread = threading.Thread(target=self._extract)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _extract(self):
+        try:
+            # TarFile is no context manager on Python 2.6.
+            with contextlib.closing(tarfile.open(fileobj=self._reader,
+                                                 mode='r|*')) as tar:
+                extract_tar(tar, self.output_dir)
+            # Drain the end-of-archive padding so the writer never blocks.
+            while self._reader.read(65536):
+                pass
+        except (tarfile.TarError, EnvironmentError) as e:
+            self.error = e
+        finally:
+            self._reader.close()
+
+    def write(self, data):
+        if self._tee is not None:
+            self._tee.write(data)
+        try:
+            self._writer.write(data)
+        except EnvironmentError:
+            # Broken pipe: the extraction thread gave up.
+            self._thread.join()
+            raise self.error or tarfile.ReadError("Extraction stopped")
+
+    def close(self):
+        """Wait for the extraction to complete.
+
+        Raises:
+            tarfile.TarError, EnvironmentError: If the extraction failed.
+        """
+        self._writer.close()
+        self._thread.join()
+        if self._tee is not None:
+            self._tee.close()
+        if self.error is not None:
+            raise self.error
+        if self._tee is not None:
+            _finalize(self.tee_file + PART_EXT, self.tee_file)
+
+    def abort(self):
+        """Stop the extraction and remove whatever was written."""
+        try:
+            self._writer.close()
+        except EnvironmentError:
+            pass
+        self._thread.join()
+        if self._tee is not None:
+            self._tee.close()
+            os.remove(self.tee_file + PART_EXT)
+        shutil.rmtree(self.output_dir, ignore_errors=True)
+
+
+def ftp_stream(ftp, ftp_file, write, blocksize, progress=True, throttle=None):
+    """Pass the content of `ftp_file` to `write` as it is received.
+
+    Returns:
+        str : SHA-256 hex digest of the content.
+    """
+    meter = Progress(total=ftp_size(ftp, ftp_file), enabled=progress,
+                     throttle=throttle)
+    digest = hashlib.sha256()
+
+    def callback(block):
+        write(block)
+        digest.update(block)
+        meter.update(len(block))
+    ftp.retrbinary('RETR ' + ftp_file, callback, blocksize)
+    meter.close()
+    return digest.hexdigest()
+
+
+def file_stream(src, write, blocksize, progress=True, throttle=None):
+    """Pass the content of the `src` file to `write` as it is read.
+
+    Returns:
+        str : SHA-256 hex digest of the content.
+    """
+    meter = Progress(total=os.path.getsize(src), enabled=progress,
+                     throttle=throttle)
+    digest = hashlib.sha256()
+    with open(src, 'rb') as fh:
+        for block in iter(lambda: fh.read(blocksize), b''):
+            write(block)
+            digest.update(block)
+            meter.update(len(block))
+    meter.close()
+    return digest.hexdigest()
+
+
+def _libc_copies():
+    """Functions copying between file descriptors in the kernel, best
+    first: copy_file_range, then sendfile.
+
+    Python 2 has neither os.copy_file_range nor os.sendfile, so they are
+    called from the C library, where they exist (copy_file_range since
+    glibc 2.27).
+
+    Returns:
+        list : Functions (in_fd, out_fd, pos, count) -> bytes copied, which
+            raise OSError. Empty if not on Linux.
+    """
+    if not sys.platform.startswith('linux'):
+        return []
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+    except (ImportError, OSError):
+        return []
+    offset_p = ctypes.POINTER(ctypes.c_int64)
+
+    def check(n):
+        if n < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code))
+        return n
+
+    copies = []
+    copy_file_range = getattr(libc, 'copy_file_range', None)
+    if copy_file_range is not None:
+        copy_file_range.argtypes = (ctypes.c_int, offset_p, ctypes.c_int,
+                                    offset_p, ctypes.c_size_t, ctypes.c_uint)
+        # ssize_t: Python 2.6 has no c_ssize_t.
+        copy_file_range.restype = ctypes.c_long
+
+        def copy_range(in_fd, out_fd, pos, count):
+            in_pos, out_pos = ctypes.c_int64(pos), ctypes.c_int64(pos)
+            return check(copy_file_range(in_fd, ctypes.byref(in_pos),
+                                         out_fd, ctypes.byref(out_pos),
+                                         count, 0))
+        copies.append(copy_range)
+    sendfile = getattr(libc, 'sendfile64', None)
+    if sendfile is not None:
+        sendfile.argtypes = (ctypes.c_int, ctypes.c_int, offset_p,
+                             ctypes.c_size_t)
+        sendfile.restype = ctypes.c_long
+
+        def send(in_fd, out_fd, pos, count):
+            # Writes at the position of out_fd, which is not shared with
+            # the other ranges: each has its own file handle.
+            os.lseek(out_fd, pos, os.SEEK_SET)
+            return check(sendfile(out_fd, in_fd,
+                                  ctypes.byref(ctypes.c_int64(pos)), count))
+        copies.append(send)
+    return copies
+
+
+_kernel_copies = None
+
+
+def _zero_copy_range(fin, fout, pos, end, chunk, meter):
+    """Copy [pos, end) between file objects without going through user space.
+
+    Uses copy_file_range, or sendfile, where the platform provides them, see
+    `_libc_copies`.
+
+    Returns:
+        bool: False if not supported, in which case nothing was copied.
+    """
+    global _kernel_copies
+    if _kernel_copies is None:
+        _kernel_copies = _libc_copies()
+    in_fd, out_fd = fin.fileno(), fout.fileno()
+    for copy in _kernel_copies:
+        first = True
+        while pos < end:
+            try:
+                n = copy(in_fd, out_fd, pos, min(chunk, end - pos))
+            except OSError as e:
+                if first and e.errno in (errno.EXDEV, errno.EINVAL,
+                                         errno.ENOSYS, errno.EOPNOTSUPP):
+                    # E.g. across file systems: try the next one.
+                    break
+                raise
+            if n == 0:
+                raise EOFError("Source truncated at byte %i" % pos)
+            first = False
+            pos += n
+            meter.update(n)
+        else:
+            return True
+    return False
+
+
+def _range_digest(path, start, end, blocksize):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fh:
+        fh.seek(start)
+        while start < end:
+            block = fh.read(min(blocksize, end - start))
+            if not block:
+                break
+            digest.update(block)
+            start += len(block)
+    return digest.hexdigest()
+
+
+class _CopyState(object):
+    """Bytes copied in each range of a partial copy, saved next to it.
+
+    Every range is copied by its own thread, with its own file handle. The
+    bytes of a range are only counted in `done`, and so saved, once that
+    thread flushed them to disk.
+    """
+
+    def __init__(self, path, src, ranges):
+        self.path = path
+        stat = os.stat(src)
+        self.source = dict(size=stat.st_size, mtime=stat.st_mtime)
+        self.ranges = ranges
+        self.done = [0] * len(ranges)
+        # Written but maybe not flushed yet, by range.
+        self._pending = [0] * len(ranges)
+        self._flushed = [time.time()] * len(ranges)
+        self._lock = threading.Lock()
+        self._saved = time.time()
+
+    def load(self):
+        """Restore the progress of a previous copy of the same source."""
+        try:
+            with open(self.path, 'r') as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            return
+        if (state['source'] == self.source
+                and state['ranges'] == [list(r) for r in self.ranges]):
+            self.done = state['done']
+
+    def advance(self, index, nbytes, fout, interval=5):
+        """Account for `nbytes` written to `fout` in range `index`.
+
+        Only called by the thread of the range. Every `interval` seconds,
+        it flushes `fout` and commits the bytes written so far.
+        """
+        self._pending[index] += nbytes
+        if time.time() - self._flushed[index] > interval:
+            fout.flush()
+            os.fsync(fout.fileno())
+            self.commit(index, interval)
+
+    def commit(self, index, interval=5):
+        """Count the bytes of range `index` which are on disk, and save the
+        progress of every range if not done for `interval` seconds."""
+        self._flushed[index] = time.time()
+        with self._lock:
+            self.done[index] += self._pending[index]
+            self._pending[index] = 0
+            if time.time() - self._saved > interval:
+                self.save()
+
+    def save(self):
+        with open(self.path, 'w') as f:
+            json.dump(dict(source=self.source, ranges=self.ranges,
+                           done=self.done), f)
+        self._saved = time.time()
+
+
+def copy_file(src, dest, blocksize, readers=1, verify=True, progress=True,
+              throttle=None):
+    """Copy `src` to `dest` with several readers, resuming partial copies.
+
+    The file is split in `readers` ranges copied in parallel, each with its
+    own file handles. Data is written to `dest` + PART_EXT, and the progress
+    of every range is saved to `dest` + STATE_EXT, so that an interrupted
+    copy resumes where it stopped. On Linux, ranges are copied in the kernel
+    with copy_file_range or sendfile when possible.
+
+    If `verify` is True, each range is checked against a SHA-1 of the source
+    bytes computed while they were read (or re-read after a zero-copy),
+    before `dest` is renamed into place. Bytes copied by an earlier,
+    interrupted, run are not verified again.
+
+    Returns:
+        str : SHA-256 hex digest of the file, computed while copying, see
+            `OrderedDigest`. Ranges copied by the kernel are read back.
+
+    Raises:
+        TransferError: If the copy fails or does not verify. In the former
+            case, the partial copy is kept to be resumed.
+    """
+    logger = logging.getLogger(__name__)
+    size = os.path.getsize(src)
+    if _is_complete(dest, size):
+        logger.debug("Already copied: %s", dest)
+        return file_digest(dest, blocksize).hexdigest()
+    part_file = dest + PART_EXT
+    ranges = split_ranges(size, max(1, readers)) if size else []
+    state = _CopyState(dest + STATE_EXT, src, ranges)
+    if os.path.exists(part_file):
+        state.load()
+        if os.path.getsize(part_file) != size:
+            # Stale, e.g. from another version of the source.
+            state.done = [0] * len(ranges)
+            with open(part_file, 'r+b') as fh:
+                fh.truncate(size)
+    else:
+        with open(part_file, 'wb') as fh:
+            fh.truncate(size)
+    if any(state.done):
+        logger.debug("Resuming copy of %s", src)
+
+    meter = Progress(total=size, done=sum(state.done), enabled=progress,
+                     throttle=throttle)
+    # Large kernel copies would make a throttled copy bursty.
+    chunk = blocksize if throttle else 16 * blocksize
+    errors = []
+    whole = OrderedDigest(part_file, ranges, blocksize)
+
+    def copy(index, fin, fout, pos):
+        """Copy the rest of range `index` from `pos`.
+
+        Returns:
+            str : SHA-1 of the source bytes, if `verify`.
+        """
+        start, end = ranges[index]
+        resumed_at = pos
+        if _zero_copy_range(fin, fout, pos, end, chunk, meter):
+            state.advance(index, end - pos, fout)
+            return (_range_digest(src, resumed_at, end, blocksize)
+                    if verify else None)
+        digest = hashlib.sha1()
+        fin.seek(pos)
+        fout.seek(pos)
+        while pos < end:
+            block = fin.read(min(blocksize, end - pos))
+            if not block:
+                raise EOFError("Source truncated at byte %i" % pos)
+            fout.write(block)
+            if verify:
+                digest.update(block)
+            whole.update(index, pos, block, fout)
+            pos += len(block)
+            meter.update(len(block))
+            state.advance(index, len(block), fout)
+        return digest.hexdigest()
+
+    def copy_range(index):
+        start, end = ranges[index]
+        resumed_at = start + state.done[index]
+        try:
+            # Nested: Python 2.6 has no multiple context managers.
+            with open(src, 'rb') as fin:
+                with open(part_file, 'r+b') as fout:
+                    expected = copy(index, fin, fout, resumed_at)
+            # Closed, so flushed. On errors, the bytes not committed yet
+            # are copied again by the next run.
+            state.commit(index)
+            whole.complete(index)
+            if verify and expected != _range_digest(part_file, resumed_at,
+                                                    end, blocksize):
+                errors.append(TransferError(
+                        "Checksum mismatch in bytes %i-%i" % (resumed_at,
+                                                             end)))
+        except (EnvironmentError, EOFError) as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=copy_range, args=(i,))
+               for i in range(len(ranges))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        if any(isinstance(e, TransferError) for e in errors):
+            # Corrupted: resuming would keep the bad bytes. The state is
+            # only saved every few seconds, so it may not exist.
+            _remove(part_file)
+            _remove(state.path)
+        else:
+            state.save()
+        raise TransferError(str(errors[0]))
+    meter.close()
+    sha256 = whole.hexdigest()
+    _finalize(part_file, dest)
+    _remove(state.path)
+    return sha256
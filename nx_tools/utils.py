@@ -5,12 +5,15 @@
     Utility functions.
 """
 import collections
+import contextlib
 import json
 import logging
 import os
 from pprint import pformat
+import subprocess
 
-from .constants import DEFAULT_CONFIG_PATH, USER_CONFIG_PATH
+from .constants import (CONFIG_CACHE_PATH, DEFAULT_CONFIG_PATH,
+                        USER_CONFIG_PATH)
 from .exceptions import UserConfigNotFound
 
 
@@ -19,7 +22,109 @@ def ensure_dir_exists(directory):
     logger = logging.getLogger(__name__)
     if not os.path.exists(directory):
         os.makedirs(directory)
-        logger.info("Directory created: %s" % directory)
+        logger.info("Directory created: %s", directory)
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on the file `path`, created if missing.
+
+    The lock is shared by all processes, and by the threads of a process
+    as long as each opens its own lock. It is not reentrant.
+    """
+    with open(path, 'a+') as f:
+        if os.name == 'nt':
+            import msvcrt
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except IOError:
+                    # LK_LOCK gives up after 10 seconds: keep waiting.
+                    pass
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class LazyFormat(object):
+    """Format `func(*args)` only when converted to a string.
+
+    Meant as an argument of logging calls, which only format their message
+    when it is emitted, e.g. `logger.debug("%s", LazyFormat(pformat, obj))`.
+    """
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
+
+def lazy_pformat(obj):
+    """`pformat(obj)`, formatted only when logged."""
+    return LazyFormat(pformat, obj)
+
+
+def spawn_background(args, log_path=None):
+    """Start `args` in a detached, low priority, process.
+
+    Args:
+        log_path (str): File receiving the output of the process, which is
+            discarded by default.
+    """
+    kwargs = {}
+    if os.name == 'nt':
+        DETACHED_PROCESS = 0x00000008
+        CREATE_NEW_PROCESS_GROUP = 0x00000200
+        IDLE_PRIORITY_CLASS = 0x00000040
+        kwargs['creationflags'] = (DETACHED_PROCESS | CREATE_NEW_PROCESS_GROUP
+                                   | IDLE_PRIORITY_CLASS)
+    else:
+        def detach():
+            os.setsid()
+            os.nice(19)
+        kwargs['preexec_fn'] = detach
+    if log_path:
+        ensure_dir_exists(os.path.dirname(log_path))
+        output = open(log_path, 'a')
+    else:
+        output = open(os.devnull, 'w')
+    devnull = open(os.devnull, 'r')
+    try:
+        # Python 2 cannot close the handles on Windows when redirecting.
+        subprocess.Popen(args, stdin=devnull, stdout=output,
+                         stderr=subprocess.STDOUT, close_fds=os.name != 'nt',
+                         **kwargs)
+    finally:
+        devnull.close()
+        output.close()
+
+
+def hard_link(source, link_name):
+    """Create a hard link, also on Windows with Python 2.
+
+    Raises:
+        OSError
+    """
+    if hasattr(os, 'link'):
+        os.link(source, link_name)
+        return
+    import ctypes
+    if not ctypes.windll.kernel32.CreateHardLinkW(
+            unicode(link_name), unicode(source), None):
+        raise ctypes.WinError()
 
 
 def load_json(filepath):
@@ -78,24 +183,76 @@ def read_user_config():
         raise UserConfigNotFound("Not a JSON object")
 
 
-def read_config():
+def _config_key(version):
+    """What the merged configuration depends on: the package version and
+    the mtime and size of both configuration files."""
+    key = [version]
+    for path in (DEFAULT_CONFIG_PATH, USER_CONFIG_PATH):
+        try:
+            st = os.stat(path)
+        except OSError:
+            key.extend([None, None])
+        else:
+            key.extend([st.st_mtime, st.st_size])
+    return key
+
+
+def read_config(version=None):
     """Read a combined user/default config.
 
-    User takes precedence over default.
+    User takes precedence over default. With a `version`, the configuration
+    is validated and cached in CONFIG_CACHE_PATH, and only merged again when
+    the version or either file changes.
+
+    Args:
+        version (str): Version of the package.
 
     Returns:
         dict
+
+    Raises:
+        ConfigError: If the configuration does not match its schema.
     """
+    if version is None:
+        return _merge_config()
+    logger = logging.getLogger(__name__)
+    key = _config_key(version)
+    try:
+        cached = load_json(CONFIG_CACHE_PATH)
+        if cached['key'] == key:
+            return cached['config']
+    except (IOError, ValueError, KeyError, TypeError):
+        pass
+    logger.debug("Merging configuration")
+    config = _merge_config()
+    # Only imported when the cache is rebuilt.
+    from .config_schema import validate
+    validate(config)
+    tmp = '%s.%i.tmp' % (CONFIG_CACHE_PATH, os.getpid())
+    try:
+        ensure_dir_exists(os.path.dirname(CONFIG_CACHE_PATH))
+        with open(tmp, 'w') as f:
+            json.dump(dict(key=key, config=config), f,
+                      separators=(',', ':'))
+        if os.path.exists(CONFIG_CACHE_PATH):
+            os.remove(CONFIG_CACHE_PATH)
+        os.rename(tmp, CONFIG_CACHE_PATH)
+    except EnvironmentError as e:
+        logger.debug("Could not cache the configuration: %s", e)
+    return config
+
+
+def _merge_config():
     logger = logging.getLogger(__name__)
     default = read_default_config()
     try:
         user = read_user_config()
-        logger.debug("User config:\n%s" % pformat(user))
+        logger.debug("User config:\n%s", lazy_pformat(user))
     except UserConfigNotFound as e:
         user = {}
-        logger.debug("User Config ignored: %s" % e)
+        logger.debug("User Config ignored: %s", e)
     config = recursive_dict_update(default, user)
-    logger.debug("Result config:\n%s" % pformat(config))
+    logger.debug("Result config:\n%s", lazy_pformat(config))
     return config
 
 
@@ -120,10 +277,13 @@ def pformat_cli_args(locs):
         locs (dict): Local symbol table
 
     Returns:
-        str
+        LazyFormat : Only formatted if logged.
     """
-    return 'ARGS\n' + '\n'.join(('%s : %s' % (k, v) for k, v in locs.iteritems()
-                                if k[:4] != 'conf' and k[:3] != 'log'))
+    def fmt(locs):
+        return 'ARGS\n' + '\n'.join(('%s : %s' % (k, v)
+                                     for k, v in locs.iteritems()
+                                     if k[:4] != 'conf' and k[:3] != 'log'))
+    return LazyFormat(fmt, dict(locs))
 
 
 def _get_roots(config, nx_version, key):
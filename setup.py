@@ -57,7 +57,7 @@ setup(
     description=('A command-line utility to automate NX update and launch'),
     license='MIT',
     version=version,
-    packages=find_packages(),
+    packages=find_packages(exclude=['tests', 'tests.*']),
     entry_points={
         'console_scripts': [
             'nx_tools = nx_tools.__main__:nx_tools',
@@ -66,6 +66,7 @@ setup(
     },
     scripts=ahk_exe,
     include_package_data=True,
+    zip_safe=False,
     install_requires=[
         'click==5.1',
         'pyreadline==2.0'
@@ -0,0 +1,24 @@
+"""
+Tests, run with `make test`.
+
+The files of nx_tools are kept in a temporary NX_TOOLS_ROOT, set before any
+test module imports nx_tools.
+"""
+import atexit
+import os
+import shutil
+import tempfile
+
+USER_ROOT = tempfile.mkdtemp(prefix='nx_tools_tests.')
+os.environ['NX_TOOLS_ROOT'] = USER_ROOT
+atexit.register(shutil.rmtree, USER_ROOT, True)
+
+
+def clear_user_root():
+    """Remove the files written to NX_TOOLS_ROOT by earlier tests."""
+    for name in os.listdir(USER_ROOT):
+        path = os.path.join(USER_ROOT, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
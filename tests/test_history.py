@@ -0,0 +1,120 @@
+import json
+import os
+import time
+import unittest
+
+from nx_tools import history
+from nx_tools.constants import HISTORY_DIR, HISTORY_PATH
+
+from . import clear_user_root
+
+# Not running: launched before the system started.
+DEAD_PIDS = range(1000001, 1000008)
+
+
+def entry(pid, launched=0, build='NX1102_0001'):
+    return dict(PID=pid, nx_version='nx11', build=build, patch='', name='',
+                time=launched)
+
+
+class HistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        clear_user_root()
+        self.segment_records = history.HISTORY_SEGMENT_RECORDS
+
+    def tearDown(self):
+        history.HISTORY_SEGMENT_RECORDS = self.segment_records
+
+    def test_add_entry(self):
+        history.add_entry(entry(1000001, build='NX1102_0001'))
+        history.add_entries([(entry(1000002), ()),
+                             (entry(1000001, build='NX1102_0002'), ())])
+        self.assertEqual([e['PID'] for e in history.entries()],
+                         [1000001, 1000002, 1000001])
+        self.assertEqual(len(history.entries(limit=2)), 2)
+        self.assertEqual(history.find(1000001)['build'], 'NX1102_0002')
+        self.assertEqual(history.find(1000003), None)
+
+    def test_running_entries(self):
+        history.add_entry(entry(os.getpid(), time.time()))
+        history.add_entry(entry(1000001))
+        self.assertEqual([e['PID'] for e in history.running_entries()],
+                         [os.getpid()])
+
+    def test_last_used(self):
+        path = os.path.join(HISTORY_DIR, 'NX1102_0001')
+        history.add_entry(entry(1000001, 42), [path])
+        self.assertEqual(history.last_used(path + os.sep), 42)
+        self.assertEqual(history.last_used(path + '_other'), None)
+
+    def test_compaction(self):
+        history.HISTORY_SEGMENT_RECORDS = 3
+        history.add_entry(entry(os.getpid(), time.time()))
+        for pid in DEAD_PIDS:
+            history.add_entry(entry(pid))
+        self.assertEqual(sorted(os.listdir(HISTORY_DIR)),
+                         ['history.1.jsonl.gz', 'history.2.jsonl.gz',
+                          'history.3.jsonl', 'index.json', 'lock'])
+        # Nothing is lost.
+        self.assertEqual([e['PID'] for e in history.entries()],
+                         list(reversed(DEAD_PIDS)) + [os.getpid()])
+        # Launches of compacted segments are only found if still running.
+        self.assertEqual(history.find(os.getpid())['PID'], os.getpid())
+        self.assertEqual(history.find(DEAD_PIDS[0]), None)
+        self.assertEqual(history.find(DEAD_PIDS[-1])['PID'], DEAD_PIDS[-1])
+
+    def test_interrupted_compaction(self):
+        history.HISTORY_SEGMENT_RECORDS = 3
+        for pid in DEAD_PIDS[:3]:
+            history.add_entry(entry(pid))
+        # Stopped before the plain copy was removed.
+        with open(os.path.join(HISTORY_DIR, 'history.1.jsonl'), 'w') as f:
+            f.write(json.dumps(entry(1000009)) + '\n')
+        os.remove(os.path.join(HISTORY_DIR, 'index.json'))
+        history.add_entry(entry(DEAD_PIDS[3]))
+        self.assertEqual([e['PID'] for e in history.entries()],
+                         list(reversed(DEAD_PIDS[:4])))
+        self.assertFalse(os.path.exists(os.path.join(HISTORY_DIR,
+                                                     'history.1.jsonl')))
+
+    def test_index_behind(self):
+        history.add_entry(entry(1000001))
+        # Written by a process which stopped before saving the index.
+        segment = os.path.join(HISTORY_DIR, 'history.1.jsonl')
+        with open(segment, 'a') as f:
+            f.write(json.dumps(entry(1000002)) + '\n')
+        self.assertEqual(history.find(1000002)['PID'], 1000002)
+
+    def test_line_cut_short(self):
+        history.add_entry(entry(1000001))
+        segment = os.path.join(HISTORY_DIR, 'history.1.jsonl')
+        with open(segment, 'a') as f:
+            f.write('{"PID": 10')
+        history.add_entry(entry(1000002))
+        self.assertEqual([e['PID'] for e in history.entries()],
+                         [1000002, 1000001])
+        self.assertEqual(history.find(1000002)['PID'], 1000002)
+
+    def write_ring_buffer(self, pids):
+        records = dict((str(i + 1), entry(pid)) for i, pid in enumerate(pids))
+        records['last_update'] = len(pids)
+        with open(HISTORY_PATH, 'w') as f:
+            json.dump(records, f)
+
+    def test_migration(self):
+        self.write_ring_buffer(DEAD_PIDS[:3])
+        # Left by an earlier migration.
+        with open(HISTORY_PATH + '.migrated', 'w') as f:
+            f.write('{}')
+        history.add_entry(entry(1000009))
+        self.assertEqual([e['PID'] for e in history.entries()],
+                         [1000009] + list(reversed(DEAD_PIDS[:3])))
+        self.assertFalse(os.path.exists(HISTORY_PATH))
+        with open(HISTORY_PATH + '.migrated') as f:
+            self.assertEqual(len(json.load(f)), 4)
+        self.assertEqual(history.find(DEAD_PIDS[0])['PID'], DEAD_PIDS[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from nx_tools import inventory
+
+from . import clear_user_root
+
+_RECORD_CODE = """
+import os, sys
+from nx_tools import inventory
+root, prefix = sys.argv[1:]
+for i in range(10):
+    name = '%s_%i' % (prefix, i)
+    os.mkdir(os.path.join(root, name))
+    inventory.Inventory().record(root, name, status=inventory.EXTRACTING)
+    inventory.Inventory().record(root, name, status=inventory.EXTRACTED)
+"""
+
+
+class InventoryTest(unittest.TestCase):
+
+    def setUp(self):
+        clear_user_root()
+        self.root = tempfile.mkdtemp()
+        self.inventory = inventory.Inventory()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def make_build(self, name):
+        ugii = os.path.join(self.root, name, 'kits', 'ugii')
+        os.makedirs(ugii)
+        open(os.path.join(ugii, 'ugraf.exe'), 'w').close()
+
+    def test_record(self):
+        self.make_build('NX1102_0001')
+        self.inventory.record(self.root, 'NX1102_0001',
+                              status=inventory.EXTRACTING,
+                              source='NX1102_0001.7z', size=10)
+        self.assertEqual(self.inventory.installed(self.root), set())
+        self.inventory.record(self.root, 'NX1102_0001',
+                              status=inventory.EXTRACTED)
+        self.assertEqual(self.inventory.installed(self.root),
+                         set(['NX1102_0001']))
+        entry = inventory.Inventory().entries(self.root)['NX1102_0001']
+        self.assertEqual(entry['status'], inventory.EXTRACTED)
+        self.assertEqual(entry['source'], 'NX1102_0001.7z')
+        self.assertEqual(entry['size'], 10)
+        self.assertEqual(entry['kind'], inventory.BUILD)
+        self.assertEqual(entry['ugraf'],
+                         [os.path.join('kits', 'ugii', 'ugraf.exe')])
+
+    def test_rescan(self):
+        self.make_build('NX1102_0001')
+        self.assertEqual(self.inventory.installed(self.root),
+                         set(['NX1102_0001']))
+        os.makedirs(os.path.join(self.root, 'nx1102_patch', 'tmg'))
+        # Make sure the mtime of the root changes.
+        mtime = os.path.getmtime(self.root) + 10
+        os.utime(self.root, (mtime, mtime))
+        entries = self.inventory.entries(self.root)
+        self.assertEqual(sorted(entries), ['NX1102_0001', 'nx1102_patch'])
+        self.assertEqual(entries['NX1102_0001']['status'], inventory.FOUND)
+        self.assertEqual(entries['nx1102_patch']['kind'], inventory.PATCH)
+
+    def test_unchanged_root_is_not_rescanned(self):
+        # Whole seconds survive utime.
+        mtime = int(time.time()) - 10
+        os.utime(self.root, (mtime, mtime))
+        self.inventory.entries(self.root)
+        os.mkdir(os.path.join(self.root, 'NX1102_0001'))
+        os.utime(self.root, (mtime, mtime))
+        self.assertEqual(self.inventory.entries(self.root), {})
+
+    def test_concurrent_processes(self):
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(
+                os.path.dirname(os.path.abspath(inventory.__file__))))
+        processes = [subprocess.Popen([sys.executable, '-c', _RECORD_CODE,
+                                       self.root, str(i)], env=env)
+                     for i in range(4)]
+        for process in processes:
+            self.assertEqual(process.wait(), 0)
+        entries = self.inventory.entries(self.root)
+        self.assertEqual(len(entries), 40)
+        self.assertEqual(set(entry['status'] for entry in entries.values()),
+                         set([inventory.EXTRACTED]))
+
+
+if __name__ == '__main__':
+    unittest.main()
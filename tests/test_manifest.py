@@ -0,0 +1,145 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from nx_tools import manifest
+from nx_tools import transfer
+
+from . import clear_user_root
+
+
+class OrderedDigestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'archive.7z')
+        self.data = os.urandom(10000)
+        self.ranges = transfer.split_ranges(len(self.data), 3)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def create(self, content=b''):
+        with open(self.path, 'wb') as f:
+            f.write(content)
+            f.truncate(len(self.data))
+        return transfer.OrderedDigest(self.path, self.ranges, 1000)
+
+    def write_range(self, digest, index, start=None, blocksize=700):
+        """Write range `index` from `start` like `transfer.copy_file`."""
+        start = self.ranges[index][0] if start is None else start
+        end = self.ranges[index][1]
+        with open(self.path, 'r+b') as fh:
+            fh.seek(start)
+            while start < end:
+                block = self.data[start:min(start + blocksize, end)]
+                fh.write(block)
+                digest.update(index, start, block, fh)
+                start += len(block)
+        digest.complete(index)
+
+    def expected(self):
+        return hashlib.sha256(self.data).hexdigest()
+
+    def test_in_order(self):
+        digest = self.create()
+        for index in range(len(self.ranges)):
+            self.write_range(digest, index)
+        self.assertEqual(digest.hexdigest(), self.expected())
+
+    def test_out_of_order(self):
+        digest = self.create()
+        for index in reversed(range(len(self.ranges))):
+            self.write_range(digest, index)
+        self.assertEqual(digest.pos, len(self.data))
+        self.assertEqual(digest.hexdigest(), self.expected())
+
+    def test_resumed(self):
+        # The first bytes of every range were written by an earlier run.
+        done = 1234
+        content = bytearray(len(self.data))
+        for start, _ in self.ranges:
+            content[start:start + done] = self.data[start:start + done]
+        digest = self.create(bytes(content))
+        for index, (start, _) in enumerate(self.ranges):
+            self.write_range(digest, index, start + done)
+        self.assertEqual(digest.pos, len(self.data))
+        self.assertEqual(digest.hexdigest(), self.expected())
+
+    def test_incomplete(self):
+        # A range left incomplete is hashed from the file.
+        digest = self.create()
+        self.write_range(digest, 0)
+        self.write_range(digest, 2)
+        with open(self.path, 'r+b') as fh:
+            start, end = self.ranges[1]
+            fh.seek(start)
+            fh.write(self.data[start:end])
+        self.assertEqual(digest.hexdigest(), self.expected())
+
+
+class ManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        clear_user_root()
+        self.tmp = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp, 'builds')
+        self.item = os.path.join(self.root, 'NX1102_0001')
+        os.makedirs(os.path.join(self.item, 'kits'))
+        for name, content in (('a.dll', b'a' * 100), ('b.dll', b'b' * 10)):
+            with open(os.path.join(self.item, 'kits', name), 'wb') as f:
+                f.write(content)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_update(self):
+        self.assertEqual(manifest.load('NX1102_0001'), None)
+        manifest.update('NX1102_0001', archive='NX1102_0001.7z', size=10,
+                        status=manifest.TRANSFERRED)
+        item_manifest = manifest.update('NX1102_0001', status=manifest.OK)
+        self.assertEqual(item_manifest, manifest.load('NX1102_0001'))
+        self.assertEqual(item_manifest['archive'], 'NX1102_0001.7z')
+        self.assertEqual(item_manifest['size'], 10)
+        self.assertEqual(item_manifest['status'], manifest.OK)
+        self.assertEqual(item_manifest['sha256'], None)
+
+    def test_verify(self):
+        workers = manifest.pool()
+        try:
+            members = manifest.hash_tree(self.item)
+            self.assertEqual(sorted(members), [os.path.join('kits', 'a.dll'),
+                                               os.path.join('kits', 'b.dll')])
+            manifest.update('NX1102_0001', members=members)
+            self.assertEqual(manifest.verify('NX1102_0001', self.root,
+                                             workers), [])
+            self.assertEqual(manifest.load('NX1102_0001')['status'],
+                             manifest.OK)
+
+            with open(os.path.join(self.item, 'kits', 'a.dll'), 'r+b') as f:
+                f.write(b'x')
+            os.remove(os.path.join(self.item, 'kits', 'b.dll'))
+            self.assertEqual(
+                    manifest.verify('NX1102_0001', self.root, workers),
+                    [(os.path.join('kits', 'a.dll'), 'CRC mismatch'),
+                     (os.path.join('kits', 'b.dll'), 'missing')])
+            self.assertEqual(manifest.load('NX1102_0001')['status'],
+                             manifest.CORRUPT)
+        finally:
+            workers.close()
+            workers.join()
+
+    def test_verify_without_manifest(self):
+        workers = manifest.pool()
+        try:
+            self.assertEqual(manifest.verify('NX1102_0001', self.root,
+                                             workers), None)
+        finally:
+            workers.close()
+            workers.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import threading
+import time
+import unittest
+from multiprocessing.pool import ThreadPool
+
+from nx_tools import scheduler
+
+CONFIG = dict(download_slots=1, download_rate_limit=None,
+              download_rate_profiles=[])
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def run_jobs(self, sched, tickets, workers):
+        """Run a transfer per ticket on `workers` threads, like
+        `update.update_all`. Returns the tickets in the order they ran, or
+        None if the jobs did not finish."""
+        order = []
+
+        def job(ticket):
+            with sched.transfer(ticket):
+                order.append(ticket)
+                time.sleep(0.01)
+
+        def run():
+            pool = ThreadPool(workers)
+            try:
+                pool.map(job, tickets)
+            finally:
+                pool.close()
+                pool.join()
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        thread.join(10)
+        if thread.is_alive():
+            return None
+        return order
+
+    def test_more_jobs_than_workers(self):
+        sched = scheduler.Scheduler(CONFIG)
+        # The best ticket is submitted last, and has no thread to run it
+        # until the others are done.
+        tickets = [sched.submit(scheduler.PATCH, size)
+                   for size in (300, 200, 100)]
+        order = self.run_jobs(sched, tickets, workers=1)
+        self.assertEqual(order, tickets)
+
+    def test_more_jobs_than_workers_with_slots(self):
+        sched = scheduler.Scheduler(dict(CONFIG, download_slots=2))
+        tickets = [sched.submit(scheduler.BUILD, size)
+                   for size in (500, 400, 300, 200, 100)]
+        order = self.run_jobs(sched, tickets, workers=4)
+        self.assertEqual(sorted(order), sorted(tickets))
+
+    def test_best_waiting_ticket_first(self):
+        sched = scheduler.Scheduler(CONFIG)
+        build = sched.submit(scheduler.BUILD, 10)
+        patch = sched.submit(scheduler.PATCH, 1000)
+        small = sched.submit(scheduler.PATCH, 10)
+        order = []
+        with sched.transfer(build):
+            threads = []
+            for ticket in (patch, small):
+                def job(ticket=ticket):
+                    with sched.transfer(ticket):
+                        order.append(ticket)
+                thread = threading.Thread(target=job)
+                thread.start()
+                threads.append(thread)
+            while len(sched._waiting) < 2:
+                time.sleep(0.01)
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(order, [small, patch])
+
+    def test_claimed_ticket_first(self):
+        sched = scheduler.Scheduler(CONFIG)
+        build = sched.submit(scheduler.BUILD, 10)
+        patch = sched.submit(scheduler.PATCH, 1000)
+        sched.claim([patch])
+        order = []
+
+        def job(ticket):
+            with sched.transfer(ticket):
+                order.append(ticket)
+        thread = threading.Thread(target=job, args=(build,))
+        thread.start()
+        time.sleep(0.1)
+        # The build waits for the claimed patch.
+        self.assertEqual(order, [])
+        job(patch)
+        thread.join(10)
+        self.assertEqual(order, [patch, build])
+
+    def test_cancel_claimed_ticket(self):
+        sched = scheduler.Scheduler(CONFIG)
+        build = sched.submit(scheduler.BUILD, 10)
+        patch = sched.submit(scheduler.PATCH, 10)
+        sched.claim([patch])
+        sched.cancel(patch)
+        order = self.run_jobs(sched, [build], workers=1)
+        self.assertEqual(order, [build])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+import urllib2
+
+from nx_tools.commands import serve
+
+SIZE = 1000
+
+
+class ParseRangeTest(unittest.TestCase):
+
+    def test_all(self):
+        for header in (None, '', 'bytes=-', 'lines=0-10', 'bytes=0-1,5-6'):
+            self.assertEqual(serve.parse_range(header, SIZE), None, header)
+
+    def test_ranges(self):
+        for header, expected in (('bytes=0-', (0, SIZE)),
+                                 ('bytes=10-19', (10, 20)),
+                                 (' bytes=10-19 ', (10, 20)),
+                                 ('bytes=990-5000', (990, SIZE)),
+                                 ('bytes=-100', (900, SIZE)),
+                                 ('bytes=-5000', (0, SIZE)),
+                                 ('bytes=999-999', (999, SIZE))):
+            self.assertEqual(serve.parse_range(header, SIZE), expected,
+                             header)
+
+    def test_unsatisfiable(self):
+        for header in ('bytes=1000-', 'bytes=20-10', 'bytes=-0'):
+            self.assertEqual(serve.parse_range(header, SIZE), False, header)
+
+
+def _closed_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class CacheServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        share = os.path.join(self.tmp, 'share')
+        os.mkdir(share)
+        self.data = os.urandom(SIZE)
+        with open(os.path.join(share, 'NX1102_0001.7z'), 'wb') as f:
+            f.write(self.data)
+        self.cache_dir = os.path.join(self.tmp, 'cache')
+        config = dict(serve_cache_dir=self.cache_dir,
+                      remote=dict(build=dict(nx11=share),
+                                  patch=dict(nx11='pub')),
+                      copy_blocksize=4096, ftp_blocksize=4096,
+                      ftp_host='127.0.0.1:%i' % _closed_port(),
+                      ftp_timeout=5)
+        self.server = serve.CacheServer(('127.0.0.1', 0), config)
+        self.url = 'http://127.0.0.1:%i/' % self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def request(self, path, method='GET', headers=None):
+        request = urllib2.Request(self.url + path, headers=headers or {})
+        request.get_method = lambda: method
+        try:
+            response = urllib2.urlopen(request, timeout=10)
+        except urllib2.HTTPError as e:
+            return e.code, e.info(), None
+        try:
+            return response.getcode(), response.info(), response.read()
+        finally:
+            response.close()
+
+    def test_get(self):
+        status, headers, body = self.request('build/nx11/NX1102_0001.7z')
+        self.assertEqual(status, 200)
+        self.assertEqual(body, self.data)
+        status, headers, body = self.request(
+                'build/nx11/NX1102_0001.7z', headers=dict(Range='bytes=10-'))
+        self.assertEqual(status, 206)
+        self.assertEqual(headers['Content-Range'], 'bytes 10-999/1000')
+        self.assertEqual(body, self.data[10:])
+        status, headers, _ = self.request(
+                'build/nx11/NX1102_0001.7z', headers=dict(Range='bytes=2000-'))
+        self.assertEqual(status, 416)
+        self.assertEqual(headers['Content-Range'], 'bytes */1000')
+
+    def test_head_does_not_fetch(self):
+        status, headers, _ = self.request('build/nx11/NX1102_0001.7z',
+                                          method='HEAD')
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['Content-Length'], str(SIZE))
+        self.assertFalse(os.path.exists(os.path.join(
+                self.cache_dir, 'build', 'nx11', 'NX1102_0001.7z')))
+
+    def test_not_found(self):
+        for path in ('build/nx11/NX1102_0002.7z', 'build/nx12/NX1202.7z',
+                     'other/nx11/NX1102_0001.7z', 'build/nx11/..'):
+            self.assertEqual(self.request(path)[0], 404, path)
+            self.assertEqual(self.request(path, method='HEAD')[0], 404, path)
+
+    def test_origin_unavailable(self):
+        for method in ('GET', 'HEAD'):
+            status, _, _ = self.request('patch/nx11/nx1102_wntx64.tgz',
+                                        method=method)
+            self.assertEqual(status, 503)
+
+
+if __name__ == '__main__':
+    unittest.main()
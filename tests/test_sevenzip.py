@@ -0,0 +1,59 @@
+import unittest
+
+from nx_tools import sevenzip
+
+LISTING = """
+7-Zip [64] 16.02 : Copyright (c) 1999-2016 Igor Pavlov : 2016-05-21
+
+Listing archive: NX1102_0002.7z
+
+--
+Path = NX1102_0002.7z
+Type = 7z
+Physical Size = 1234
+
+----------
+Path = NX1102_0002
+Size = 0
+Attributes = D....
+CRC =
+
+Path = NX1102_0002/kits/empty
+Size = 0
+Attributes = D....
+CRC =
+
+Path = NX1102_0002/kits/ugraf.exe
+Size = 100
+Attributes = A....
+CRC = 1234ABCD
+
+Path = NX1102_0002/kits/empty.txt
+Size = 0
+Attributes = A....
+CRC =
+
+"""
+
+
+class ListArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.run = sevenzip._run
+        sevenzip._run = lambda command: LISTING.replace('\n', '\r\n')
+
+    def tearDown(self):
+        sevenzip._run = self.run
+
+    def test_list_archive(self):
+        members, dirs = sevenzip.list_archive('NX1102_0002.7z', '7z')
+        self.assertEqual(members, {
+                'NX1102_0002/kits/ugraf.exe': [100, '1234ABCD'],
+                'NX1102_0002/kits/empty.txt': [0, '']})
+        self.assertEqual(dirs, ['NX1102_0002', 'NX1102_0002/kits/empty'])
+        self.assertEqual(sevenzip.list_members('NX1102_0002.7z', '7z'),
+                         members)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from nx_tools import transfer
+from nx_tools.exceptions import TransferError
+
+SIZE = 3 * 64 * 1024 + 123
+
+
+class CopyFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, 'src.7z')
+        self.dest = os.path.join(self.tmp, 'dest.7z')
+        self.data = os.urandom(SIZE)
+        with open(self.src, 'wb') as f:
+            f.write(self.data)
+        self.range_digest = transfer._range_digest
+        self.kernel_copies = transfer._kernel_copies
+
+    def tearDown(self):
+        transfer._range_digest = self.range_digest
+        transfer._kernel_copies = self.kernel_copies
+        shutil.rmtree(self.tmp)
+
+    def copy(self, readers=1):
+        return transfer.copy_file(self.src, self.dest, 4096, readers=readers,
+                                  progress=False)
+
+    def read_dest(self):
+        with open(self.dest, 'rb') as f:
+            return f.read()
+
+    def test_copy(self):
+        for readers in (1, 3):
+            self.check_copy(readers)
+
+    def test_copy_in_user_space(self):
+        transfer._kernel_copies = []
+        for readers in (1, 3):
+            self.check_copy(readers)
+
+    def check_copy(self, readers):
+        sha256 = self.copy(readers)
+        self.assertEqual(self.read_dest(), self.data)
+        self.assertEqual(sha256, hashlib.sha256(self.data).hexdigest())
+        self.assertFalse(os.path.exists(self.dest + transfer.PART_EXT))
+        self.assertFalse(os.path.exists(self.dest + transfer.STATE_EXT))
+        os.remove(self.dest)
+
+    def write_partial(self, prefix, state):
+        with open(self.dest + transfer.PART_EXT, 'wb') as f:
+            f.write(prefix)
+            f.truncate(SIZE)
+        with open(self.dest + transfer.STATE_EXT, 'w') as f:
+            json.dump(state, f)
+
+    def test_resume(self):
+        # Bytes copied by the earlier run are kept as they are.
+        prefix = b'x' * 1000
+        stat = os.stat(self.src)
+        self.write_partial(prefix, dict(
+                source=dict(size=stat.st_size, mtime=stat.st_mtime),
+                ranges=[[0, SIZE]], done=[len(prefix)]))
+        sha256 = self.copy()
+        expected = prefix + self.data[len(prefix):]
+        self.assertEqual(self.read_dest(), expected)
+        self.assertEqual(sha256, hashlib.sha256(expected).hexdigest())
+        self.assertFalse(os.path.exists(self.dest + transfer.STATE_EXT))
+
+    def test_resume_other_source(self):
+        self.write_partial(b'x' * 1000, dict(
+                source=dict(size=SIZE, mtime=0), ranges=[[0, SIZE]],
+                done=[1000]))
+        self.copy()
+        self.assertEqual(self.read_dest(), self.data)
+
+    def test_mismatch(self):
+        # Differs between the source and the copy.
+        transfer._range_digest = lambda path, *args: path
+        for readers in (1, 3):
+            try:
+                self.copy(readers)
+            except TransferError as e:
+                self.assertTrue('Checksum mismatch' in str(e), str(e))
+            else:
+                self.fail("No TransferError")
+            self.assertFalse(os.path.exists(self.dest))
+            self.assertFalse(os.path.exists(self.dest + transfer.PART_EXT))
+            self.assertFalse(os.path.exists(self.dest + transfer.STATE_EXT))
+
+
+if __name__ == '__main__':
+    unittest.main()